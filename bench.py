@@ -0,0 +1,434 @@
+# -- coding: utf-8 --
+# Load benchmark for server.py. Starts the server in a child process against a
+# synthetic drive, drives concurrent keep-alive clients through each scenario
+# and reports throughput, latency percentiles and the server's peak RSS.
+#
+#   python bench.py                          # quick run, results in bench-results.json
+#   python bench.py --full                   # adds the 100k folder and a 4 GB file
+#   python bench.py --compare old.json       # show the change against an earlier run
+#   python bench.py -o SEARCH_INDEX_ENABLED=False --scenarios listing_10000,range
+import os
+import sys
+import time
+import json
+import shutil
+import signal
+import socket
+import random
+import base64
+import argparse
+import platform
+import tempfile
+import threading
+import itertools
+import subprocess
+import http.client
+
+import server
+
+DEFAULT_FOLDER_SIZES = (10, 1000, 10000)
+FULL_FOLDER_SIZES = (10, 1000, 10000, 100000)
+DEFAULT_FILE_SIZES = ('1K', '1M', '100M', '1G')
+FULL_FILE_SIZES = ('1K', '1M', '100M', '1G', '4G')
+DELETE_POOL_SIZE = 5000
+RANGE_LENGTH = 64 * 1024
+READ_BUFFER_SIZE = 1024 * 1024
+DATASET_VERSION = 1
+
+AUTH = {'Authorization': 'Basic ' + base64.b64encode(f'{server.USERNAME}:{server.PASSWORD}'.encode('utf-8')).decode('ascii')}
+
+# Runs in the child process: argv is repo dir, drive dir, port, NAME=VALUE overrides.
+BOOTSTRAP = r"""
+import sys, ast
+sys.path.insert(0, sys.argv[1])
+import server
+server.UPLOAD_DIR = sys.argv[2]
+server.LOG_TO_CONSOLE = False
+for option in sys.argv[4:]:
+    name, _, value = option.partition('=')
+    if not hasattr(server, name):
+        sys.exit(f"Unknown server setting {name}")
+    setattr(server, name, ast.literal_eval(value))
+server.run(port=int(sys.argv[3]))
+"""
+
+def parse_size(text):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile.
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# --- Synthetic drive ---
+
+def build_dataset(root, folder_sizes, file_sizes, clients):
+    # Folders and big files are reused between runs when the spec matches;
+    # the mutable areas (uploads, rename, delete) are reset every time.
+    spec = {'version': DATASET_VERSION, 'folders': list(folder_sizes), 'files': list(file_sizes)}
+    marker = os.path.join(root, '.bench-dataset.json')
+    try:
+        with open(marker) as f:
+            reuse = json.load(f) == spec
+    except (OSError, ValueError):
+        reuse = False
+
+    started = time.monotonic()
+    if not reuse:
+        print(f"Building synthetic drive in {root} ...")
+        for name in ('lists', 'files'):
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+        for count in folder_sizes:
+            folder = os.path.join(root, 'lists', f'n{count}')
+            os.makedirs(folder)
+            for i in range(count):
+                if i % 10 == 9:
+                    os.mkdir(os.path.join(folder, f'folder_{i:06d}'))
+                else:
+                    with open(os.path.join(folder, f'file_{i:06d}.txt'), 'wb') as f:
+                        f.write(b'x' * (i % 4096))
+        os.makedirs(os.path.join(root, 'files'))
+        for label in file_sizes:
+            # Sparse files: any size costs no disk space and reads are repeatable.
+            with open(os.path.join(root, 'files', f'{label}.bin'), 'wb') as f:
+                f.truncate(parse_size(label))
+        with open(marker, 'w') as f:
+            json.dump(spec, f)
+
+    for name in ('uploads', 'rename', 'delete'):
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+        os.makedirs(os.path.join(root, name))
+    for i in range(clients):
+        os.makedirs(os.path.join(root, 'rename', f'c{i}'))
+        with open(os.path.join(root, 'rename', f'c{i}', 'a.txt'), 'wb') as f:
+            f.write(b'rename me')
+    for i in range(DELETE_POOL_SIZE):
+        with open(os.path.join(root, 'delete', f'd{i:06d}.txt'), 'wb') as f:
+            f.write(b'delete me')
+    print(f"Synthetic drive ready in {time.monotonic() - started:.1f}s")
+
+# --- Scenarios ---
+# Each scenario maps (client index, request number, per-client state) to
+# (method, path, body, headers), or None when it has nothing left to do.
+
+def listing_scenario(count):
+    return lambda i, n, state: ('GET', f'/lists/n{count}', None, {})
+
+def list_api_scenario(count):
+    return lambda i, n, state: ('GET', f'/_api/list?path=lists/n{count}&limit=200', None, {})
+
+def download_scenario(label):
+    return lambda i, n, state: ('GET', f'/files/{label}.bin', None, {})
+
+def range_scenario(label, seed):
+    size = parse_size(label)
+
+    def make(i, n, state):
+        start = random.Random(seed * 1000003 + n).randrange(0, max(1, size - RANGE_LENGTH))
+        return 'GET', f'/files/{label}.bin', None, {'Range': f'bytes={start}-{start + RANGE_LENGTH - 1}'}
+    return make
+
+def upload_scenario(upload_size):
+    payload = b'u' * upload_size
+    boundary = 'benchboundary7MA4YWxkTrZu0gW'
+
+    def make(i, n, state):
+        body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="up_{n:07d}.bin"\r\n'
+                f'Content-Type: application/octet-stream\r\n\r\n').encode('ascii') + payload + f'\r\n--{boundary}--\r\n'.encode('ascii')
+        return 'POST', '/upload?path=uploads', body, {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+    return make
+
+def rename_scenario(i, n, state):
+    # Each client flips its own file between a.txt and b.txt.
+    flips = state.get('flips', 0)
+    state['flips'] = flips + 1
+    old, new = ('a.txt', 'b.txt') if flips % 2 == 0 else ('b.txt', 'a.txt')
+    return 'POST', '/rename', f'old_path=rename/c{i}/{old}&new_name={new}'.encode('ascii'), {'Content-Type': 'application/x-www-form-urlencoded'}
+
+def delete_scenario(i, n, state):
+    if n >= DELETE_POOL_SIZE:
+        return None
+    return 'POST', '/delete', f'path=delete/d{n:06d}.txt'.encode('ascii'), {'Content-Type': 'application/x-www-form-urlencoded'}
+
+def build_scenarios(folder_sizes, file_sizes, upload_size, seed):
+    scenarios = {}
+    for count in folder_sizes:
+        scenarios[f'listing_{count}'] = (listing_scenario(count), True)
+    scenarios[f'list_api_{max(folder_sizes)}'] = (list_api_scenario(max(folder_sizes)), True)
+    for label in file_sizes:
+        scenarios[f'download_{label}'] = (download_scenario(label), True)
+    scenarios['range'] = (range_scenario(file_sizes[-1], seed), True)
+    # Mutating scenarios get no warm-up round.
+    scenarios['upload'] = (upload_scenario(upload_size), False)
+    scenarios['rename'] = (rename_scenario, False)
+    scenarios['delete'] = (delete_scenario, False)
+    return scenarios
+
+# --- Measurement ---
+
+class RSSSampler:
+    # Polls the server's resident set size from /proc while a scenario runs.
+
+    def __init__(self, pid, interval=0.1):
+        self._path = f'/proc/{pid}/status'
+        self._interval = interval
+        self._stop = threading.Event()
+        self.peak = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def read(self, field='VmRSS'):
+        try:
+            with open(self._path) as f:
+                for line in f:
+                    if line.startswith(field + ':'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = self.read()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+            self._stop.wait(self._interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def run_scenario(port, make_request, clients, duration, max_requests):
+    latencies = []
+    results = {'requests': 0, 'errors': 0, 'bytes': 0}
+    lock = threading.Lock()
+    counter = itertools.count()
+    stop_at = time.monotonic() + duration
+
+    def client(i):
+        buffer = bytearray(READ_BUFFER_SIZE)
+        state = {}
+        conn = None
+        local_latencies = []
+        requests = errors = received = 0
+        while time.monotonic() < stop_at:
+            n = next(counter)
+            if max_requests and n >= max_requests:
+                break
+            request = make_request(i, n, state)
+            if request is None:
+                break
+            method, path, body, headers = request
+            if conn is None:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+            started = time.perf_counter()
+            ok = False
+            try:
+                conn.request(method, path, body=body, headers={**AUTH, **headers})
+                response = conn.getresponse()
+                while True:
+                    got = response.readinto(buffer)
+                    if not got:
+                        break
+                    received += got
+                ok = response.status in (200, 206, 303)
+                if response.will_close:
+                    conn.close()
+                    conn = None
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = None
+            local_latencies.append(time.perf_counter() - started)
+            requests += 1
+            errors += not ok
+        if conn is not None:
+            conn.close()
+        with lock:
+            latencies.extend(local_latencies)
+            results['requests'] += requests
+            results['errors'] += errors
+            results['bytes'] += received
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    results['duration_s'] = round(elapsed, 3)
+    results['rps'] = round(results['requests'] / elapsed, 2) if elapsed else None
+    results['mb_per_s'] = round(results['bytes'] / elapsed / (1024 * 1024), 2) if elapsed else None
+    results['latency_ms'] = {
+        'p50': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        'p95': round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+        'p99': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        'mean': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+        'max': round(latencies[-1] * 1000, 3) if latencies else None,
+    }
+    return results
+
+# --- Server process ---
+
+def start_server(root, port, options):
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen([sys.executable, '-c', BOOTSTRAP, repo_dir, root, str(port)] + list(options),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Server exited during startup: {proc.stderr.read().decode('utf-8', 'replace')}")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/_api/list?limit=1', headers=AUTH)
+            status = conn.getresponse().status
+            conn.close()
+            if status == 200:
+                return proc
+        except OSError:
+            pass
+        time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("Server did not start within 60s")
+
+def stop_server(proc):
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+# --- Reporting ---
+
+def print_table(results, baseline=None):
+    header = f"{'scenario':<22}{'requests':>9}{'errors':>7}{'req/s':>10}{'MB/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak RSS':>10}"
+    if baseline:
+        header += f"{'Δ req/s':>10}{'Δ p95':>9}"
+    print(header)
+    print('-' * len(header))
+    for name, r in results['scenarios'].items():
+        lat = r['latency_ms']
+        rss = f"{r['peak_rss_bytes'] / (1024 * 1024):.0f}M" if r.get('peak_rss_bytes') else '-'
+        line = (f"{name:<22}{r['requests']:>9}{r['errors']:>7}{r['rps'] or 0:>10.1f}{r['mb_per_s'] or 0:>9.1f}"
+                f"{lat['p50'] or 0:>10.2f}{lat['p95'] or 0:>10.2f}{lat['p99'] or 0:>10.2f}{rss:>10}")
+        old = (baseline or {}).get('scenarios', {}).get(name)
+        if old:
+            line += f"{change(old.get('rps'), r['rps']):>10}{change(old['latency_ms'].get('p95'), lat['p95']):>9}"
+        print(line)
+    peak = results['server'].get('peak_rss_bytes')
+    if peak:
+        print(f"Server peak RSS: {peak / (1024 * 1024):.1f} MB")
+
+def change(old, new):
+    if not old or new is None:
+        return '-'
+    return f"{(new - old) / old * 100:+.0f}%"
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark server.py against a synthetic drive.")
+    parser.add_argument('--full', action='store_true', help="include the 100k-entry folder and a 4 GB file")
+    parser.add_argument('--folders', help="comma-separated folder sizes (default: 10,1000,10000)")
+    parser.add_argument('--files', help="comma-separated file sizes such as 1K,1M,1G (default: 1K,1M,100M,1G)")
+    parser.add_argument('--scenarios', help="comma-separated scenario names to run (default: all)")
+    parser.add_argument('--clients', type=int, default=8, help="concurrent clients (default: 8)")
+    parser.add_argument('--duration', type=float, default=10, help="seconds per scenario (default: 10)")
+    parser.add_argument('--requests', type=int, default=0, help="stop a scenario after this many requests")
+    parser.add_argument('--warmup', type=float, default=1, help="seconds of unmeasured warm-up per read scenario")
+    parser.add_argument('--upload-size', default='1M', help="size of each uploaded file (default: 1M)")
+    parser.add_argument('--seed', type=int, default=1, help="seed for ranged download offsets")
+    parser.add_argument('--data-dir', help="where to build the drive; reused when it matches (default: temporary)")
+    parser.add_argument('--port', type=int, default=0, help="server port (default: a free one)")
+    parser.add_argument('-o', '--server-option', action='append', default=[], metavar='NAME=VALUE',
+                        help="override a server.py setting, e.g. SERVER_MODE='threaded' (repeatable)")
+    parser.add_argument('--output', default='bench-results.json', help="JSON results file")
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    folder_sizes = tuple(int(x) for x in args.folders.split(',')) if args.folders else (FULL_FOLDER_SIZES if args.full else DEFAULT_FOLDER_SIZES)
+    file_sizes = tuple(x.strip() for x in args.files.split(',')) if args.files else (FULL_FILE_SIZES if args.full else DEFAULT_FILE_SIZES)
+    scenarios = build_scenarios(folder_sizes, file_sizes, parse_size(args.upload_size), args.seed)
+    if args.scenarios:
+        wanted = [s.strip() for s in args.scenarios.split(',')]
+        unknown = [s for s in wanted if s not in scenarios]
+        if unknown:
+            parser.error(f"unknown scenario(s) {', '.join(unknown)}; available: {', '.join(scenarios)}")
+        scenarios = {name: scenarios[name] for name in wanted}
+
+    temporary = args.data_dir is None
+    root = os.path.abspath(args.data_dir or tempfile.mkdtemp(prefix='drive-bench-'))
+    os.makedirs(root, exist_ok=True)
+    build_dataset(root, folder_sizes, file_sizes, args.clients)
+
+    port = args.port or free_port()
+    proc = start_server(root, port, args.server_option)
+    sampler = RSSSampler(proc.pid)
+    results = {
+        'meta': {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'clients': args.clients,
+            'duration_s': args.duration,
+            'max_requests': args.requests,
+            'folder_sizes': list(folder_sizes),
+            'file_sizes': list(file_sizes),
+            'upload_size': parse_size(args.upload_size),
+            'seed': args.seed,
+            'server_options': args.server_option,
+        },
+        'server': {},
+        'scenarios': {},
+    }
+    try:
+        for name, (make_request, warm_up) in scenarios.items():
+            if warm_up and args.warmup > 0:
+                run_scenario(port, make_request, args.clients, args.warmup, 0)
+            print(f"Running {name} ...", flush=True)
+            with RSSSampler(proc.pid) as scenario_rss:
+                result = run_scenario(port, make_request, args.clients, args.duration, args.requests)
+            result['peak_rss_bytes'] = scenario_rss.peak
+            results['scenarios'][name] = result
+        results['server']['peak_rss_bytes'] = sampler.read('VmHWM')
+    finally:
+        stop_server(proc)
+        if temporary:
+            shutil.rmtree(root, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print()
+    print_table(results, baseline)
+    print(f"\nResults saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
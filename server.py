@@ -1,24 +1,4570 @@
 # -- coding: utf-8 --
 import os
+import stat
+import sys
 import shutil
-from http.server import SimpleHTTPRequestHandler, HTTPServer
-import cgi
-from datetime import datetime
+import queue
+import bisect
+import itertools
+import contextlib
+import threading
+import time
+import socket
+import select
+import re
+import secrets
+from collections import OrderedDict
+from array import array
+import pickle
+import ctypes
+import errno
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import ctypes.util
+import struct
+import zlib
+import zipfile
+import mimetypes
+from collections import namedtuple, deque
+from http.server import SimpleHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
 import urllib.parse
 import json
 import html
 import base64
+import email.utils
+import hashlib
+import email.parser
+import email.message
+import subprocess
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+try:
+    from PIL import Image, ImageOps  # optional (pip install pillow): photo thumbnails
+except ImportError:
+    Image = ImageOps = None
 
 UPLOAD_DIR = '/storage/emulated/0/Drive'
 PORT = 8000
-MAX_UPLOAD_SIZE = 100 * 1024 * 1024
-ALLOW_DELETE_NON_EMPTY_DIRS = False
+MAX_UPLOAD_SIZE = 100 * 1024 * 1024  # per file
+MAX_UPLOAD_REQUEST_SIZE = 4 * 1024 * 1024 * 1024  # one multi-file upload request
+UPLOAD_CHUNK_SIZE = 256 * 1024
+MAX_FORM_FIELD_SIZE = 64 * 1024
+MAX_PART_HEADER_SIZE = 16 * 1024
+MAX_RESUMABLE_UPLOAD_SIZE = 16 * 1024 * 1024 * 1024
+UPLOAD_SESSION_TTL = 24 * 60 * 60
+ALLOW_DELETE_NON_EMPTY_DIRS = False  # non-empty folders are deleted by a background job
+JOB_WORKERS = 2  # threads running background jobs (recursive deletes)
+JOB_HISTORY_TTL = 24 * 60 * 60  # finished jobs stay visible in /_api/jobs this long
+STATE_DIR_NAME = '.drive'  # server bookkeeping inside UPLOAD_DIR; hidden from listings
+API_PREFIX = '/_api/'
+STATIC_PREFIX = '/_static/'  # stylesheet, script and icons of the web UI
+
+SERVER_MODE = 'pool'  # 'pool' (bounded workers), 'threaded' (thread per connection) or 'single'
+MAX_WORKERS = 8
+REQUEST_QUEUE_SIZE = 32
+SHUTDOWN_DRAIN_TIMEOUT = 30
+KEEPALIVE_TIMEOUT = 15  # idle seconds before a persistent connection is closed
+MAX_KEEPALIVE_REQUESTS = 100
+REQUEST_TIMEOUT = 120  # socket timeout while a request is being read or answered
+MAX_UNREAD_BODY_DISCARD = 64 * 1024
+
+MAX_RANGES_PER_REQUEST = 16
+LISTING_CACHE_MAX_BYTES = 32 * 1024 * 1024
+LISTING_PAGE_SIZE = 200
+MAX_LISTING_PAGE_SIZE = 1000
+CHANGE_TRACKING = 'auto'  # 'auto' (inotify, else polling), 'inotify', 'poll' or 'off'
+CHANGE_POLL_INTERVAL = 10
+CHANGE_COALESCE_DELAY = 0.05  # seconds a change waits so repeat reports of it can be merged
+# Open folder pages get changes pushed over Server-Sent Events and update in
+# place. A stream holds a worker thread, so at most MAX_EVENT_STREAMS run at
+# once, and a stream is ended early when other clients are waiting for a
+# worker; the browser reconnects a few seconds later and catches up from
+# the last EVENT_HISTORY_SIZE changes.
+EVENTS_ENABLED = True
+MAX_EVENT_STREAMS = max(1, MAX_WORKERS // 2)
+EVENT_STREAM_TIMEOUT = 300  # seconds before a stream is handed back and reopened
+EVENT_HEARTBEAT_INTERVAL = 15
+EVENT_HISTORY_SIZE = 1000
+SEARCH_INDEX_ENABLED = True
+SEARCH_RESULT_LIMIT = 100
+MAX_SEARCH_RESULT_LIMIT = 1000
+DISK_USAGE_ENABLED = True
+# Uploads identical to a file already on the drive are stored as a reflink
+# (copy-on-write clone) or, failing that, a hardlink to it instead of a new
+# copy. A hardlinked file edited in place (not re-uploaded) changes in every
+# folder that holds it; set DEDUP_HARDLINKS = False to only use reflinks.
+DEDUP_ENABLED = True
+DEDUP_HARDLINKS = True
+DEDUP_MIN_SIZE = 64 * 1024
+DEDUP_MAX_CANDIDATES = 4  # same-size files hashed per upload when looking for a match
+DUPLICATES_RESULT_LIMIT = 100
+# Sync API: a client posts a manifest of its files and gets back what to
+# upload, download or delete. Modification times this close count as equal
+# (FAT and exFAT cards only keep even seconds).
+SYNC_MTIME_TOLERANCE = 2
+MAX_SYNC_MANIFEST_SIZE = 64 * 1024 * 1024  # after gzip decoding
+SYNC_BLOCK_SIZE = 64 * 1024  # block size of file signatures for delta uploads
+SYNC_DELTA_MIN_SIZE = 1024 * 1024  # changed files from this size are worth a delta upload
+USAGE_RESULT_LIMIT = 50
+MAX_USAGE_RESULT_LIMIT = 1000
+STATE_SAVE_INTERVAL = 300  # seconds between saves of the search index and folder sizes
+
+# Cache-Control per response type. Keys are matched as prefixes of the content
+# type (longest wins); 'listing' is used for folder pages. Everything carries
+# validators, so 'no-cache' still means a cheap 304 when nothing changed.
+CACHE_POLICIES = {
+    'listing': 'private, no-cache',
+    'image/': 'private, max-age=3600',
+    'video/': 'private, max-age=3600',
+    'audio/': 'private, max-age=3600',
+    'thumbnail': 'private, max-age=31536000, immutable',  # versioned /_api/thumb URLs
+    'static': 'public, max-age=31536000, immutable',  # content-hashed /_static/ URLs
+    '': 'private, no-cache',
+}
+
+COMPRESSION_ENABLED = True
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_LEVEL = 6
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml',
+                      'application/xhtml+xml', 'image/svg+xml', 'application/x-sh', 'application/x-yaml')
+# Extensions that are already compressed even when their guessed type looks
+# like text (e.g. notes.txt.gz is guessed as text/plain).
+PRECOMPRESSED_EXTENSIONS = ('.gz', '.tgz', '.bz2', '.xz', '.zst', '.br', '.zip', '.7z', '.rar', '.svgz',
+                            '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.mov', '.pdf')
+COMPRESSED_CACHE_MAX_BYTES = 64 * 1024 * 1024
+COMPRESSED_CACHE_MAX_FILE_SIZE = 16 * 1024 * 1024
+COMPRESSED_CACHE_MIN_HITS = 2
+
+ZIP_MAX_SELECTION = 1000
+
+# Photo thumbnails need Pillow; video thumbnails (a frame from the first
+# second) need ffmpeg on the PATH. Without either, cards keep the type icon.
+THUMBNAILS_ENABLED = True
+THUMBNAIL_SIZE = 256  # longest side, pixels
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_WORKERS = 2  # processes (threads where the platform has no process pool)
+THUMBNAIL_CACHE_MAX_BYTES = 256 * 1024 * 1024
+THUMBNAIL_MAX_SOURCE_SIZE = 256 * 1024 * 1024  # larger images are not decoded
+THUMBNAIL_TIMEOUT = 60
+THUMBNAIL_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tif', '.tiff')
+THUMBNAIL_VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv', '.webm', '.m4v', '.3gp')
+FFMPEG_PATH = 'ffmpeg'
+
+METRICS_ENABLED = True  # Prometheus text format at /_api/metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+LOG_FILE = None  # JSON lines; None keeps it at .drive/logs/drive.log
+LOG_TO_CONSOLE = True
+LOG_ACCESS = True  # one 'request' event per HTTP request
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+LOG_QUEUE_SIZE = 10000
+LOG_QUEUE_FULL = 'drop'  # 'drop' (never stall a request) or 'block'
+
+BANDWIDTH_LIMIT = 0  # bytes/s shared by all bulk transfers; 0 = unlimited
+CLIENT_BANDWIDTH_LIMIT = 0  # bytes/s per client; 0 = unlimited
+BULK_TRANSFER_SIZE = 1024 * 1024  # larger downloads/uploads yield to pages, API calls and small files
+BANDWIDTH_BURST_SECONDS = 0.25
+THROTTLE_CHUNK_SIZE = 64 * 1024
+
+USE_SENDFILE = True
+SENDFILE_CHUNK_SIZE = 4 * 1024 * 1024
+TRANSFER_BUFFER_SIZE = 1024 * 1024
 
 USERNAME = "username"
 PASSWORD = "your_password"
 REALM = "My Private Drive"
 
+def state_dir(*parts):
+    path = os.path.join(UPLOAD_DIR, STATE_DIR_NAME, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+class EventLog:
+    # Structured log written by a background thread. Callers only enqueue a
+    # dict; the writer takes everything queued, appends it to the JSON-lines
+    # file in one write, rotates by size and echoes a short line to the
+    # terminal. A slow terminal or disk therefore only delays the writer.
+    # When the queue is full events are dropped and counted, or the caller
+    # waits, depending on LOG_QUEUE_FULL.
+
+    BATCH_SIZE = 500
+
+    def __init__(self, queue_size=LOG_QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self._file_failed = False
+        self.dropped = 0
+
+    def log(self, event, message=None, level='info', **fields):
+        record = {'ts': time.time(), 'level': level, 'event': event}
+        if message is not None:
+            record['msg'] = message
+        record.update(fields)
+        if self._thread is None:
+            self.start()
+        if LOG_QUEUE_FULL == 'block':
+            self._queue.put(record)
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="event-log", daemon=True)
+                self._thread.start()
+
+    def close(self, timeout=5):
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def _run(self):
+        reported_drops = 0
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = None in batch
+            batch = [record for record in batch if record is not None]
+            dropped = self.dropped
+            if dropped != reported_drops:
+                batch.append({'ts': time.time(), 'level': 'warning', 'event': 'log_dropped',
+                              'msg': f"Log queue full, dropped {dropped - reported_drops} event(s)",
+                              'count': dropped - reported_drops})
+                reported_drops = dropped
+            try:
+                self._write(batch)
+            except Exception as e:
+                sys.stderr.write(f"Event log write failed: {e}\n")
+            if stopping:
+                if self._file:
+                    self._file.close()
+                return
+
+    def _write(self, batch):
+        if not batch:
+            return
+        lines = []
+        console = []
+        for record in batch:
+            ts = record['ts']
+            record['ts'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(ts)) + f'.{int(ts % 1 * 1000):03d}'
+            lines.append(json.dumps(record, ensure_ascii=False, default=str))
+            if LOG_TO_CONSOLE:
+                console.append(f"[{record['ts'][11:19]}] {record.get('msg') or self._describe(record)}")
+        if console:
+            sys.stdout.write('\n'.join(console) + '\n')
+            sys.stdout.flush()
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        f = self._open()
+        if f is None:
+            return
+        if self._size and self._size + len(data) > LOG_MAX_BYTES:
+            f = self._rotate()
+            if f is None:
+                return
+        f.write(data)
+        f.flush()
+        self._size += len(data)
+
+    def _describe(self, record):
+        if record['event'] == 'request':
+            return (f'{record.get("client")} "{record.get("method")} {record.get("path")}" {record.get("status")} '
+                    f'{record.get("bytes_out")}B {record.get("duration_ms")}ms')
+        return ' '.join(f'{k}={v}' for k, v in record.items() if k not in ('ts', 'level'))
+
+    def path(self):
+        return LOG_FILE or os.path.join(state_dir('logs'), 'drive.log')
+
+    def _open(self):
+        if self._file is None and not self._file_failed:
+            try:
+                self._file = open(self.path(), 'ab')
+                self._size = self._file.tell()
+            except OSError as e:
+                self._file_failed = True
+                sys.stderr.write(f"Event log disabled, cannot open {self.path()}: {e}\n")
+        return self._file
+
+    def _rotate(self):
+        path = self.path()
+        self._file.close()
+        self._file = None
+        try:
+            for i in range(LOG_BACKUP_COUNT - 1, 0, -1):
+                if os.path.exists(f'{path}.{i}'):
+                    os.replace(f'{path}.{i}', f'{path}.{i + 1}')
+            if LOG_BACKUP_COUNT > 0:
+                os.replace(path, f'{path}.1')
+            else:
+                os.remove(path)
+        except OSError as e:
+            sys.stderr.write(f"Event log rotation failed: {e}\n")
+        return self._open()
+
+event_log = EventLog()
+
+def log_event(event, message=None, level='info', **fields):
+    event_log.log(event, message, level, **fields)
+
+def file_etag(st):
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+def cache_policy_for(content_type):
+    best = ''
+    for prefix in CACHE_POLICIES:
+        if content_type.startswith(prefix) and len(prefix) > len(best):
+            best = prefix
+    return CACHE_POLICIES.get(best, 'private, no-cache')
+
+def etag_matches(if_none_match, etag):
+    # Weak comparison, as required for If-None-Match.
+    if if_none_match.strip() == '*':
+        return True
+    bare = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == bare:
+            return True
+    return False
+
+_LISTING_ETAG_SALT = f"{os.getpid()}-{time.time()}".encode('ascii')
+
+def listing_validators(rel_path, snapshot):
+    # The page is generated, so the tag is weak and salted per server process
+    # (a restart may ship a different page layout for the same folder).
+    if snapshot.validators is None:
+        digest = hashlib.sha1(_LISTING_ETAG_SALT)
+        digest.update(rel_path.encode('utf-8', 'surrogateescape'))
+        last_modified = snapshot.dir_mtime
+        for name in snapshot.dirs:
+            digest.update(b'\0d' + name.encode('utf-8', 'surrogateescape'))
+        for name, size, mtime in snapshot.files:
+            digest.update(f"\0f{name}\0{size}\0{mtime}".encode('utf-8', 'surrogateescape'))
+            if mtime is not None:
+                last_modified = max(last_modified, mtime)
+        snapshot.validators = (f'W/"{digest.hexdigest()[:20]}"', last_modified)
+    # Folder cards show recursive totals, which change without this folder's
+    # own entries changing.
+    stamp = disk_usage.stamp(rel_path) if DISK_USAGE_ENABLED else None
+    if stamp is None:
+        return snapshot.validators
+    etag, last_modified = snapshot.validators
+    return f'{etag[:-1]}-{stamp}"', last_modified
+
+class DirectorySnapshot:
+    # One scandir pass over a folder: sorted sub-folder names and
+    # (name, size, mtime) tuples for files. size/mtime are None when the
+    # file could not be stat'ed.
+    __slots__ = ('dir_mtime_ns', 'dir_mtime', 'dirs', 'files', 'approx_bytes', 'validators', 'views', 'usage_stamp')
+
+    def __init__(self, abs_path, hide_state_dir=False):
+        dir_stat = os.stat(abs_path)
+        self.dir_mtime_ns = dir_stat.st_mtime_ns
+        self.dir_mtime = dir_stat.st_mtime
+        self.dirs = []
+        self.files = []
+        self.validators = None
+        self.views = {}
+        self.usage_stamp = None
+        approx_bytes = 200
+        with os.scandir(abs_path) as it:
+            for entry in it:
+                if hide_state_dir and entry.name == STATE_DIR_NAME:
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                    is_file = not is_dir and entry.is_file()
+                except OSError:
+                    continue
+                if is_dir:
+                    self.dirs.append(entry.name)
+                elif is_file:
+                    try:
+                        st = entry.stat()
+                        self.files.append((entry.name, st.st_size, st.st_mtime))
+                    except OSError:
+                        self.files.append((entry.name, None, None))
+                else:
+                    continue
+                # Tuple, name, stat fields, plus room for a few sorted views.
+                approx_bytes += 160 + 2 * len(entry.name)
+        self.dirs.sort(key=str.lower)
+        self.files.sort(key=lambda item: item[0].lower())
+        self.approx_bytes = approx_bytes
+
+class DirectoryListingCache:
+    # LRU of DirectorySnapshots keyed by absolute path, bounded by an estimate
+    # of their memory use. A hit is one stat() of the folder: the snapshot is
+    # reused only while the folder's mtime is unchanged. Folders modified in
+    # the last couple of seconds are not cached, since coarse mtime clocks
+    # (FUSE, FAT) could hide a second change within the same tick.
+
+    RACY_WINDOW_NS = 2 * 10**9
+
+    def __init__(self, max_bytes=LISTING_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()  # also guards each cached snapshot's views
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, abs_path):
+        mtime_ns = os.stat(abs_path).st_mtime_ns
+        with self.lock:
+            snapshot = self._entries.get(abs_path)
+            if snapshot is not None and snapshot.dir_mtime_ns == mtime_ns:
+                self._entries.move_to_end(abs_path)
+                self.hits += 1
+                return snapshot
+            self.misses += 1
+        snapshot = DirectorySnapshot(abs_path, hide_state_dir=(abs_path == UPLOAD_DIR))
+        if time.time_ns() - snapshot.dir_mtime_ns > self.RACY_WINDOW_NS:
+            self._store(abs_path, snapshot)
+        return snapshot
+
+    def _store(self, abs_path, snapshot):
+        if snapshot.approx_bytes > self.max_bytes:
+            return
+        with self.lock:
+            old = self._entries.pop(abs_path, None)
+            if old is not None:
+                self._bytes -= old.approx_bytes
+            self._entries[abs_path] = snapshot
+            self._bytes += snapshot.approx_bytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.approx_bytes
+
+    def stats(self):
+        with self.lock:
+            return len(self._entries), self._bytes, self.hits, self.misses
+
+    def invalidate(self, abs_path, recursive=False):
+        prefix = abs_path.rstrip(os.sep) + os.sep
+        with self.lock:
+            for key in list(self._entries):
+                if key == abs_path or (recursive and key.startswith(prefix)):
+                    self._bytes -= self._entries.pop(key).approx_bytes
+
+listing_cache = DirectoryListingCache()
+
+# Listing entries are ('folder' | 'file', name, size, mtime, file_count).
+# Folders carry their recursive size and file count (None until the disk
+# usage walk has finished) and no mtime; files have no file_count. Folders
+# always come first; the key orders entries inside each group and ends with
+# the name so that it is unique within a folder (which keyset cursors rely on).
+LISTING_SORT_KEYS = {
+    'name': lambda e: (e[1].lower(), e[1]),
+    'size': lambda e: (e[2] if e[2] is not None else -1, e[1].lower(), e[1]),
+    'mtime': lambda e: (e[3] if e[3] is not None else 0, e[1].lower(), e[1]),
+    'type': lambda e: (os.path.splitext(e[1])[1].lower(), e[1].lower(), e[1]),
+}
+
+def sorted_listing(snapshot, rel_path, sort, descending):
+    stamp = disk_usage.stamp(rel_path) if DISK_USAGE_ENABLED else None
+    with listing_cache.lock:
+        if stamp != snapshot.usage_stamp:
+            snapshot.views = {}
+            snapshot.usage_stamp = stamp
+        view = snapshot.views.get((sort, descending))
+    if view is None:
+        key = LISTING_SORT_KEYS[sort]
+        totals = disk_usage.children_totals(rel_path) if stamp is not None else {}
+        dirs = []
+        for name in snapshot.dirs:
+            size, count = totals.get(name, (None, None))
+            dirs.append(('folder', name, size, None, count))
+        files = [('file', name, size, mtime, None) for name, size, mtime in snapshot.files]
+        view = sorted(dirs, key=key, reverse=descending) + sorted(files, key=key, reverse=descending)
+        with listing_cache.lock:
+            if snapshot.usage_stamp == stamp:
+                snapshot.views[(sort, descending)] = view
+    return view
+
+def listing_cursor(entry, sort):
+    key = [0 if entry[0] == 'folder' else 1, *LISTING_SORT_KEYS[sort](entry)]
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(',', ':')).encode('utf-8')).decode('ascii').rstrip('=')
+
+def listing_position_after(view, cursor, sort, descending):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        after_key = json.loads(raw.decode('utf-8'))
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(after_key, list) or not after_key or after_key[0] not in (0, 1):
+        raise ValueError("Invalid cursor")
+    after_key = tuple(after_key)
+    key = LISTING_SORT_KEYS[sort]
+    lo, hi = 0, len(view)
+    try:
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = view[mid]
+            kind = 0 if entry[0] == 'folder' else 1
+            if kind != after_key[0]:
+                is_after = kind > after_key[0]
+            elif descending:
+                is_after = key(entry) < after_key[1:]
+            else:
+                is_after = key(entry) > after_key[1:]
+            if is_after:
+                hi = mid
+            else:
+                lo = mid + 1
+    except TypeError:
+        # Made for another sort order, or not by us at all.
+        raise ValueError("Invalid cursor")
+    return lo
+
+def listing_page(snapshot, rel_path, sort='name', descending=False, query='', cursor=None, offset=0, limit=LISTING_PAGE_SIZE):
+    view = sorted_listing(snapshot, rel_path, sort, descending)
+    if query:
+        needle = query.lower()
+        view = [entry for entry in view if needle in entry[1].lower()]
+    if cursor:
+        offset = listing_position_after(view, cursor, sort, descending)
+    offset = max(0, min(offset, len(view)))
+    page = view[offset:offset + limit]
+    prefix = rel_path + '/' if rel_path else ''
+    next_cursor = listing_cursor(page[-1], sort) if page and offset + len(page) < len(view) else None
+    entries = []
+    for kind, name, size, mtime, count in page:
+        entry = {'type': kind, 'name': name, 'path': prefix + name, 'size': size, 'mtime': mtime}
+        if kind == 'folder':
+            entry['files'] = count
+        entries.append(entry)
+    return {
+        'path': rel_path,
+        'sort': sort,
+        'order': 'desc' if descending else 'asc',
+        'query': query,
+        'total': len(view),
+        'offset': offset,
+        'version': listing_validators(rel_path, snapshot)[0],
+        'next_cursor': next_cursor,
+        'entries': entries,
+    }
+
+def is_compressible(content_type, path=None):
+    if path is not None and path.lower().endswith(PRECOMPRESSED_EXTENSIONS):
+        return False
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+def choose_encoding(accept_encoding):
+    offered = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try: quality = float(value)
+                except ValueError: quality = 0.0
+        if coding:
+            offered[coding.strip().lower()] = quality
+    for coding in ('gzip', 'deflate'):
+        if offered.get(coding, offered.get('*', 0)) > 0:
+            return coding
+    return None
+
+def compressor_for(encoding):
+    # 'deflate' in HTTP means the zlib wrapper; wbits 31 selects gzip framing.
+    return zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+
+def compress_bytes(data, encoding):
+    compressor = compressor_for(encoding)
+    return compressor.compress(data) + compressor.flush()
+
+def parse_byte_ranges(range_header, file_size):
+    # Returns None when the header should be ignored (bad syntax, other units,
+    # too many ranges), [] when nothing in it is satisfiable, otherwise a sorted
+    # list of merged (start, end) pairs with inclusive ends.
+    units, _, spec = range_header.partition('=')
+    if units.strip().lower() != 'bytes' or not spec.strip():
+        return None
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
+        if not sep:
+            return None
+        first, last = first.strip(), last.strip()
+        try:
+            if first == '':
+                if not last: return None
+                suffix = int(last)
+                if suffix <= 0: continue
+                start, end = max(0, file_size - suffix), file_size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else file_size - 1
+                if start < 0 or (last and end < start): return None
+                end = min(end, file_size - 1)
+        except ValueError:
+            return None
+        if start < file_size and start <= end:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES_PER_REQUEST:
+        return None
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+class MultipartError(ValueError):
+    pass
+
+def upload_components(filename):
+    # Relative path from a folder upload, minus anything that could climb
+    # out of the target folder.
+    components = [c for c in re.split(r'[\\/]', filename or '') if c not in ('', '.', '..')]
+    return components or ['uploaded_file']
+
+def multipart_boundary(content_type_header):
+    msg = email.message.Message()
+    msg['Content-Type'] = content_type_header
+    boundary = msg.get_param('boundary')
+    if not isinstance(boundary, str) or not 0 < len(boundary) <= 200:
+        return None
+    return boundary.encode('latin-1', 'replace')
+
+class MultipartPart:
+
+    def __init__(self, reader, headers):
+        self._reader = reader
+        self.headers = headers
+        self.name = headers.get_param('name', header='content-disposition')
+        self.filename = headers.get_filename()
+        self.content_type = headers.get_content_type()
+        self.mtime = None
+        # RFC 2183 lets a client send the file's own modification time, so a
+        # synced copy keeps it instead of getting the upload time.
+        modified = headers.get_param('modification-date', header='content-disposition')
+        if isinstance(modified, str):
+            try:
+                self.mtime = email.utils.parsedate_to_datetime(modified).timestamp()
+            except (TypeError, ValueError):
+                pass
+        self.done = False
+
+    def read(self, size=UPLOAD_CHUNK_SIZE):
+        if self.done:
+            return b''
+        data = self._reader._read_part_data(size)
+        if not data:
+            self.done = True
+        return data
+
+    def read_value(self, limit=MAX_FORM_FIELD_SIZE):
+        value = bytearray()
+        while True:
+            chunk = self.read()
+            if not chunk:
+                break
+            value += chunk
+            if len(value) > limit:
+                raise MultipartError(f"Form field '{self.name}' is larger than {limit} bytes")
+        return value.decode('utf-8', 'replace')
+
+    def drain(self):
+        while self.read():
+            pass
+
+class MultipartReader:
+    # Incremental multipart/form-data parser. Parts are produced in order and
+    # their bodies are read straight off the socket in bounded chunks, so
+    # nothing is spooled to memory or temp files. Reading past the current
+    # part (or iterating on) discards whatever is left of it.
+
+    def __init__(self, rfile, boundary, content_length):
+        self._rfile = rfile
+        self._remaining = content_length
+        self._delimiter = b'\r\n--' + boundary
+        # The first boundary has no leading CRLF; pretend it does so that one
+        # delimiter search covers every boundary.
+        self._buf = bytearray(b'\r\n')
+        self._current = None
+        self._finished = False
+
+    def _fill(self):
+        if self._remaining <= 0:
+            return False
+        data = self._rfile.read1(min(UPLOAD_CHUNK_SIZE, self._remaining))
+        if not data:
+            raise MultipartError("Request body ended before the closing boundary")
+        self._remaining -= len(data)
+        self._buf += data
+        return True
+
+    def _read_part_data(self, size):
+        delimiter_len = len(self._delimiter)
+        while True:
+            idx = self._buf.find(self._delimiter)
+            if idx == 0:
+                return b''
+            if idx > 0:
+                n = min(idx, size)
+            else:
+                # Keep a tail that might be the start of a split delimiter.
+                n = min(len(self._buf) - delimiter_len + 1, size)
+                if n < size and self._remaining > 0:
+                    self._fill()
+                    continue
+                if n <= 0:
+                    raise MultipartError("Request body ended inside a part")
+            data = bytes(self._buf[:n])
+            del self._buf[:n]
+            return data
+
+    def _next_part(self):
+        while True:
+            idx = self._buf.find(self._delimiter)
+            if idx >= 0 and len(self._buf) >= idx + len(self._delimiter) + 2:
+                break
+            if idx > 0:
+                del self._buf[:idx]
+            elif idx < 0 and len(self._buf) > len(self._delimiter):
+                del self._buf[:len(self._buf) - len(self._delimiter)]
+            if not self._fill():
+                raise MultipartError("Missing multipart boundary")
+        del self._buf[:idx + len(self._delimiter)]
+        if self._buf[:2] == b'--':
+            self._finished = True
+            self._buf.clear()
+            while self._remaining > 0 and self._fill():
+                self._buf.clear()
+            return None
+
+        while True:
+            line_end = self._buf.find(b'\r\n')
+            header_end = self._buf.find(b'\r\n\r\n', max(line_end, 0)) if line_end >= 0 else -1
+            if header_end >= 0:
+                break
+            if len(self._buf) > MAX_PART_HEADER_SIZE:
+                raise MultipartError("Multipart part headers are too large")
+            if not self._fill():
+                raise MultipartError("Request body ended inside part headers")
+        header_bytes = bytes(self._buf[line_end + 2:header_end]) if header_end > line_end else b''
+        del self._buf[:header_end + 4]
+        headers = email.parser.Parser().parsestr(header_bytes.decode('utf-8', 'replace'), headersonly=True)
+        return MultipartPart(self, headers)
+
+    def __iter__(self):
+        while not self._finished:
+            if self._current is not None:
+                self._current.drain()
+            self._current = self._next_part()
+            if self._current is None:
+                return
+            yield self._current
+
+    def collect_fields(self):
+        form = FormData()
+        for part in self:
+            if part.name is None or part.filename is not None:
+                continue
+            form.add(part.name, part.read_value())
+        return form
+
+class FormData:
+
+    def __init__(self, fields=None):
+        self._fields = fields or {}
+
+    @classmethod
+    def from_urlencoded(cls, body):
+        return cls(urllib.parse.parse_qs(body.decode('utf-8', 'replace'), keep_blank_values=True))
+
+    def add(self, name, value):
+        self._fields.setdefault(name, []).append(value)
+
+    def __contains__(self, name):
+        return name in self._fields
+
+    def getvalue(self, name, default=None):
+        values = self._fields.get(name)
+        return values[0] if values else default
+
+class UploadSessionError(Exception):
+
+    def __init__(self, status, message, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+class UploadSessionStore:
+    # Resumable uploads. Each session is a JSON record plus a .part file under
+    # the state directory (same filesystem as UPLOAD_DIR, so finishing is an
+    # atomic rename). The current offset is simply the size of the .part file,
+    # which stays correct across crashes and restarts.
+
+    _ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session_locks = {}
+
+    def _paths(self, session_id):
+        if not self._ID_RE.match(session_id or ''):
+            raise UploadSessionError(404, "Unknown upload session")
+        base = state_dir('uploads')
+        return os.path.join(base, session_id + '.json'), os.path.join(base, session_id + '.part')
+
+    def _session_lock(self, session_id):
+        with self._lock:
+            return self._session_locks.setdefault(session_id, threading.Lock())
+
+    def _load(self, session_id):
+        meta_path, part_path = self._paths(session_id)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                session = json.load(f)
+            session['offset'] = os.path.getsize(part_path)
+        except (FileNotFoundError, ValueError):
+            raise UploadSessionError(404, "Unknown upload session")
+        return session
+
+    def create(self, target_rel_dir, filename, size, mtime=None):
+        session_id = secrets.token_hex(16)
+        meta_path, part_path = self._paths(session_id)
+        session = {'id': session_id, 'path': target_rel_dir, 'filename': filename,
+                   'size': size, 'mtime': mtime, 'created': time.time()}
+        open(part_path, 'wb').close()
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(session, f)
+        session['offset'] = 0
+        return session
+
+    def status(self, session_id):
+        return self._load(session_id)
+
+    def append(self, session_id, offset, stream, length):
+        with self._session_lock(session_id):
+            session = self._load(session_id)
+            _, part_path = self._paths(session_id)
+            if offset != session['offset']:
+                raise UploadSessionError(409, "Offset does not match the uploaded size", session['offset'])
+            limit = session['size'] if session['size'] is not None else MAX_RESUMABLE_UPLOAD_SIZE
+            if offset + length > limit:
+                raise UploadSessionError(413, f"Chunk goes past the end of the upload ({limit} bytes)", offset)
+            with open(part_path, 'r+b') as f:
+                f.seek(offset)
+                remaining = length
+                try:
+                    while remaining > 0:
+                        chunk = stream.read1(min(UPLOAD_CHUNK_SIZE, remaining))
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        remaining -= len(chunk)
+                finally:
+                    # Whatever arrived before a disconnect is kept; the client
+                    # asks for the offset and continues from there.
+                    f.flush()
+            os.utime(part_path)
+            session['offset'] = offset + (length - remaining)
+            if remaining:
+                raise UploadSessionError(400, "Request body ended early", session['offset'])
+            return session
+
+    def finish(self, session_id, target_abs_dir):
+        with self._session_lock(session_id):
+            session = self._load(session_id)
+            meta_path, part_path = self._paths(session_id)
+            if session['size'] is not None and session['offset'] != session['size']:
+                raise UploadSessionError(409, "Upload is incomplete", session['offset'])
+            if not os.path.isdir(target_abs_dir):
+                raise UploadSessionError(404, "Upload target directory does not exist.")
+            save_path = os.path.join(target_abs_dir, session['filename'])
+            duplicate_of = dedup.place(part_path, save_path, session['offset'], sync=True, mtime=session.get('mtime'))
+            os.remove(meta_path)
+        with self._lock:
+            self._session_locks.pop(session_id, None)
+        session['saved_as'] = save_path
+        if duplicate_of is not None:
+            session['duplicate_of'] = duplicate_of
+        return session
+
+    def abort(self, session_id):
+        with self._session_lock(session_id):
+            meta_path, part_path = self._paths(session_id)
+            if not os.path.exists(meta_path):
+                raise UploadSessionError(404, "Unknown upload session")
+            for path in (part_path, meta_path):
+                try: os.remove(path)
+                except FileNotFoundError: pass
+        with self._lock:
+            self._session_locks.pop(session_id, None)
+
+    def collect_garbage(self):
+        base = state_dir('uploads')
+        cutoff = time.time() - UPLOAD_SESSION_TTL
+        removed = 0
+        for entry in os.scandir(base):
+            try:
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+                session_id = entry.name.split('.')[0]
+                if entry.name.endswith('.json') and os.path.exists(os.path.join(base, session_id + '.part')):
+                    # Age is decided by the .part file, which is touched on every chunk.
+                    continue
+                os.remove(entry.path)
+                removed += 1
+            except OSError:
+                continue
+        return removed
+
+upload_sessions = UploadSessionStore()
+
+def _upload_session_gc_loop():
+    while True:
+        try:
+            removed = upload_sessions.collect_garbage()
+            if removed:
+                log_event('upload_gc', f"Removed {removed} expired partial upload file(s)", count=removed)
+        except OSError as e:
+            log_event('upload_gc', f"Partial upload cleanup failed: {e}", level='error')
+        time.sleep(min(UPLOAD_SESSION_TTL, 3600))
+
+class JobError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class JobCancelled(Exception):
+    pass
+
+class JobManager:
+    # Long-running file operations. Handlers submit a job and answer at once
+    # with its id; a small pool of worker threads does the work. Each job is
+    # a JSON record under the state directory, rewritten as it makes progress,
+    # so the queue survives a restart: jobs that were queued or running start
+    # again when the server comes back. Job kinds must therefore be safe to
+    # re-run from the beginning.
+
+    _ID_RE = re.compile(r'^[0-9a-f]{32}$')
+    SAVE_INTERVAL = 1.0
+    UNFINISHED = ('queued', 'running')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._queue = queue.Queue()
+        self._cancelled = set()
+        self._saved_at = {}
+        self._started = False
+
+    def _path(self, job_id):
+        return os.path.join(state_dir('jobs'), job_id + '.json')
+
+    def _save(self, job):
+        path = self._path(job['id'])
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(job, f)
+        os.replace(path + '.tmp', path)
+        self._saved_at[job['id']] = time.monotonic()
+
+    def start(self, workers=JOB_WORKERS):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            resumed = []
+            for entry in os.scandir(state_dir('jobs')):
+                job_id, ext = os.path.splitext(entry.name)
+                if ext != '.json' or not self._ID_RE.match(job_id):
+                    continue
+                try:
+                    with open(entry.path, 'r', encoding='utf-8') as f:
+                        job = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                self._jobs[job_id] = job
+                if job['state'] in self.UNFINISHED:
+                    job.update(state='queued', started=None, items=0, bytes=0)
+                    resumed.append(job)
+            for job in sorted(resumed, key=lambda job: job['created']):
+                self._save(job)
+                self._queue.put(job['id'])
+            self._collect_garbage()
+        if resumed:
+            log_event('jobs', f"Resuming {len(resumed)} unfinished job(s)", count=len(resumed))
+        for number in range(workers):
+            threading.Thread(target=self._worker, name=f"job-worker-{number}", daemon=True).start()
+
+    def submit(self, kind, path, **fields):
+        if kind not in JOB_KINDS:
+            raise JobError(400, f"Unknown job kind '{kind}'")
+        with self._lock:
+            # Asking twice for the same operation (a double click, a retried
+            # request) returns the job that is already on its way.
+            for job in self._jobs.values():
+                if job['kind'] == kind and job['path'] == path and job['state'] in self.UNFINISHED:
+                    return dict(job)
+            job = {'id': secrets.token_hex(16), 'kind': kind, 'path': path, 'state': 'queued',
+                   'created': time.time(), 'started': None, 'finished': None, 'items': 0, 'bytes': 0,
+                   'total_items': None, 'total_bytes': None, 'error': None, **fields}
+            self._jobs[job['id']] = job
+            self._save(job)
+            self._collect_garbage()
+        self._queue.put(job['id'])
+        log_event('jobs', f"Queued {kind} job {job['id']} for /{path}", job=job['id'], kind=kind, path=path)
+        return dict(job)
+
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                raise JobError(404, "Unknown job")
+            return dict(job)
+
+    def list(self):
+        with self._lock:
+            return sorted((dict(job) for job in self._jobs.values()), key=lambda job: job['created'], reverse=True)
+
+    def counts(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job['state']] = counts.get(job['state'], 0) + 1
+            return counts
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                raise JobError(404, "Unknown job")
+            if job['state'] == 'queued':
+                job.update(state='cancelled', finished=time.time())
+                self._save(job)
+            elif job['state'] == 'running':
+                self._cancelled.add(job_id)
+            return dict(job)
+
+    def progress(self, job, items=0, nbytes=0):
+        # Called by job kinds as they go; raises JobCancelled once the job has
+        # been cancelled, so work stops at the next item.
+        with self._lock:
+            job['items'] += items
+            job['bytes'] += nbytes
+            if job['id'] in self._cancelled:
+                raise JobCancelled()
+            if time.monotonic() - self._saved_at.get(job['id'], 0) >= self.SAVE_INTERVAL:
+                self._save(job)
+
+    def set_totals(self, job, items, nbytes):
+        with self._lock:
+            job['total_items'] = items
+            job['total_bytes'] = nbytes
+
+    def _worker(self):
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None or job['state'] != 'queued':
+                    continue
+                job.update(state='running', started=time.time())
+                self._save(job)
+            started = time.monotonic()
+            state, error = 'done', None
+            try:
+                JOB_KINDS[job['kind']](self, job)
+            except JobCancelled:
+                state = 'cancelled'
+            except Exception as e:
+                state, error = 'failed', str(e)
+            with self._lock:
+                self._cancelled.discard(job_id)
+                job.update(state=state, error=error, finished=time.time())
+                try:
+                    self._save(job)
+                except OSError:
+                    pass
+            log_event('jobs', f"Job {job_id} ({job['kind']} /{job['path']}) {state} after {time.monotonic() - started:.1f}s"
+                      + (f": {error}" if error else ''), level='error' if error else 'info',
+                      job=job_id, kind=job['kind'], path=job['path'], state=state, items=job['items'], bytes=job['bytes'])
+
+    def _collect_garbage(self):
+        cutoff = time.time() - JOB_HISTORY_TTL
+        for job_id, job in list(self._jobs.items()):
+            if job['state'] not in self.UNFINISHED and job['finished'] < cutoff:
+                del self._jobs[job_id]
+                self._saved_at.pop(job_id, None)
+                try: os.remove(self._path(job_id))
+                except FileNotFoundError: pass
+
+def _delete_job(jobs, job):
+    abs_path = rel_to_abs(job['path'])
+    if not os.path.lexists(abs_path):
+        return
+    is_dir = os.path.isdir(abs_path) and not os.path.islink(abs_path)
+    totals = disk_usage.totals(job['path']) if DISK_USAGE_ENABLED and disk_usage.ready else None
+    if totals is not None:
+        jobs.set_totals(job, totals[1] + totals[2] + 1, totals[0])
+    try:
+        if not is_dir:
+            size = os.lstat(abs_path).st_size
+            os.remove(abs_path)
+            jobs.progress(job, 1, size)
+            return
+        for dirpath, dirnames, filenames in os.walk(abs_path, topdown=False):
+            for name in filenames:
+                file_path = os.path.join(dirpath, name)
+                try:
+                    size = os.lstat(file_path).st_size
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    size = 0
+                jobs.progress(job, 1, size)
+            for name in dirnames:
+                dir_path = os.path.join(dirpath, name)
+                try:
+                    os.remove(dir_path) if os.path.islink(dir_path) else os.rmdir(dir_path)
+                except FileNotFoundError:
+                    pass
+                jobs.progress(job, 1)
+        os.rmdir(abs_path)
+        jobs.progress(job, 1)
+    finally:
+        # A cancelled or failed delete leaves part of the tree behind; report
+        # it as removed and re-added so listings and indexes pick up what is left.
+        record_change('deleted', abs_path, is_dir=is_dir)
+        if os.path.lexists(abs_path):
+            record_change('added', abs_path)
+
+# Background job kinds: name -> function(jobs, job). Each must be safe to
+# start over from scratch, since unfinished jobs are re-run after a restart.
+JOB_KINDS = {
+    'delete': _delete_job,
+}
+
+jobs = JobManager()
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class _SearchData:
+    # Column-oriented entry table plus a trigram -> entry id posting index over
+    # lower-cased file names. Removed entries are tombstoned (name set to None)
+    # and squeezed out by compact().
+
+    def __init__(self):
+        self.paths = []
+        self.names = []
+        self.kinds = bytearray()
+        self.sizes = array('q')
+        self.mtimes = array('d')
+        self.postings = {}
+        self.by_ext = {}
+        self.by_path = {}
+        self.dead = 0
+
+    def add(self, rel_path, is_dir, size, mtime):
+        existing = self.by_path.get(rel_path)
+        if existing is not None:
+            if self.kinds[existing] == (1 if is_dir else 0):
+                self.sizes[existing] = size
+                self.mtimes[existing] = mtime
+                return
+            self.remove(rel_path)
+        entry_id = len(self.paths)
+        name = rel_path.rsplit('/', 1)[-1].lower()
+        self.paths.append(rel_path)
+        self.names.append(name)
+        self.kinds.append(1 if is_dir else 0)
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+        self.by_path[rel_path] = entry_id
+        for gram in _trigrams(name):
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array('I')
+            posting.append(entry_id)
+        if not is_dir:
+            ext = os.path.splitext(name)[1]
+            posting = self.by_ext.get(ext)
+            if posting is None:
+                posting = self.by_ext[ext] = array('I')
+            posting.append(entry_id)
+
+    def remove(self, rel_path):
+        # A folder takes everything below it along; only then is the whole
+        # table scanned.
+        entry_id = self.by_path.get(rel_path)
+        if entry_id is None:
+            return 0
+        doomed = [rel_path]
+        if self.kinds[entry_id] == 1:
+            prefix = rel_path + '/'
+            doomed.extend(p for p in self.by_path if p.startswith(prefix))
+        for path in doomed:
+            entry_id = self.by_path.pop(path)
+            self.names[entry_id] = None
+            self.dead += 1
+        return len(doomed)
+
+    def compact(self):
+        fresh = _SearchData()
+        for entry_id, name in enumerate(self.names):
+            if name is not None:
+                fresh.add(self.paths[entry_id], self.kinds[entry_id], self.sizes[entry_id], self.mtimes[entry_id])
+        return fresh
+
+    def candidates(self, needle, extensions=None):
+        if len(needle) < 3:
+            if extensions:
+                return [entry_id for ext in extensions for entry_id in self.by_ext.get(ext, ())]
+            return range(len(self.paths))
+        postings = []
+        for gram in _trigrams(needle):
+            posting = self.postings.get(gram)
+            if posting is None:
+                return ()
+            postings.append(posting)
+        # Verifying the substring is cheap, so walking the shortest posting
+        # list beats intersecting them all.
+        return min(postings, key=len)
+
+class SearchIndex:
+    # In-memory filename index over the whole of UPLOAD_DIR. It is loaded from
+    # disk at startup (so search works immediately), then rebuilt by a
+    # background walk. The server's own uploads, renames and deletes update it
+    # in place. Changes that arrive during a rebuild are replayed on the new
+    # data before it is swapped in.
+
+    FORMAT_VERSION = 1
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._data = _SearchData()
+        self._replay = None
+        self._dirty = False
+        self.ready = False
+        self.building = False
+
+    def _index_file(self):
+        return os.path.join(state_dir('search'), 'index.pickle')
+
+    def load(self):
+        # The file lives in the server's private state directory and is only
+        # ever written by save().
+        try:
+            with open(self._index_file(), 'rb') as f:
+                saved = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            log_event('search_index', f"Ignoring unreadable search index: {e}", level='warning')
+            return False
+        if saved.get('version') != self.FORMAT_VERSION or saved.get('root') != UPLOAD_DIR:
+            return False
+        with self._lock:
+            self._data = saved['data']
+            self.ready = True
+        return True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            if self._data.dead:
+                self._data = self._data.compact()
+            payload = pickle.dumps({'version': self.FORMAT_VERSION, 'root': UPLOAD_DIR, 'data': self._data},
+                                   protocol=pickle.HIGHEST_PROTOCOL)
+            self._dirty = False
+        path = self._index_file()
+        with open(path + '.tmp', 'wb') as f:
+            f.write(payload)
+        os.replace(path + '.tmp', path)
+
+    def rebuild(self):
+        with self._lock:
+            if self.building:
+                return
+            self.building = True
+            self._replay = []
+        started = time.monotonic()
+        fresh = _SearchData()
+        try:
+            for entry in self._walk(UPLOAD_DIR, ''):
+                fresh.add(*entry)
+            with self._lock:
+                for action, args in self._replay:
+                    getattr(self, action)(*args, data=fresh)
+                self._data = fresh
+                self._dirty = True
+                self.ready = True
+            log_event('search_index', f"Search index built: {len(fresh.by_path)} entries in {time.monotonic() - started:.1f}s",
+                      entries=len(fresh.by_path))
+        finally:
+            with self._lock:
+                self.building = False
+                self._replay = None
+
+    def _walk(self, abs_dir, rel_dir):
+        # (rel path, is_dir, size, mtime) for everything below abs_dir.
+        stack = [(abs_dir, rel_dir)]
+        while stack:
+            current_abs, current_rel = stack.pop()
+            try:
+                it = os.scandir(current_abs)
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    if not current_rel and entry.name == STATE_DIR_NAME:
+                        continue
+                    rel = f"{current_rel}/{entry.name}" if current_rel else entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            found = (rel, True, 0, entry.stat(follow_symlinks=False).st_mtime)
+                            stack.append((entry.path, rel))
+                        elif entry.is_file():
+                            st = entry.stat()
+                            found = (rel, False, st.st_size, st.st_mtime)
+                        else:
+                            continue
+                    except OSError:
+                        continue
+                    yield found
+
+    def add_path(self, abs_path):
+        # The stat and any folder walk run outside the lock, so searches only
+        # wait for the merge.
+        rel = os.path.relpath(abs_path, UPLOAD_DIR).replace(os.sep, '/')
+        try:
+            st = os.stat(abs_path)
+        except OSError:
+            return
+        is_dir = stat.S_ISDIR(st.st_mode)
+        entries = [(rel, is_dir, 0 if is_dir else st.st_size, st.st_mtime)]
+        if is_dir:
+            entries.extend(self._walk(abs_path, rel))
+        self._add_entries(entries)
+
+    def _add_entries(self, entries, data=None):
+        with self._lock:
+            if data is None and self._replay is not None:
+                self._replay.append(('_add_entries', (entries,)))
+            target = data or self._data
+            for entry in entries:
+                target.add(*entry)
+            self._dirty = True
+
+    def remove_path(self, abs_path, data=None):
+        rel = os.path.relpath(abs_path, UPLOAD_DIR).replace(os.sep, '/')
+        with self._lock:
+            if data is None and self._replay is not None:
+                self._replay.append(('remove_path', (abs_path,)))
+            target = data or self._data
+            if target.remove(rel):
+                self._dirty = True
+            if target.dead > 1000 and target.dead > len(target.by_path) // 4:
+                if target is self._data:
+                    self._data = target.compact()
+
+    def search(self, query='', extensions=None, kind=None, min_size=None, max_size=None,
+               after=None, before=None, under=None, limit=SEARCH_RESULT_LIMIT):
+        needle = query.lower()
+        prefix = under.strip('/') + '/' if under and under.strip('/') else None
+        matches = []
+        with self._lock:
+            data = self._data
+            for entry_id in data.candidates(needle, extensions):
+                name = data.names[entry_id]
+                if name is None or needle not in name:
+                    continue
+                is_dir = data.kinds[entry_id] == 1
+                if kind is not None and kind != ('folder' if is_dir else 'file'):
+                    continue
+                if extensions and (is_dir or os.path.splitext(name)[1] not in extensions):
+                    continue
+                size, mtime = data.sizes[entry_id], data.mtimes[entry_id]
+                if (min_size is not None and size < min_size) or (max_size is not None and size > max_size):
+                    continue
+                if (after is not None and mtime < after) or (before is not None and mtime >= before):
+                    continue
+                if prefix and not data.paths[entry_id].startswith(prefix):
+                    continue
+                matches.append(entry_id)
+            # Exact names first, then prefix matches, then the rest; shorter
+            # paths win ties so that shallow hits come before deep ones.
+            matches.sort(key=lambda i: (data.names[i] != needle, not data.names[i].startswith(needle), len(data.paths[i]), data.paths[i]))
+            results = [{'type': 'folder' if data.kinds[i] else 'file', 'name': data.paths[i].rsplit('/', 1)[-1],
+                        'path': data.paths[i], 'size': None if data.kinds[i] else data.sizes[i], 'mtime': data.mtimes[i]}
+                       for i in matches[:limit]]
+            return {'total': len(matches), 'results': results, 'indexed': len(data.by_path),
+                    'ready': self.ready, 'building': self.building}
+
+    def files_under(self, rel_dir):
+        # {path below rel_dir: (size, mtime)} for every indexed file.
+        prefix = rel_dir + '/' if rel_dir else ''
+        with self._lock:
+            data = self._data
+            return {path[len(prefix):]: (data.sizes[entry_id], data.mtimes[entry_id])
+                    for path, entry_id in data.by_path.items()
+                    if path.startswith(prefix) and data.kinds[entry_id] == 0}
+
+    def files_of_size(self, size, limit):
+        # Paths of indexed files exactly `size` bytes long. The sizes column
+        # is searched as raw bytes, which runs at memchr speed.
+        needle = struct.pack('=q', size)
+        found = []
+        with self._lock:
+            data = self._data
+            raw = data.sizes.tobytes()
+            pos = raw.find(needle)
+            while pos >= 0 and len(found) < limit:
+                if pos % 8 == 0:
+                    entry_id = pos // 8
+                    if data.names[entry_id] is not None and data.kinds[entry_id] == 0:
+                        found.append(data.paths[entry_id])
+                    pos = raw.find(needle, pos + 8)
+                else:
+                    pos = raw.find(needle, pos + 1)
+        return found
+
+search_index = SearchIndex()
+
+def _search_index_loop():
+    if search_index.load():
+        log_event('search_index', "Search index loaded from disk, refreshing in the background...")
+    try:
+        search_index.rebuild()
+    except Exception as e:
+        log_event('search_index', f"Search index build failed: {e}", level='error')
+
+class _UsageNode:
+    # sizes maps each file directly in the folder to its size, and own_*
+    # total them; bytes/files/dirs cover the whole subtree. stamp changes
+    # whenever anything below the folder does.
+    __slots__ = ('sizes', 'own_bytes', 'own_files', 'bytes', 'files', 'dirs', 'children', 'stamp')
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.own_bytes = sum(sizes.values())
+        self.own_files = len(sizes)
+        self.bytes = self.own_bytes
+        self.files = self.own_files
+        self.dirs = 0
+        self.children = set()
+        self.stamp = 0
+
+def _parent_rel(rel):
+    return rel.rsplit('/', 1)[0] if '/' in rel else ''
+
+class DiskUsageIndex:
+    # Recursive size and file count for every folder under UPLOAD_DIR. Built
+    # by one walk (loaded from disk at startup, then refreshed in the
+    # background) and kept current from change events. A changed file costs
+    # one stat and its size difference is added to each of its parents; only
+    # a changed folder is re-read, so no update walks more than the part of
+    # the tree that changed.
+
+    FORMAT_VERSION = 2
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._dirs = {}
+        self._replay = None
+        self._dirty = False
+        self._clock = 0
+        self.ready = False
+        self.building = False
+
+    def _state_file(self):
+        return os.path.join(state_dir('usage'), 'usage.pickle')
+
+    def load(self):
+        try:
+            with open(self._state_file(), 'rb') as f:
+                saved = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            log_event('disk_usage', f"Ignoring unreadable folder sizes: {e}", level='warning')
+            return False
+        if saved.get('version') != self.FORMAT_VERSION or saved.get('root') != UPLOAD_DIR:
+            return False
+        with self._lock:
+            self._dirs = saved['dirs']
+            self._clock = saved['clock']
+            self.ready = True
+        return True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            payload = pickle.dumps({'version': self.FORMAT_VERSION, 'root': UPLOAD_DIR, 'clock': self._clock, 'dirs': self._dirs},
+                                   protocol=pickle.HIGHEST_PROTOCOL)
+            self._dirty = False
+        path = self._state_file()
+        with open(path + '.tmp', 'wb') as f:
+            f.write(payload)
+        os.replace(path + '.tmp', path)
+
+    def rebuild(self):
+        with self._lock:
+            if self.building:
+                return
+            self.building = True
+            self._replay = []
+        started = time.monotonic()
+        try:
+            fresh = self._walk(UPLOAD_DIR, '')
+            with self._lock:
+                self._clock += 1
+                for node in fresh.values():
+                    node.stamp = self._clock
+                self._dirs = fresh
+                for event in self._replay:
+                    self._apply(event)
+                self._dirty = True
+                self.ready = True
+            log_event('disk_usage', f"Folder sizes computed: {len(fresh)} folders in {time.monotonic() - started:.1f}s",
+                      folders=len(fresh))
+        finally:
+            with self._lock:
+                self.building = False
+                self._replay = None
+
+    def _scan(self, abs_dir, rel_dir):
+        # Files directly inside one folder, and its sub-folder names. Symlinked
+        # folders are not followed, so loops can't inflate the totals.
+        sizes = {}
+        subdirs = []
+        with os.scandir(abs_dir) as it:
+            for entry in it:
+                if not rel_dir and entry.name == STATE_DIR_NAME:
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.is_file():
+                        sizes[entry.name] = entry.stat().st_size
+                except OSError:
+                    continue
+        return sizes, subdirs
+
+    def _walk(self, abs_dir, rel_dir):
+        found = {}
+        order = []
+        stack = [(abs_dir, rel_dir)]
+        while stack:
+            current_abs, current_rel = stack.pop()
+            try:
+                sizes, subdirs = self._scan(current_abs, current_rel)
+            except OSError:
+                sizes, subdirs = {}, []
+            found[current_rel] = _UsageNode(sizes)
+            order.append(current_rel)
+            for name in subdirs:
+                found[current_rel].children.add(name)
+                stack.append((os.path.join(current_abs, name), f"{current_rel}/{name}" if current_rel else name))
+        # Children always come after their parent in order.
+        for rel in reversed(order):
+            if rel == rel_dir:
+                continue
+            child, parent = found[rel], found[_parent_rel(rel)]
+            parent.bytes += child.bytes
+            parent.files += child.files
+            parent.dirs += child.dirs + 1
+        return found
+
+    def _add_to_parents(self, rel, delta_bytes, delta_files, delta_dirs):
+        self._clock += 1
+        node = self._dirs.get(rel)
+        if node is not None:
+            node.stamp = self._clock
+        while rel:
+            rel = _parent_rel(rel)
+            parent = self._dirs.get(rel)
+            if parent is None:
+                break
+            parent.bytes += delta_bytes
+            parent.files += delta_files
+            parent.dirs += delta_dirs
+            parent.stamp = self._clock
+        self._dirty = True
+
+    def _subtree(self, rel):
+        stack = [rel]
+        while stack:
+            current = stack.pop()
+            node = self._dirs.get(current)
+            if node is None:
+                continue
+            yield current, node
+            stack.extend(f"{current}/{name}" if current else name for name in node.children)
+
+    def _add_tree(self, rel):
+        parent_rel = _parent_rel(rel)
+        if rel and parent_rel not in self._dirs:
+            self._add_tree(parent_rel)
+            return
+        if rel in self._dirs:
+            self._remove_tree(rel)
+        abs_path = rel_to_abs(rel)
+        if not os.path.isdir(abs_path) or os.path.islink(abs_path):
+            return
+        found = self._walk(abs_path, rel)
+        self._dirs.update(found)
+        top = found[rel]
+        if rel:
+            self._dirs[parent_rel].children.add(rel.rsplit('/', 1)[-1])
+        self._add_to_parents(rel, top.bytes, top.files, top.dirs + 1)
+        for node in found.values():
+            node.stamp = self._clock
+
+    def _remove_tree(self, rel):
+        top = self._dirs.get(rel)
+        if top is None or not rel:
+            return
+        for current, _ in list(self._subtree(rel)):
+            del self._dirs[current]
+        parent = self._dirs.get(_parent_rel(rel))
+        if parent is not None:
+            parent.children.discard(rel.rsplit('/', 1)[-1])
+        self._add_to_parents(rel, -top.bytes, -top.files, -(top.dirs + 1))
+
+    def _refresh(self, rel):
+        # Re-read one folder's own files and reconcile its sub-folder list.
+        node = self._dirs.get(rel)
+        if node is None:
+            self._add_tree(rel)
+            return
+        try:
+            sizes, subdirs = self._scan(rel_to_abs(rel), rel)
+        except OSError:
+            self._remove_tree(rel)
+            return
+        size, files = sum(sizes.values()), len(sizes)
+        delta_bytes, delta_files = size - node.own_bytes, files - node.own_files
+        node.sizes, node.own_bytes, node.own_files = sizes, size, files
+        node.bytes += delta_bytes
+        node.files += delta_files
+        self._add_to_parents(rel, delta_bytes, delta_files, 0)
+        current = set(subdirs)
+        for name in node.children - current:
+            self._remove_tree(f"{rel}/{name}" if rel else name)
+        for name in current - node.children:
+            self._add_tree(f"{rel}/{name}" if rel else name)
+
+    def _set_file(self, rel, size):
+        # Record one file's new size (None: it is gone) in its folder.
+        parent_rel = _parent_rel(rel)
+        parent = self._dirs.get(parent_rel)
+        if parent is None:
+            if size is not None:
+                self._add_tree(parent_rel)
+            return
+        name = rel.rsplit('/', 1)[-1]
+        old = parent.sizes.pop(name, None)
+        if size is not None:
+            parent.sizes[name] = size
+        delta_bytes = (size or 0) - (old or 0)
+        delta_files = (size is not None) - (old is not None)
+        if not delta_bytes and not delta_files:
+            return
+        parent.own_bytes += delta_bytes
+        parent.own_files += delta_files
+        parent.bytes += delta_bytes
+        parent.files += delta_files
+        self._add_to_parents(parent_rel, delta_bytes, delta_files, 0)
+
+    def _forget(self, rel):
+        if rel in self._dirs:
+            self._remove_tree(rel)
+        else:
+            self._set_file(rel, None)
+
+    def _apply(self, event):
+        path = event.path
+        if event.action == 'modified' and path in self._dirs:
+            self._refresh(path)
+            return
+        if event.old_path is not None:
+            self._forget(event.old_path)
+        if event.action == 'deleted':
+            self._forget(path)
+            return
+        abs_path = rel_to_abs(path)
+        try:
+            st = os.lstat(abs_path)
+        except OSError:
+            self._forget(path)
+            return
+        if stat.S_ISDIR(st.st_mode):
+            if event.action != 'modified' or path not in self._dirs:
+                self._add_tree(path)
+        else:
+            if path in self._dirs:
+                self._remove_tree(path)
+            if stat.S_ISLNK(st.st_mode):
+                try:
+                    st = os.stat(abs_path)
+                except OSError:
+                    st = None
+            self._set_file(path, st.st_size if st is not None and stat.S_ISREG(st.st_mode) else None)
+
+    def apply(self, event):
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append(event)
+            if self.ready:
+                self._apply(event)
+
+    def stamp(self, rel):
+        node = self._dirs.get(rel)
+        return node.stamp if node is not None else None
+
+    def totals(self, rel):
+        with self._lock:
+            node = self._dirs.get(rel)
+            return (node.bytes, node.files, node.dirs) if node is not None else None
+
+    def children_totals(self, rel):
+        # name -> (bytes, files) for the direct sub-folders of rel.
+        prefix = rel + '/' if rel else ''
+        with self._lock:
+            node = self._dirs.get(rel)
+            if node is None:
+                return {}
+            result = {}
+            for name in node.children:
+                child = self._dirs.get(prefix + name)
+                if child is not None:
+                    result[name] = (child.bytes, child.files)
+            return result
+
+    def largest(self, rel='', sort='bytes', descending=True, depth=None, limit=USAGE_RESULT_LIMIT):
+        key = {'bytes': lambda item: item[1].bytes, 'files': lambda item: item[1].files,
+               'name': lambda item: item[0].lower()}[sort]
+        with self._lock:
+            top = self._dirs.get(rel)
+            if top is None:
+                return None
+            base_depth = rel.count('/') + 1 if rel else 0
+            folders = []
+            for current, node in self._subtree(rel):
+                if current == rel:
+                    continue
+                if depth is not None and current.count('/') + 1 - base_depth > depth:
+                    continue
+                folders.append((current, node))
+            folders.sort(key=key, reverse=descending)
+            return {
+                'path': rel, 'bytes': top.bytes, 'files': top.files, 'dirs': top.dirs,
+                'total': len(folders), 'ready': self.ready, 'building': self.building,
+                'folders': [{'path': current, 'name': current.rsplit('/', 1)[-1], 'bytes': node.bytes,
+                             'files': node.files, 'dirs': node.dirs} for current, node in folders[:limit]],
+            }
+
+disk_usage = DiskUsageIndex()
+
+def _disk_usage_loop():
+    if disk_usage.load():
+        log_event('disk_usage', "Folder sizes loaded from disk, refreshing in the background...")
+    try:
+        disk_usage.rebuild()
+    except Exception as e:
+        log_event('disk_usage', f"Folder size walk failed: {e}", level='error')
+
+FICLONE = 0x40049409  # Linux ioctl: make dest share src's extents (btrfs, XFS)
+
+class DedupCatalog:
+    # SHA-256 of files on the drive, filled in as uploads stream through (the
+    # hash costs no extra read) and, lazily, for existing files that happen
+    # to have the same size as an upload. Entries remember the inode, size
+    # and mtime they were hashed at and are dropped as soon as the file no
+    # longer matches, so an edited file is never mistaken for its old self.
+    # An upload that matches a catalogued file becomes a reflink or hardlink
+    # to it; its temp copy is deleted without ever being fsynced, so on most
+    # filesystems its pages are dropped before reaching the flash.
+
+    FORMAT_VERSION = 1
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries = {}  # rel path -> (digest, inode, size, mtime_ns)
+        self._by_digest = {}
+        self._dirty = False
+        self.reflinks = fcntl is not None
+        self.hardlinks = DEDUP_HARDLINKS
+        self.linked_files = 0
+        self.linked_bytes = 0
+
+    def _state_file(self):
+        return os.path.join(state_dir('dedup'), 'catalog.pickle')
+
+    def load(self):
+        try:
+            with open(self._state_file(), 'rb') as f:
+                saved = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            log_event('dedup', f"Ignoring unreadable duplicate catalog: {e}", level='warning')
+            return False
+        if saved.get('version') != self.FORMAT_VERSION or saved.get('root') != UPLOAD_DIR:
+            return False
+        with self._lock:
+            self._entries = {}
+            self._by_digest = {}
+            for rel, entry in saved['entries'].items():
+                self._add(rel, entry)
+        return True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            payload = pickle.dumps({'version': self.FORMAT_VERSION, 'root': UPLOAD_DIR, 'entries': self._entries},
+                                   protocol=pickle.HIGHEST_PROTOCOL)
+            self._dirty = False
+        path = self._state_file()
+        with open(path + '.tmp', 'wb') as f:
+            f.write(payload)
+        os.replace(path + '.tmp', path)
+
+    def _add(self, rel, entry):
+        self._forget(rel)
+        self._entries[rel] = entry
+        self._by_digest.setdefault(entry[0], set()).add(rel)
+        self._dirty = True
+
+    def _forget(self, rel):
+        entry = self._entries.pop(rel, None)
+        if entry is None:
+            return
+        paths = self._by_digest.get(entry[0])
+        if paths is not None:
+            paths.discard(rel)
+            if not paths:
+                del self._by_digest[entry[0]]
+        self._dirty = True
+
+    def remember(self, abs_path, digest, st=None):
+        st = st or os.stat(abs_path)
+        with self._lock:
+            self._add(abs_to_rel(abs_path), (digest, st.st_ino, st.st_size, st.st_mtime_ns))
+
+    def forget(self, rel, recursive=False):
+        with self._lock:
+            self._forget(rel)
+            if recursive:
+                prefix = rel + '/'
+                for path in [p for p in self._entries if p.startswith(prefix)]:
+                    self._forget(path)
+
+    def move(self, old_rel, new_rel):
+        with self._lock:
+            prefix = old_rel + '/'
+            moved = [(p, new_rel + p[len(old_rel):]) for p in self._entries if p == old_rel or p.startswith(prefix)]
+            for old, new in moved:
+                entry = self._entries[old]
+                self._forget(old)
+                self._add(new, entry)
+
+    def _current(self, rel):
+        # (digest, stat) if the catalogued digest still describes the file.
+        with self._lock:
+            entry = self._entries.get(rel)
+        if entry is None:
+            return None
+        try:
+            st = os.stat(rel_to_abs(rel))
+        except OSError:
+            st = None
+        if st is None or (st.st_ino, st.st_size, st.st_mtime_ns) != entry[1:]:
+            with self._lock:
+                if self._entries.get(rel) == entry:
+                    self._forget(rel)
+            return None
+        return entry[0], st
+
+    def digest_of(self, rel):
+        current = self._current(rel)
+        if current is not None:
+            return current[0]
+        abs_path = rel_to_abs(rel)
+        try:
+            before = os.stat(abs_path)
+            digest = _file_digest(abs_path)
+            after = os.stat(abs_path)
+        except OSError:
+            return None
+        if (before.st_ino, before.st_size, before.st_mtime_ns) != (after.st_ino, after.st_size, after.st_mtime_ns):
+            return None  # changed while we read it
+        self.remember(abs_path, digest, after)
+        return digest
+
+    def _matches(self, digest, size):
+        with self._lock:
+            paths = sorted(self._by_digest.get(digest, ()))
+        for rel in paths:
+            current = self._current(rel)
+            if current is not None and current[0] == digest and current[1].st_size == size:
+                yield rel
+
+    def _size_candidates(self, size, exclude):
+        with self._lock:
+            seen = {rel for rel, entry in self._entries.items() if entry[2] == size}
+        candidates = []
+        if SEARCH_INDEX_ENABLED and search_index.ready:
+            candidates = [rel for rel in search_index.files_of_size(size, DEDUP_MAX_CANDIDATES * 4)
+                          if rel not in seen and rel != exclude]
+        return candidates[:DEDUP_MAX_CANDIDATES]
+
+    def place(self, temp_path, save_path, size, digest=None, sync=False, mtime=None):
+        # Moves a finished upload from temp_path to save_path. When the same
+        # content is already on the drive, save_path becomes a clone of that
+        # file instead and temp_path is deleted. digest=None (a resumable
+        # upload) means the upload is only hashed if some file has its size.
+        # mtime (from the client) is applied to the result; a hardlink is only
+        # used if the existing file already has it, since links share it.
+        # Returns the relative path of the file it now shares data with.
+        if DEDUP_ENABLED and size >= DEDUP_MIN_SIZE and (self.reflinks or self.hardlinks):
+            save_rel = abs_to_rel(save_path)
+            candidates = self._size_candidates(size, save_rel)
+            if digest is None:
+                with self._lock:
+                    has_catalogued = any(entry[2] == size for entry in self._entries.values())
+                digest = _file_digest(temp_path) if candidates or has_catalogued else None
+            if digest is not None:
+                for rel in itertools.chain(self._matches(digest, size),
+                                           (rel for rel in candidates if self.digest_of(rel) == digest)):
+                    if rel == save_rel:
+                        continue
+                    source = rel_to_abs(rel)
+                    hardlink = mtime is None or int(os.stat(source).st_mtime) == int(mtime)
+                    linked = self._clone(source, save_path, hardlink)
+                    if linked:
+                        os.remove(temp_path)
+                        if mtime is not None and linked == 'reflink':
+                            os.utime(save_path, (mtime, mtime))
+                        self.remember(save_path, digest)
+                        self.linked_files += 1
+                        self.linked_bytes += size
+                        log_event('dedup', f"{save_rel} has the same content as {rel}, stored as a link",
+                                  path=save_rel, duplicate_of=rel, size=size)
+                        return rel
+        if sync:
+            with open(temp_path, 'rb') as f:
+                os.fsync(f.fileno())
+        os.replace(temp_path, save_path)
+        if mtime is not None:
+            os.utime(save_path, (mtime, mtime))
+        if DEDUP_ENABLED and digest is not None and size >= DEDUP_MIN_SIZE:
+            self.remember(save_path, digest)
+        return None
+
+    def _clone(self, source, dest, hardlink=True):
+        # Returns 'reflink' or 'hardlink' for how dest now shares source's
+        # data, or None if it could not be linked.
+        link_path = f"{dest}.{threading.get_ident()}.link"
+        try:
+            if self.reflinks:
+                try:
+                    with open(source, 'rb') as src, open(link_path, 'wb') as dst:
+                        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    os.replace(link_path, dest)
+                    return 'reflink'
+                except OSError as e:
+                    os.remove(link_path)
+                    if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.EPERM):
+                        self.reflinks = False  # this filesystem can't clone; don't try again
+                    elif not (self.hardlinks and hardlink):
+                        raise
+            if self.hardlinks and hardlink:
+                try:
+                    os.link(source, link_path)
+                except OSError as e:
+                    if e.errno in (errno.EPERM, errno.EOPNOTSUPP, errno.EXDEV, errno.ENOSYS):
+                        self.hardlinks = False  # e.g. FAT or Android shared storage
+                        log_event('dedup', f"Hardlinks are not supported here ({e}); uploads are stored as copies", level='warning')
+                        return None
+                    raise
+                os.replace(link_path, dest)
+                return 'hardlink'
+        except OSError as e:
+            log_event('dedup', f"Could not link {abs_to_rel(dest)} to {abs_to_rel(source)}: {e}", level='warning')
+            try: os.remove(link_path)
+            except OSError: pass
+        return None
+
+    def duplicates(self, under='', limit=DUPLICATES_RESULT_LIMIT):
+        # Groups of catalogued files with the same content, most space
+        # wasted first. Files sharing an inode already take no extra space.
+        prefix = under + '/' if under else ''
+        with self._lock:
+            groups = [sorted(paths) for paths in self._by_digest.values() if len(paths) > 1]
+        result = []
+        for paths in groups:
+            current = {}
+            for rel in paths:
+                if prefix and not rel.startswith(prefix):
+                    continue
+                state = self._current(rel)
+                if state is not None:
+                    current[rel] = state
+            if len(current) < 2:
+                continue
+            size = next(iter(current.values()))[1].st_size
+            inodes = {(st.st_dev, st.st_ino) for _, st in current.values()}
+            result.append({'digest': next(iter(current.values()))[0], 'size': size, 'paths': sorted(current),
+                           'copies': len(inodes), 'wasted_bytes': size * (len(inodes) - 1),
+                           'saved_bytes': size * (len(current) - len(inodes))})
+        result.sort(key=lambda group: (-group['wasted_bytes'], -group['saved_bytes'], group['paths'][0]))
+        with self._lock:
+            hashed = len(self._entries)
+        return {'path': under, 'groups': result[:limit], 'total': len(result), 'hashed_files': hashed,
+                'wasted_bytes': sum(group['wasted_bytes'] for group in result),
+                'saved_bytes': sum(group['saved_bytes'] for group in result)}
+
+def _file_digest(abs_path):
+    digest = hashlib.sha256()
+    view = _transfer_buffer()
+    with open(abs_path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(view)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+dedup = DedupCatalog()
+
+def _find_duplicates_job(jobs, job):
+    # Hashes every group of same-sized files under the job's path, so the
+    # duplicates report covers files that never went through an upload.
+    by_size = {}
+    for root_dir, dir_names, file_names in os.walk(rel_to_abs(job['path'])):
+        if root_dir == UPLOAD_DIR and STATE_DIR_NAME in dir_names:
+            dir_names.remove(STATE_DIR_NAME)
+        for name in file_names:
+            abs_path = os.path.join(root_dir, name)
+            try:
+                st = os.lstat(abs_path)
+            except OSError:
+                continue
+            if st.st_size >= DEDUP_MIN_SIZE and not os.path.islink(abs_path):
+                by_size.setdefault(st.st_size, []).append(abs_to_rel(abs_path))
+        jobs.progress(job)
+    groups = [(size, paths) for size, paths in by_size.items() if len(paths) > 1]
+    jobs.set_totals(job, sum(len(paths) for _, paths in groups), sum(size * len(paths) for size, paths in groups))
+    for size, paths in groups:
+        for rel in paths:
+            dedup.digest_of(rel)
+            jobs.progress(job, 1, size)
+
+JOB_KINDS['find_duplicates'] = _find_duplicates_job
+
+def _update_dedup_catalog(event):
+    # Edits are caught when an entry is next used (its stat no longer
+    # matches); only paths that went away or moved need handling here.
+    if event.old_path is not None:
+        dedup.move(event.old_path, event.path)
+    elif event.action == 'deleted':
+        dedup.forget(event.path, recursive=True)
+
+def _walk_files(abs_dir):
+    # Same result as SearchIndex.files_under, read from the disk.
+    files = {}
+    stack = [(abs_dir, '')]
+    while stack:
+        current_abs, current_rel = stack.pop()
+        try:
+            it = os.scandir(current_abs)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if current_abs == UPLOAD_DIR and entry.name == STATE_DIR_NAME:
+                    continue
+                rel = f"{current_rel}/{entry.name}" if current_rel else entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, rel))
+                    elif entry.is_file():
+                        st = entry.stat()
+                        files[rel] = (st.st_size, st.st_mtime)
+                except OSError:
+                    continue
+    return files
+
+def _manifest_path(path):
+    components = [c for c in str(path).replace('\\', '/').split('/') if c not in ('', '.')]
+    if not components or '..' in components:
+        raise ValueError(f"Invalid path in manifest: {path!r}")
+    return '/'.join(components)
+
+def plan_sync(rel_root, manifest, mode='push', delete=False, fresh=False):
+    # Compares a client's files under rel_root with the server's. manifest
+    # holds {path, size, mtime, hash} objects or [path, size, mtime, hash]
+    # lists; paths are relative to rel_root, hash (SHA-256, optional) is
+    # only used when size matches but mtime doesn't, e.g. after a restore
+    # that lost the timestamps. mode 'push' treats the client as the source,
+    # 'pull' the server, 'both' lets the newer side win and never deletes.
+    if mode not in ('push', 'pull', 'both'):
+        raise ValueError("mode must be 'push', 'pull' or 'both'")
+    indexed = SEARCH_INDEX_ENABLED and search_index.ready and not fresh
+    server_files = search_index.files_under(rel_root) if indexed else _walk_files(rel_to_abs(rel_root))
+    upload, download, delta, conflicts, delete_on_server, delete_on_client = [], [], [], [], [], []
+    unchanged = 0
+    seen = set()
+    for entry in manifest:
+        if isinstance(entry, (list, tuple)):
+            entry = dict(zip(('path', 'size', 'mtime', 'hash'), entry))
+        if not isinstance(entry, dict):
+            raise ValueError("Manifest entries must be objects or lists")
+        path = _manifest_path(entry.get('path', ''))
+        if not rel_root and path.split('/', 1)[0] == STATE_DIR_NAME:
+            raise ValueError(f"Invalid path in manifest: {path!r}")
+        if path in seen:
+            continue
+        seen.add(path)
+        size, mtime = int(entry.get('size', -1)), float(entry.get('mtime', 0))
+        server = server_files.get(path)
+        if server is None:
+            if mode != 'pull':
+                upload.append(path)
+            elif delete:
+                delete_on_client.append(path)
+            continue
+        server_size, server_mtime = server
+        if size == server_size and abs(mtime - server_mtime) <= SYNC_MTIME_TOLERANCE:
+            unchanged += 1
+            continue
+        client_hash = entry.get('hash')
+        if size == server_size and client_hash and DEDUP_ENABLED:
+            if dedup.digest_of(f"{rel_root}/{path}" if rel_root else path) == str(client_hash).lower():
+                unchanged += 1
+                continue
+        if mode == 'both':
+            if mtime > server_mtime + SYNC_MTIME_TOLERANCE:
+                direction = 'upload'
+            elif server_mtime > mtime + SYNC_MTIME_TOLERANCE:
+                direction = 'download'
+            else:
+                conflicts.append({'path': path, 'size': server_size, 'mtime': server_mtime})
+                continue
+        else:
+            direction = 'upload' if mode == 'push' else 'download'
+        if direction == 'upload':
+            upload.append(path)
+            if server_size >= SYNC_DELTA_MIN_SIZE:
+                delta.append(path)
+        else:
+            download.append({'path': path, 'size': server_size, 'mtime': server_mtime})
+    for path, (server_size, server_mtime) in server_files.items():
+        if path in seen:
+            continue
+        if mode != 'push':
+            download.append({'path': path, 'size': server_size, 'mtime': server_mtime})
+        elif delete:
+            delete_on_server.append(path)
+    return {'path': rel_root, 'mode': mode, 'upload': upload, 'delta': delta, 'download': download,
+            'delete_on_server': delete_on_server, 'delete_on_client': delete_on_client, 'conflicts': conflicts,
+            'unchanged': unchanged, 'server_files': len(server_files), 'indexed': indexed}
+
+def file_signature(abs_path, block_size=None):
+    # Per-block checksums of a file for delta uploads, rsync style: the
+    # client slides an Adler-32 window over its copy to find blocks the
+    # server already has, confirms them with the strong hash (first 16 hex
+    # digits of SHA-256) and sends only the rest.
+    size = os.path.getsize(abs_path)
+    if block_size is None:
+        block_size = SYNC_BLOCK_SIZE
+        while size // block_size > 65536:
+            block_size *= 2
+    blocks = []
+    with open(abs_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            blocks.append([zlib.adler32(block), hashlib.sha256(block).hexdigest()[:16]])
+    return {'size': size, 'block_size': block_size, 'blocks': blocks}
+
+def apply_delta(stream, base_path, out_path, limit):
+    # Builds a file from a delta: a series of b'C' + offset + length (both
+    # 8-byte big-endian) records copying a range of the base file, and b'D'
+    # + length + that many bytes of new data. Returns (size, sha256 digest,
+    # bytes copied, bytes sent).
+    def read_exact(n):
+        data = bytearray()
+        while len(data) < n:
+            chunk = stream.read(n - len(data))
+            if not chunk:
+                raise ValueError("Delta ended in the middle of a record")
+            data += chunk
+        return bytes(data)
+    digest = hashlib.sha256()
+    size = copied = sent = 0
+    base_size = os.path.getsize(base_path)
+    with open(base_path, 'rb') as base, open(out_path, 'wb') as out:
+        while True:
+            op = stream.read(1)
+            if not op:
+                break
+            if op == b'C':
+                offset, length = struct.unpack('>QQ', read_exact(16))
+                if offset + length > base_size:
+                    raise ValueError("Delta copies past the end of the file")
+                base.seek(offset)
+                copied += length
+            elif op == b'D':
+                (length,) = struct.unpack('>Q', read_exact(8))
+                sent += length
+            else:
+                raise ValueError(f"Unknown delta record {op!r}")
+            size += length
+            if size > limit:
+                raise ValueError(f"Result is larger than {limit} bytes")
+            source = base if op == b'C' else None
+            while length:
+                chunk = source.read(min(UPLOAD_CHUNK_SIZE, length)) if source else stream.read(min(UPLOAD_CHUNK_SIZE, length))
+                if not chunk:
+                    raise ValueError("Delta ended in the middle of a record")
+                out.write(chunk)
+                digest.update(chunk)
+                length -= len(chunk)
+    return size, digest.hexdigest(), copied, sent
+
+def _save_state_loop():
+    while True:
+        time.sleep(STATE_SAVE_INTERVAL)
+        save_state()
+
+def save_state():
+    if SEARCH_INDEX_ENABLED:
+        try:
+            search_index.save()
+        except OSError as e:
+            log_event('search_index', f"Could not save search index: {e}", level='error')
+    if DISK_USAGE_ENABLED:
+        try:
+            disk_usage.save()
+        except OSError as e:
+            log_event('disk_usage', f"Could not save folder sizes: {e}", level='error')
+    if DEDUP_ENABLED:
+        try:
+            dedup.save()
+        except OSError as e:
+            log_event('dedup', f"Could not save duplicate catalog: {e}", level='error')
+
+# A change to the tree under UPLOAD_DIR. path/old_path are '/'-separated and
+# relative to UPLOAD_DIR. action is 'added', 'modified', 'deleted', 'renamed'
+# or 'rescan' (events were lost; drop anything derived from the tree). An
+# added, deleted or renamed folder stands for its whole subtree. source is
+# 'server' for the server's own operations, 'watcher' for outside changes; the
+# same change can arrive from both, so consumers must be idempotent.
+ChangeEvent = namedtuple('ChangeEvent', 'action path is_dir old_path source')
+
+class ChangeBus:
+    # Consumers run on one dispatcher thread, in publish order, so whoever
+    # publishes (a request handler, the watcher) never waits on them. A
+    # change still queued when another report of it arrives - the server and
+    # the watcher both see an upload, inotify follows the create with a
+    # write - is delivered once.
+
+    def __init__(self, delay=CHANGE_COALESCE_DELAY):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._subscribers = []
+        self._pending = deque()  # (due, event)
+        self._latest = {}  # path -> its last queued event
+        self._busy = False
+        self._thread = None
+        self.delay = delay
+        self.merged = 0
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def _repeats(self, last, event):
+        if last is None:
+            return False
+        if (last.action, last.is_dir, last.old_path) == (event.action, event.is_dir, event.old_path):
+            return True
+        # Consumers stat an added file anyway, so a write behind it adds nothing.
+        return event.action == 'modified' and not event.is_dir and last.action == 'added' and not last.is_dir
+
+    def publish(self, event):
+        with self._lock:
+            if self._repeats(self._latest.get(event.path), event):
+                self.merged += 1
+                return
+            self._pending.append((time.monotonic() + self.delay, event))
+            self._latest[event.path] = event
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch_loop, name="change-dispatch", daemon=True)
+                self._thread.start()
+            self._changed.notify_all()
+
+    def _dispatch_loop(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._changed.wait()
+                due, event = self._pending[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._changed.wait(wait)
+                    continue
+                self._pending.popleft()
+                if self._latest.get(event.path) is event:
+                    del self._latest[event.path]
+                self._busy = True
+                subscribers = list(self._subscribers)
+            for callback in subscribers:
+                try:
+                    callback(event)
+                except Exception as e:
+                    log_event('change_tracking', f"Change consumer {getattr(callback, '__name__', callback)} failed on {event.action} {event.path}: {e}", level='error')
+            with self._lock:
+                self._busy = False
+                self._changed.notify_all()
+
+    def drain(self, timeout=None):
+        # Wait until every change published so far has been handed to the
+        # consumers. Returns False on timeout.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._pending or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+        return True
+
+change_bus = ChangeBus()
+
+def rel_to_abs(rel_path):
+    return os.path.join(UPLOAD_DIR, *rel_path.split('/')) if rel_path else UPLOAD_DIR
+
+def abs_to_rel(abs_path):
+    rel = os.path.relpath(abs_path, UPLOAD_DIR)
+    return '' if rel == '.' else rel.replace(os.sep, '/')
+
+def record_change(action, abs_path, old_abs_path=None, is_dir=None):
+    # Called after the server itself changes the tree ('added', 'modified',
+    # 'deleted' or 'renamed'; 'modified' for a file rewritten in place).
+    if is_dir is None:
+        is_dir = os.path.isdir(abs_path)
+    old_path = abs_to_rel(old_abs_path) if old_abs_path else None
+    event = ChangeEvent(action, abs_to_rel(abs_path), is_dir, old_path, 'server')
+    # Listings are dropped here and now, whatever CHANGE_TRACKING is: the
+    # folder's mtime misses in-place edits, and the page that follows an
+    # upload or rename must not wait for the change bus.
+    _invalidate_listings(event)
+    change_bus.publish(event)
+
+def _invalidate_listings(event):
+    if event.action == 'rescan':
+        listing_cache.invalidate(UPLOAD_DIR, recursive=True)
+        return
+    for rel in (event.path, event.old_path):
+        if rel is None:
+            continue
+        abs_path = rel_to_abs(rel)
+        listing_cache.invalidate(os.path.dirname(abs_path))
+        if event.is_dir and event.action != 'added':
+            listing_cache.invalidate(abs_path, recursive=True)
+
+def _update_search_index(event):
+    if event.action == 'rescan':
+        threading.Thread(target=search_index.rebuild, name="search-index-rebuild", daemon=True).start()
+        return
+    if event.old_path is not None:
+        search_index.remove_path(rel_to_abs(event.old_path))
+    if event.action == 'deleted':
+        search_index.remove_path(rel_to_abs(event.path))
+    elif not (event.action == 'modified' and event.is_dir):
+        search_index.add_path(rel_to_abs(event.path))
+
+def _update_disk_usage(event):
+    if event.action == 'rescan':
+        threading.Thread(target=disk_usage.rebuild, name="disk-usage-rebuild", daemon=True).start()
+        return
+    disk_usage.apply(event)
+
+def _invalidate_watched_listings(event):
+    if event.source != 'server':  # record_change has done the server's own
+        _invalidate_listings(event)
+
+change_bus.subscribe(_invalidate_watched_listings)
+if SEARCH_INDEX_ENABLED:
+    change_bus.subscribe(_update_search_index)
+if DISK_USAGE_ENABLED:
+    change_bus.subscribe(_update_disk_usage)
+if DEDUP_ENABLED:
+    change_bus.subscribe(_update_dedup_catalog)
+
+def listing_entry(rel_path):
+    # One entry in the format of listing_page, read from the disk; None if
+    # it is gone or would not be listed.
+    abs_path = rel_to_abs(rel_path)
+    name = rel_path.rsplit('/', 1)[-1]
+    try:
+        if os.path.isdir(abs_path):
+            totals = disk_usage.totals(rel_path) if DISK_USAGE_ENABLED and disk_usage.ready else None
+            return {'type': 'folder', 'name': name, 'path': rel_path, 'size': totals and totals[0],
+                    'mtime': None, 'files': totals and totals[1]}
+        if os.path.isfile(abs_path):
+            st = os.stat(abs_path)
+            return {'type': 'file', 'name': name, 'path': rel_path, 'size': st.st_size, 'mtime': st.st_mtime}
+    except OSError:
+        pass
+    return None
+
+class ChangeFeed:
+    # The last EVENT_HISTORY_SIZE change events, numbered, for the live
+    # folder streams. Each stream waits here and picks out what concerns its
+    # folder. Ids carry a per-process prefix, so a browser reconnecting with
+    # an id from before a restart (or one too old to replay) is told to reload.
+
+    def __init__(self, size=EVENT_HISTORY_SIZE):
+        self._cond = threading.Condition()
+        self._events = deque(maxlen=size)
+        self.epoch = secrets.token_hex(4)
+        self.last_id = 0
+        self.streams = 0
+
+    def publish(self, event):
+        with self._cond:
+            self.last_id += 1
+            self._events.append((self.last_id, event))
+            self._cond.notify_all()
+
+    def parse_id(self, event_id):
+        # Position to resume after, or None when the events since are lost.
+        epoch, _, number = (event_id or '').partition('-')
+        if epoch != self.epoch or not number.isdigit():
+            return None
+        number = int(number)
+        with self._cond:
+            oldest = self._events[0][0] if self._events else self.last_id + 1
+            if number > self.last_id or number < oldest - 1:
+                return None
+        return number
+
+    def wait(self, after, timeout):
+        with self._cond:
+            self._cond.wait_for(lambda: self.last_id > after, timeout)
+            if self._events and self._events[0][0] > after + 1:
+                return None  # fell out of the history while we were busy
+            return [(number, event) for number, event in self._events if number > after]
+
+    def open_stream(self):
+        with self._cond:
+            if self.streams >= MAX_EVENT_STREAMS:
+                return False
+            self.streams += 1
+            return True
+
+    def close_stream(self):
+        with self._cond:
+            self.streams -= 1
+
+change_feed = ChangeFeed()
+if EVENTS_ENABLED:
+    change_bus.subscribe(change_feed.publish)
+
+def folder_events(rel_dir, events):
+    # What a page showing rel_dir needs to hear about a batch of changes, as
+    # (event name, data) pairs: 'add', 'modify', 'remove' and 'rename' of its
+    # entries ('modify' too for a sub-folder whose size changed), 'gone' when
+    # the folder itself was deleted or moved, 'reload' after a full rescan.
+    # Entries are read once at the end, so a burst of changes to one file
+    # becomes a single message.
+    prefix = rel_dir + '/' if rel_dir else ''
+
+    def child(rel):
+        if rel is None or not rel.startswith(prefix) or rel == rel_dir:
+            return None, False
+        name, _, rest = rel[len(prefix):].partition('/')
+        if not rel_dir and name == STATE_DIR_NAME:
+            return None, False
+        return name, bool(rest)
+
+    ops = []
+    for event in events:
+        if event.action == 'rescan':
+            return [('reload', {})]
+        for gone in (event.path if event.action == 'deleted' else None, event.old_path):
+            if gone is not None and rel_dir and (rel_dir == gone or rel_dir.startswith(gone + '/')):
+                new_path = event.path + rel_dir[len(gone):] if gone == event.old_path else None
+                return [('gone', {'path': rel_dir, 'new_path': new_path})]
+        old_name, old_deep = child(event.old_path)
+        name, deep = child(event.path)
+        if old_name is not None and not old_deep and name is not None and not deep:
+            ops.append(('rename', old_name, name))
+            continue
+        if old_name is not None:
+            ops.append(('modify', old_name) if old_deep else ('remove', old_name))
+        if name is not None:
+            if deep:
+                ops.append(('modify', name))
+            elif event.action == 'deleted':
+                ops.append(('remove', name))
+            else:
+                ops.append(('add' if event.action in ('added', 'renamed') else 'modify', name))
+
+    # Walk backwards keeping only the last change to each name; a rename
+    # whose new name changes again later still has to drop the old name.
+    latest, seen = [], set()
+    for op in reversed(ops):
+        name = op[-1]
+        if op[0] == 'rename':
+            if name not in seen:
+                latest.append(op)
+            elif op[1] not in seen:
+                latest.append(('remove', op[1]))
+            seen.update((op[1], name))
+        elif name not in seen:
+            latest.append(op)
+            seen.add(name)
+
+    messages = []
+    for op in reversed(latest):
+        name = op[-1]
+        if op[0] == 'remove':
+            messages.append(('remove', {'name': name}))
+            continue
+        entry = listing_entry(prefix + name)
+        if op[0] == 'rename':
+            messages.append(('rename', {'old_name': op[1], 'entry': entry}) if entry else ('remove', {'name': op[1]}))
+        elif entry is None:
+            messages.append(('remove', {'name': name}))
+        else:
+            messages.append((op[0], {'entry': entry}))
+    return messages
+
+class InotifyWatcher:
+    # Recursive watch over UPLOAD_DIR using the raw inotify syscalls via ctypes
+    # (Linux/Android). Every folder gets its own watch; new folders are picked
+    # up as they appear.
+
+    IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+    IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+    IN_DELETE_SELF, IN_MOVE_SELF = 0x400, 0x800
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    _HEADER = struct.Struct('iIII')
+
+    def __init__(self, publish):
+        libc_name = ctypes.util.find_library('c')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._publish = publish
+        self._watches = {}
+
+    def _add_watch(self, abs_dir):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(abs_dir), self.WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (28,):  # ENOSPC: fs.inotify.max_user_watches reached
+                raise OSError(err, "Too many watched folders (raise fs.inotify.max_user_watches)")
+            return
+        self._watches[wd] = abs_dir
+
+    def _watch_tree(self, abs_dir):
+        stack = [abs_dir]
+        while stack:
+            current = stack.pop()
+            self._add_watch(current)
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        if current == UPLOAD_DIR and entry.name == STATE_DIR_NAME:
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+            except OSError:
+                continue
+
+    def _unwatch_tree(self, abs_dir):
+        prefix = abs_dir + os.sep
+        for wd, path in list(self._watches.items()):
+            if path == abs_dir or path.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._watches[wd]
+
+    def start(self):
+        self._watch_tree(UPLOAD_DIR)
+        log_event('change_tracking', f"Change tracking: inotify ({len(self._watches)} folders watched)")
+
+    def run(self):
+        while True:
+            data = os.read(self._fd, 256 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, name_len = self._HEADER.unpack_from(data, offset)
+                offset += self._HEADER.size
+                name = os.fsdecode(data[offset:offset + name_len].rstrip(b'\0'))
+                offset += name_len
+                self._handle(wd, mask, name)
+
+    def _handle(self, wd, mask, name):
+        if mask & self.IN_Q_OVERFLOW:
+            self._publish('rescan', UPLOAD_DIR, True)
+            return
+        if mask & self.IN_IGNORED:
+            self._watches.pop(wd, None)
+            return
+        parent = self._watches.get(wd)
+        if parent is None or not name:
+            return
+        if parent == UPLOAD_DIR and name == STATE_DIR_NAME:
+            return
+        abs_path = os.path.join(parent, name)
+        is_dir = bool(mask & self.IN_ISDIR)
+        if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+            if is_dir:
+                try:
+                    self._watch_tree(abs_path)
+                except OSError as e:
+                    log_event('change_tracking', f"Not watching {abs_path}: {e}", level='warning')
+            self._publish('added', abs_path, is_dir)
+        elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+            if is_dir and mask & self.IN_MOVED_FROM:
+                # Watches follow the inode, so drop the ones registered under
+                # the old name; the destination (if inside the tree) re-adds them.
+                self._unwatch_tree(abs_path)
+            self._publish('deleted', abs_path, is_dir)
+        elif mask & self.IN_CLOSE_WRITE:
+            self._publish('modified', abs_path, False)
+
+class PollingWatcher:
+    # Fallback when inotify is unavailable. Remembers every folder's mtime and
+    # entry names; each round stats only the folders, and re-reads just the
+    # ones whose mtime moved. Files inside a re-read folder that were written
+    # since the previous round are reported as modified. (A file rewritten in
+    # place without touching its folder is not noticed.)
+
+    def __init__(self, publish, interval=CHANGE_POLL_INTERVAL):
+        self._publish = publish
+        self._interval = interval
+        self._dirs = {}
+        self._last_round = time.time()
+
+    def _read_dir(self, abs_dir):
+        names = {}
+        try:
+            mtime_ns = os.stat(abs_dir).st_mtime_ns
+            with os.scandir(abs_dir) as it:
+                for entry in it:
+                    if abs_dir == UPLOAD_DIR and entry.name == STATE_DIR_NAME:
+                        continue
+                    try:
+                        names[entry.name] = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        continue
+        except OSError:
+            return None
+        return mtime_ns, names
+
+    def _remember_tree(self, abs_dir):
+        stack = [abs_dir]
+        while stack:
+            current = stack.pop()
+            state = self._read_dir(current)
+            if state is None:
+                continue
+            self._dirs[current] = state
+            stack.extend(os.path.join(current, name) for name, is_dir in state[1].items() if is_dir)
+
+    def _forget_tree(self, abs_dir):
+        prefix = abs_dir + os.sep
+        for key in [k for k in self._dirs if k == abs_dir or k.startswith(prefix)]:
+            del self._dirs[key]
+
+    def start(self):
+        self._remember_tree(UPLOAD_DIR)
+        log_event('change_tracking', f"Change tracking: polling every {self._interval}s ({len(self._dirs)} folders)")
+
+    def poll(self):
+        round_started = time.time()
+        for abs_dir in list(self._dirs):
+            known = self._dirs.get(abs_dir)
+            if known is None:
+                continue
+            try:
+                mtime_ns = os.stat(abs_dir).st_mtime_ns
+            except OSError:
+                continue  # its parent reports the removal
+            if mtime_ns == known[0]:
+                continue
+            fresh = self._read_dir(abs_dir)
+            if fresh is None:
+                continue
+            self._dirs[abs_dir] = fresh
+            old_names, new_names = known[1], fresh[1]
+            for name, is_dir in old_names.items():
+                if name not in new_names or new_names[name] != is_dir:
+                    path = os.path.join(abs_dir, name)
+                    if is_dir:
+                        self._forget_tree(path)
+                    self._publish('deleted', path, is_dir)
+            for name, is_dir in new_names.items():
+                path = os.path.join(abs_dir, name)
+                if name not in old_names or old_names[name] != is_dir:
+                    if is_dir:
+                        self._remember_tree(path)
+                    self._publish('added', path, is_dir)
+                elif not is_dir:
+                    try:
+                        if os.stat(path).st_mtime >= self._last_round:
+                            self._publish('modified', path, False)
+                    except OSError:
+                        pass
+        self._last_round = round_started
+
+    def run(self):
+        while True:
+            time.sleep(self._interval)
+            self.poll()
+
+def _publish_watcher_event(action, abs_path, is_dir):
+    change_bus.publish(ChangeEvent(action, abs_to_rel(abs_path), is_dir, None, 'watcher'))
+
+def start_change_tracking():
+    if CHANGE_TRACKING == 'off':
+        return None
+
+    def run_watcher():
+        watcher = None
+        if CHANGE_TRACKING in ('auto', 'inotify'):
+            try:
+                watcher = InotifyWatcher(_publish_watcher_event)
+                watcher.start()
+            except (OSError, AttributeError) as e:
+                # AttributeError: libc without inotify symbols (not Linux).
+                log_event('change_tracking', f"Change tracking: inotify unavailable ({e}), falling back to polling", level='warning')
+                watcher = None
+        if watcher is None:
+            watcher = PollingWatcher(_publish_watcher_event)
+            watcher.start()
+        try:
+            watcher.run()
+        except Exception as e:
+            log_event('change_tracking', f"Change tracking stopped: {e}", level='error')
+
+    thread = threading.Thread(target=run_watcher, name="change-tracker", daemon=True)
+    thread.start()
+    return thread
+
+class CompressedVariantCache:
+    # Compressed copies of text files, stored under .drive/compressed and keyed
+    # by the file's ETag plus encoding (so an edited file simply misses). A file
+    # is cached once it has been requested COMPRESSED_CACHE_MIN_HITS times;
+    # the oldest variants are evicted past COMPRESSED_CACHE_MAX_BYTES.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hits = {}
+        self._total_bytes = None
+
+    def _path(self, variant_etag):
+        name = hashlib.sha1(variant_etag.encode('utf-8')).hexdigest()
+        return os.path.join(state_dir('compressed'), name)
+
+    def lookup(self, variant_etag):
+        path = self._path(variant_etag)
+        try:
+            os.utime(path)
+            return path
+        except OSError:
+            return None
+
+    def should_store(self, variant_etag, file_size):
+        if file_size > COMPRESSED_CACHE_MAX_FILE_SIZE:
+            return False
+        with self._lock:
+            if len(self._hits) > 10000:
+                self._hits.clear()
+            self._hits[variant_etag] = self._hits.get(variant_etag, 0) + 1
+            return self._hits[variant_etag] >= COMPRESSED_CACHE_MIN_HITS
+
+    def open_writer(self, variant_etag):
+        path = self._path(variant_etag)
+        return path, open(f"{path}.{threading.get_ident()}.tmp", 'wb')
+
+    def commit(self, path, writer):
+        writer.close()
+        size = os.path.getsize(writer.name)
+        os.replace(writer.name, path)
+        with self._lock:
+            self._hits.clear()
+            if self._total_bytes is None:
+                self._total_bytes = sum(e.stat().st_size for e in os.scandir(os.path.dirname(path)) if e.is_file())
+            else:
+                self._total_bytes += size
+            if self._total_bytes <= COMPRESSED_CACHE_MAX_BYTES:
+                return
+            entries = sorted((e for e in os.scandir(os.path.dirname(path)) if e.is_file() and not e.name.endswith('.tmp')),
+                             key=lambda e: e.stat().st_mtime)
+            for entry in entries:
+                if self._total_bytes <= COMPRESSED_CACHE_MAX_BYTES * 0.9:
+                    break
+                try:
+                    size = entry.stat().st_size
+                    os.remove(entry.path)
+                    self._total_bytes -= size
+                except OSError:
+                    continue
+
+    def discard(self, writer):
+        writer.close()
+        try: os.remove(writer.name)
+        except OSError: pass
+
+compressed_cache = CompressedVariantCache()
+
+def _render_thumbnail(kind, source_path, dest_path, size, quality, ffmpeg):
+    # Runs in a thumbnail worker process. Writes a JPEG no larger than
+    # size x size to dest_path and returns its length.
+    temp_path = f"{dest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        if kind == 'video':
+            scale = f"scale='min({size},iw)':'min({size},ih)':force_original_aspect_ratio=decrease"
+            for seek in ('1', '0'):  # clips shorter than a second have no frame at 1s
+                subprocess.run([ffmpeg, '-v', 'error', '-nostdin', '-y', '-ss', seek, '-i', source_path, '-frames:v', '1',
+                                '-vf', scale, '-q:v', '4', '-f', 'image2', '-c:v', 'mjpeg', temp_path],
+                               stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=THUMBNAIL_TIMEOUT)
+                if os.path.exists(temp_path) and os.path.getsize(temp_path):
+                    break
+            else:
+                raise ValueError("ffmpeg produced no frame")
+        else:
+            with Image.open(source_path) as image:
+                # JPEG decoders can scale down by up to 8x while decoding.
+                image.draft('RGB', (size, size))
+                image = ImageOps.exif_transpose(image)
+                image.thumbnail((size, size))
+                if image.mode in ('RGBA', 'LA', 'P'):
+                    image = image.convert('RGBA')
+                    background = Image.new('RGB', image.size, (255, 255, 255))
+                    background.paste(image, mask=image.getchannel('A'))
+                    image = background
+                elif image.mode != 'RGB':
+                    image = image.convert('RGB')
+                image.save(temp_path, 'JPEG', quality=quality, optimize=True)
+        length = os.path.getsize(temp_path)
+        os.replace(temp_path, dest_path)
+        return length
+    finally:
+        try: os.remove(temp_path)
+        except OSError: pass
+
+class ThumbnailService:
+    # Small JPEG previews for photos and videos. They are rendered on a pool
+    # of worker processes (decoding is CPU-bound and would otherwise stall
+    # request threads on the GIL) and kept under .drive/thumbnails, keyed by
+    # the source's ETag and the thumbnail size, so an edited file simply
+    # misses. Concurrent requests for the same thumbnail share one render;
+    # files that fail to render are remembered and not retried. The least
+    # recently used thumbnails are evicted past THUMBNAIL_CACHE_MAX_BYTES.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pending = {}
+        self._failed = set()
+        self._total_bytes = None
+        self._ffmpeg = None
+        self.hits = 0
+        self.generated = 0
+        self.failures = 0
+
+    def kind(self, path):
+        return self._kind_for_extension(os.path.splitext(path)[1].lower())
+
+    def _kind_for_extension(self, ext):
+        if ext in THUMBNAIL_IMAGE_EXTENSIONS and Image is not None:
+            return 'image'
+        if ext in THUMBNAIL_VIDEO_EXTENSIONS and self._find_ffmpeg():
+            return 'video'
+        return None
+
+    def extensions(self):
+        if not THUMBNAILS_ENABLED:
+            return []
+        return [ext for ext in THUMBNAIL_IMAGE_EXTENSIONS + THUMBNAIL_VIDEO_EXTENSIONS if self._kind_for_extension(ext)]
+
+    def _find_ffmpeg(self):
+        if self._ffmpeg is None:
+            self._ffmpeg = shutil.which(FFMPEG_PATH) or ''
+        return self._ffmpeg
+
+    def key(self, st):
+        return hashlib.sha1(f"{file_etag(st)}-{THUMBNAIL_SIZE}-{THUMBNAIL_QUALITY}".encode('ascii')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(state_dir('thumbnails'), key + '.jpg')
+
+    def _executor(self):
+        if self._pool is None:
+            try:
+                # spawn, not fork: this process is full of threads and locks.
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    THUMBNAIL_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            except (ImportError, OSError, NotImplementedError) as e:
+                # e.g. Android, which has no working sem_open. Pillow releases
+                # the GIL while decoding, so threads still help.
+                log_event('thumbnails', f"Process pool unavailable ({e}), rendering thumbnails on threads", level='warning')
+                self._pool = concurrent.futures.ThreadPoolExecutor(THUMBNAIL_WORKERS, thread_name_prefix='thumbnail')
+        return self._pool
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path)
+        return data
+
+    def get(self, abs_path, st, kind):
+        # JPEG bytes of the thumbnail, rendering it first if needed; None if
+        # the file cannot be thumbnailed.
+        key = self.key(st)
+        path = self._path(key)
+        try:
+            data = self._read(path)
+            self.hits += 1
+            return data
+        except OSError:
+            pass
+        with self._lock:
+            if key in self._failed:
+                return None
+            pending = self._pending.get(key)
+            if pending is None:
+                pool = self._executor()
+                pending = self._pending[key] = (pool.submit(_render_thumbnail, kind, abs_path, path, THUMBNAIL_SIZE,
+                                                            THUMBNAIL_QUALITY, self._find_ffmpeg()), pool)
+        future, pool = pending
+        try:
+            length = future.result(timeout=THUMBNAIL_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            # Still rendering, or queued behind a folder's worth of others.
+            # Not a failure: the render carries on and is accounted for when
+            # it lands, and the next request finds it on disk.
+            future.add_done_callback(lambda done: self._settle(key, done, pool, abs_path))
+            return None
+        except Exception:
+            self._settle(key, future, pool, abs_path)
+            return None
+        try:
+            data = self._read(path)
+        except OSError:
+            return None
+        self._settle(key, future, pool, abs_path)
+        return data
+
+    def _settle(self, key, future, pool, abs_path):
+        # Books a finished render once, however many requests waited for it.
+        with self._lock:
+            if self._pending.pop(key, None) is None or future.cancelled():
+                return
+            error = future.exception()
+            if error is None:
+                self.generated += 1
+                self._account(future.result())
+            elif isinstance(error, BrokenProcessPool):
+                if self._pool is pool:
+                    self._pool = None  # a worker died (out of memory?); start a fresh pool next time
+            else:
+                self.failures += 1
+                if len(self._failed) > 10000:
+                    self._failed.clear()
+                self._failed.add(key)
+                log_event('thumbnails', f"No thumbnail for {abs_to_rel(abs_path)}: {error}", level='warning', path=abs_to_rel(abs_path))
+
+    def _account(self, length):
+        base = state_dir('thumbnails')
+        if self._total_bytes is None:
+            self._total_bytes = sum(e.stat().st_size for e in os.scandir(base) if e.is_file())
+        else:
+            self._total_bytes += length
+        if self._total_bytes <= THUMBNAIL_CACHE_MAX_BYTES:
+            return
+        entries = sorted((e for e in os.scandir(base) if e.is_file() and not e.name.endswith('.tmp')),
+                         key=lambda e: e.stat().st_mtime)
+        for entry in entries:
+            if self._total_bytes <= THUMBNAIL_CACHE_MAX_BYTES * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self._total_bytes -= size
+            except OSError:
+                continue
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+
+thumbnails = ThumbnailService()
+
+def zip_members(abs_paths):
+    # Yields (abs_path, arcname, is_dir) for everything under the selected
+    # paths. Each selection is stored under its own name; symlinked folders
+    # are not followed.
+    used = set()
+    for abs_path in abs_paths:
+        top = os.path.basename(abs_path.rstrip(os.sep)) or 'Drive'
+        name, n = top, 1
+        while name in used:
+            n += 1
+            stem, ext = os.path.splitext(top)
+            name = f"{stem} ({n}){ext}"
+        used.add(name)
+        if not os.path.isdir(abs_path):
+            yield abs_path, name, False
+            continue
+        yield abs_path, name + '/', True
+        for root_dir, dir_names, file_names in os.walk(abs_path):
+            if root_dir == UPLOAD_DIR and STATE_DIR_NAME in dir_names:
+                dir_names.remove(STATE_DIR_NAME)
+            dir_names.sort()
+            rel_root = os.path.relpath(root_dir, abs_path)
+            prefix = name if rel_root == '.' else f"{name}/{rel_root.replace(os.sep, '/')}"
+            for dir_name in dir_names:
+                yield os.path.join(root_dir, dir_name), f"{prefix}/{dir_name}/", True
+            for file_name in sorted(file_names):
+                yield os.path.join(root_dir, file_name), f"{prefix}/{file_name}", False
+
+def write_zip_stream(out, abs_paths):
+    # Streams a ZIP archive to a non-seekable file object. zipfile then uses
+    # data descriptors, and switches to ZIP64 records per entry and for the
+    # central directory when sizes, offsets or counts need it. Media is
+    # stored as-is; text-like files are deflated.
+    written = 0
+    with zipfile.ZipFile(out, 'w', allowZip64=True) as archive:
+        for abs_path, arcname, is_dir in zip_members(abs_paths):
+            try:
+                info = zipfile.ZipInfo.from_file(abs_path, arcname, strict_timestamps=False)
+            except OSError as e:
+                log_event('zip', f"ZIP: skipping {abs_path}: {e}", level='warning')
+                continue
+            if is_dir:
+                archive.writestr(info, b'')
+                continue
+            content_type = mimetypes.guess_type(abs_path)[0] or 'application/octet-stream'
+            if is_compressible(content_type, abs_path):
+                info.compress_type = zipfile.ZIP_DEFLATED
+            else:
+                info.compress_type = zipfile.ZIP_STORED
+            try:
+                src = open(abs_path, 'rb', buffering=0)
+            except OSError as e:
+                log_event('zip', f"ZIP: skipping {abs_path}: {e}", level='warning')
+                continue
+            view = _transfer_buffer()
+            with src, archive.open(info, 'w', force_zip64=info.file_size > 0x7FFFFFFF) as dest:
+                while True:
+                    n = src.readinto(view)
+                    if not n:
+                        break
+                    dest.write(view[:n])
+            written += 1
+    return written
+
+_thread_buffers = threading.local()
+
+def _transfer_buffer():
+    # One reusable buffer per worker thread for the non-sendfile copy path.
+    view = getattr(_thread_buffers, 'view', None)
+    if view is None:
+        view = _thread_buffers.view = memoryview(bytearray(TRANSFER_BUFFER_SIZE))
+    return view
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(**labels):
+    return ','.join(f'{k}="{v}"' for k, v in labels.items())
+
+
+class Metrics:
+    # In-process counters for /_api/metrics. Recording a request is a few dict
+    # updates under one lock; the text format is only built when scraped.
+
+    METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}        # (route, method, status) -> count
+        self.durations = {}       # route -> Histogram
+        self.listing_phases = {}  # 'stat' | 'render' | 'write' -> Histogram
+        self.bytes_in = {}        # route -> request body bytes
+        self.bytes_out = {}       # route -> response bytes, headers included
+        self.open_connections = 0
+        self.in_flight = 0
+        self.transfers = {}       # kind -> transfers in progress
+
+    def connection_opened(self, delta=1):
+        with self._lock:
+            self.open_connections += delta
+
+    def connection_closed(self):
+        self.connection_opened(-1)
+
+    def request_started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def request_finished(self, route, method, status, seconds, bytes_in, bytes_out):
+        if method not in self.METHODS:
+            method = 'other'
+        key = (route, method, status)
+        with self._lock:
+            self.in_flight -= 1
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.durations.get(route)
+            if histogram is None:
+                histogram = self.durations[route] = Histogram()
+            histogram.observe(seconds)
+            self.bytes_in[route] = self.bytes_in.get(route, 0) + bytes_in
+            self.bytes_out[route] = self.bytes_out.get(route, 0) + bytes_out
+
+    def listing_phase(self, phase, seconds):
+        with self._lock:
+            histogram = self.listing_phases.get(phase)
+            if histogram is None:
+                histogram = self.listing_phases[phase] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def transfer(self, kind):
+        with self._lock:
+            self.transfers[kind] = self.transfers.get(kind, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.transfers[kind] -= 1
+
+    def render(self, samples=()):
+        # samples: extra (name, type, help, value) taken at scrape time.
+        out = []
+
+        def family(name, kind, help_text):
+            out.append(f'# HELP {name} {help_text}')
+            out.append(f'# TYPE {name} {kind}')
+
+        def histogram(name, label, histograms):
+            for key, h in sorted(histograms.items()):
+                cumulative = 0
+                for bound, n in zip(h.buckets, h.counts):
+                    cumulative += n
+                    out.append(f'{name}_bucket{{{label}="{key}",le="{bound}"}} {cumulative}')
+                out.append(f'{name}_bucket{{{label}="{key}",le="+Inf"}} {h.count}')
+                out.append(f'{name}_sum{{{label}="{key}"}} {h.sum:.6f}')
+                out.append(f'{name}_count{{{label}="{key}"}} {h.count}')
+
+        with self._lock:
+            family('drive_requests_total', 'counter', 'Requests handled, by route, method and status.')
+            for (route, method, status), n in sorted(self.requests.items()):
+                out.append(f'drive_requests_total{{{_labels(route=route, method=method, status=status)}}} {n}')
+            family('drive_request_duration_seconds', 'histogram', 'Time from request line to last byte written, by route.')
+            histogram('drive_request_duration_seconds', 'route', self.durations)
+            family('drive_listing_phase_seconds', 'histogram', 'Folder page time spent reading the folder (stat), building HTML (render) and sending it (write).')
+            histogram('drive_listing_phase_seconds', 'phase', self.listing_phases)
+            family('drive_received_bytes_total', 'counter', 'Request body bytes read, by route.')
+            for route, n in sorted(self.bytes_in.items()):
+                out.append(f'drive_received_bytes_total{{route="{route}"}} {n}')
+            family('drive_sent_bytes_total', 'counter', 'Response bytes written, by route.')
+            for route, n in sorted(self.bytes_out.items()):
+                out.append(f'drive_sent_bytes_total{{route="{route}"}} {n}')
+            family('drive_transfers_in_flight', 'gauge', 'Downloads, uploads and archives currently streaming.')
+            for kind, n in sorted(self.transfers.items()):
+                out.append(f'drive_transfers_in_flight{{kind="{kind}"}} {n}')
+            samples = [
+                ('drive_open_connections', 'gauge', 'Client connections currently open.', self.open_connections),
+                ('drive_requests_in_flight', 'gauge', 'Requests currently being handled.', self.in_flight),
+                ('drive_start_time_seconds', 'gauge', 'Unix time the server started.', self.started),
+            ] + list(samples)
+        for name, kind, help_text, value in samples:
+            family(name, kind, help_text)
+            out.append(f'{name} {value}')
+        return '\n'.join(out) + '\n'
+
+metrics = Metrics()
+
+
+class CountingWriter:
+    # Wraps the connection's wfile to count bytes sent; sendfile() bypasses
+    # it and adds to bytes_written itself.
+
+    def __init__(self, wfile):
+        self._wfile = wfile
+        self.bytes_written = 0
+
+    def write(self, data):
+        n = self._wfile.write(data)
+        self.bytes_written += len(data)
+        return n
+
+    def flush(self):
+        self._wfile.flush()
+
+    def close(self):
+        self._wfile.close()
+
+    @property
+    def closed(self):
+        return self._wfile.closed
+
+
+class _Bucket:
+    __slots__ = ('rate', 'tat')
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tat = 0.0  # theoretical arrival time of the next byte
+
+
+class BandwidthScheduler:
+    # Token buckets in GCRA form: one shared by everybody and one per client.
+    # A bulk stream reserves a slot for each chunk and sleeps until it comes
+    # up. Slots are handed out in call order, so concurrent streams take turns
+    # chunk by chunk and share the rate evenly. Interactive responses (pages,
+    # API calls, small files) are charged to the same buckets but never wait,
+    # which pushes the bulk streams back instead.
+
+    MAX_INTERACTIVE_DEBT = 1.0  # seconds of rate interactive traffic may borrow
+    CLIENT_IDLE_TIMEOUT = 60
+
+    def __init__(self, global_rate=BANDWIDTH_LIMIT, client_rate=CLIENT_BANDWIDTH_LIMIT, burst_seconds=BANDWIDTH_BURST_SECONDS):
+        self._lock = threading.Lock()
+        self._global = _Bucket(global_rate) if global_rate > 0 else None
+        self._client_rate = client_rate
+        self._clients = {}
+        self._burst = burst_seconds
+        self._last_sweep = time.monotonic()
+        self.waited = 0.0
+
+    @property
+    def enabled(self):
+        return self._global is not None or self._client_rate > 0
+
+    def consume(self, client, nbytes, bulk=True):
+        wait = 0.0
+        with self._lock:
+            now = time.monotonic()
+            buckets = [self._global] if self._global is not None else []
+            if self._client_rate > 0:
+                if now - self._last_sweep > self.CLIENT_IDLE_TIMEOUT:
+                    self._sweep(now)
+                bucket = self._clients.get(client)
+                if bucket is None:
+                    bucket = self._clients[client] = _Bucket(self._client_rate)
+                buckets.append(bucket)
+            for bucket in buckets:
+                tat = max(bucket.tat, now) + nbytes / bucket.rate
+                if not bulk:
+                    tat = min(tat, now + self.MAX_INTERACTIVE_DEBT)
+                bucket.tat = tat
+                wait = max(wait, tat - self._burst - now)
+            if bulk and wait > 0:
+                self.waited += wait
+        if bulk and wait > 0:
+            time.sleep(wait)
+
+    def _sweep(self, now):
+        self._last_sweep = now
+        for client in [c for c, b in self._clients.items() if b.tat < now - self.CLIENT_IDLE_TIMEOUT]:
+            del self._clients[client]
+
+bandwidth = BandwidthScheduler()
+
+
+class RequestBody:
+    # The request body as announced by Content-Length. Reads never run past it
+    # into the next request on the connection, and whatever a handler leaves
+    # unread is either skipped afterwards or the connection is closed.
+
+    def __init__(self, rfile, length, throttle=None):
+        self._rfile = rfile
+        self.length = length
+        self.remaining = length
+        self._throttle = throttle
+
+    def _take(self, reader, size):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return b''
+        if self._throttle is not None:
+            size = min(size, THROTTLE_CHUNK_SIZE)
+        data = reader(size)
+        self.remaining -= len(data)
+        if self._throttle is not None and data:
+            self._throttle(len(data))
+        return data
+
+    def read(self, size=-1):
+        return self._take(self._rfile.read, size)
+
+    def read1(self, size=-1):
+        return self._take(self._rfile.read1, size)
+
+    def discard(self, limit):
+        if self.remaining > limit:
+            return False
+        while self.remaining:
+            if not self.read1(UPLOAD_CHUNK_SIZE):
+                return False
+        return True
+
+
+class StreamWriter:
+    # Body of unknown length. HTTP/1.1 clients get chunked framing so the
+    # connection stays usable; HTTP/1.0 clients read until the connection
+    # closes. Small writes (zip headers) are coalesced into larger chunks.
+
+    def __init__(self, wfile, chunked, buffer_size=64 * 1024, throttle=None):
+        self._wfile = wfile
+        self._chunked = chunked
+        self._buffer = bytearray()
+        self._buffer_size = buffer_size
+        self._throttle = throttle
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self._buffer_size:
+            self._emit()
+        return len(data)
+
+    def _emit(self):
+        if not self._buffer:
+            return
+        if self._throttle is not None:
+            self._throttle(len(self._buffer))
+        if self._chunked:
+            self._wfile.write(b'%x\r\n' % len(self._buffer))
+            self._buffer += b'\r\n'
+        self._wfile.write(self._buffer)
+        self._buffer = bytearray()
+
+    def flush(self):
+        self._emit()
+        self._wfile.flush()
+
+    def close(self):
+        self._emit()
+        if self._chunked:
+            self._wfile.write(b'0\r\n\r\n')
+        self._wfile.flush()
+
+
+class _DiscardWriter:
+    # Stands in for wfile once the headers of a HEAD response are out.
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class PooledHTTPServer(HTTPServer):
+    # Accepted connections are handed to a fixed set of worker threads through a
+    # bounded queue. When every worker is busy and the queue is full, new clients
+    # get a 503 straight away instead of piling up behind a long transfer.
+
+    def __init__(self, server_address, handler_class, max_workers=MAX_WORKERS, queue_size=REQUEST_QUEUE_SIZE):
+        self.request_queue_size = max(queue_size, 5)
+        self.max_workers = max(1, max_workers)
+        self._pending = queue.Queue(maxsize=max(1, queue_size))
+        self._workers = []
+        self._active_lock = threading.Lock()
+        self.active_connections = 0
+        self.stopping = threading.Event()
+        super().__init__(server_address, handler_class)
+        for i in range(self.max_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"drive-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def process_request(self, request, client_address):
+        try:
+            self._pending.put_nowait((request, client_address))
+        except queue.Full:
+            self._reject_busy(request, client_address)
+
+    def waiting_connections(self):
+        return self._pending.qsize()
+
+    def clients_waiting(self):
+        # Someone is queued and no worker is free to take them.
+        return self.active_connections >= self.max_workers and not self._pending.empty()
+
+    def _reject_busy(self, request, client_address):
+        log_event('busy', f"Server busy: rejecting connection from {client_address[0]} (all {self.max_workers} workers in use)",
+                  level='warning', client=client_address[0])
+        try:
+            request.sendall(b"HTTP/1.0 503 Service Unavailable\r\n"
+                            b"Retry-After: 5\r\n"
+                            b"Content-Length: 0\r\n"
+                            b"Connection: close\r\n\r\n")
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _worker_loop(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            request, client_address = item
+            with self._active_lock:
+                self.active_connections += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._active_lock:
+                    self.active_connections -= 1
+
+    def server_close(self):
+        # Stop accepting, then let queued and in-flight requests finish before
+        # the workers exit. Anything still running after the timeout is abandoned.
+        self.stopping.set()
+        super().server_close()
+        deadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT
+        for _ in self._workers:
+            try:
+                self._pending.put(None, timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for worker in self._workers:
+            worker.join(max(0, deadline - time.monotonic()))
+        still_running = sum(1 for w in self._workers if w.is_alive())
+        if still_running:
+            log_event('shutdown', f"{still_running} transfer(s) still running after {SHUTDOWN_DRAIN_TIMEOUT}s, abandoning them.", level='warning')
+
+
+class DrainingThreadingHTTPServer(ThreadingHTTPServer):
+    # One thread per connection; server_close() waits for them to finish.
+    daemon_threads = False
+    block_on_close = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+    def __init__(self, *args, **kwargs):
+        self.stopping = threading.Event()  # tells idle keep-alives and event streams to let go
+        super().__init__(*args, **kwargs)
+
+    def server_close(self):
+        self.stopping.set()
+        super().server_close()
+
+
+LISTING_STYLE = """
+body {
+    font-family: system-ui, -apple-system, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif;
+    background-color: #f1f3f4;
+    margin: 0;
+    padding: 20px;
+    color: #333;
+}
+h1 {
+    color: #202124;
+    border-bottom: 1px solid #ddd;
+    padding-bottom: 10px;
+    margin-top: 0;
+    margin-bottom: 15px;
+    font-weight: 600;
+}
+.container {
+    background-color: white;
+    padding: 20px 30px;
+    border-radius: 10px;
+    box-shadow: 0 2px 10px rgba(0,0,0,0.1);
+    max-width: 1200px;
+    margin: auto;
+}
+a {
+    color: #1a73e8;
+    text-decoration: none;
+}
+a:hover {
+    text-decoration: underline;
+}
+.breadcrumbs {
+    margin-bottom: 20px;
+    font-size: 14px;
+    color: #5f6368;
+    word-wrap: break-word;
+}
+.breadcrumbs a {
+    color: #1a73e8;
+}
+.breadcrumbs .current-crumb {
+    font-weight: 600;
+    color: #202124;
+}
+.upload-section, .search-section {
+    margin-bottom: 25px;
+    padding: 15px;
+    background-color: #e8f0fe;
+    border-radius: 8px;
+}
+.search-section {
+    background-color: #f8f9fa;
+}
+.upload-btn {
+    background: #1a73e8;
+    color: white;
+    border: none;
+    padding: 10px 20px;
+    border-radius: 20px;
+    cursor: pointer;
+    font-size: 14px;
+    font-weight: 600;
+    transition: background-color 0.2s ease;
+}
+.upload-btn:hover {
+    background: #1558b0;
+}
+#upload-status {
+    margin-left: 10px;
+    font-style: italic;
+    color: #1a73e8;
+    font-size: 13px;
+}
+#search-input {
+    padding: 10px 15px;
+    font-size: 14px;
+    border-radius: 20px;
+    border: 1px solid #ccc;
+    width: 300px;
+    max-width: 90%;
+    box-sizing: border-box;
+}
+.zip-actions {
+    margin-top: 10px;
+    font-size: 13px;
+}
+.zip-actions .upload-btn {
+    margin-left: 10px;
+}
+.select-box {
+    position: absolute;
+    top: 8px;
+    left: 8px;
+    z-index: 2;
+    cursor: pointer;
+}
+.search-scope {
+    font-size: 13px;
+    color: #5f6368;
+    margin-left: 8px;
+    white-space: nowrap;
+}
+#sort-select {
+    padding: 9px 12px;
+    font-size: 14px;
+    border-radius: 20px;
+    border: 1px solid #ccc;
+    margin-left: 8px;
+    background: white;
+    font-family: inherit;
+}
+#search-input:focus {
+    outline: none;
+    border-color: #1a73e8;
+    box-shadow: 0 0 0 2px rgba(26, 115, 232, 0.2);
+}
+.item-grid {
+    position: relative;
+    margin-top: 20px;
+    padding-top: 10px;
+}
+#empty-folder {
+    display: none;
+    color: #5f6368;
+    font-style: italic;
+    padding: 20px 0;
+}
+.item {
+    position: absolute;
+    width: 170px;
+    height: 190px;
+    padding: 10px 15px 15px 15px;
+    border-radius: 8px;
+    background: #fff;
+    border: 1px solid #dadce0;
+    text-align: center;
+    font-size: 13px;
+    overflow: visible;
+    transition: box-shadow 0.2s ease-in-out, opacity 0.3s ease, transform 0.3s ease;
+    word-wrap: break-word;
+    display: flex;
+    flex-direction: column;
+    box-sizing: border-box;
+}
+.item:hover {
+    box-shadow: 0 4px 8px rgba(0,0,0,0.15);
+    transform: translateY(-2px);
+}
+.item.placeholder {
+    background: #f8f9fa;
+    border-style: dashed;
+}
+.item-link {
+    text-decoration: none;
+    color: #1a0dab;
+    font-weight: 600;
+    display: block;
+    flex-grow: 1;
+    margin-bottom: 5px;
+}
+.item img, .item svg.icon {
+    width: 60px;
+    height: 60px;
+    object-fit: contain;
+    margin-bottom: 10px;
+    margin-top: 5px;
+}
+.item img.thumb {
+    width: 120px;
+    height: 80px;
+    object-fit: cover;
+    border-radius: 4px;
+    margin-top: 0;
+}
+.item-name {
+    height: 40px;
+    overflow: hidden;
+    line-height: 1.4;
+    word-break: break-all;
+}
+.meta {
+    font-size: 11px;
+    color: #5f6368;
+    margin-top: auto;
+    padding-top: 5px;
+}
+.item-actions {
+    position: absolute;
+    top: 5px;
+    right: 5px;
+    z-index: 11;
+}
+.three-dots-btn {
+    background: none;
+    border: none;
+    font-size: 20px;
+    line-height: 1;
+    font-weight: bold;
+    padding: 5px;
+    cursor: pointer;
+    color: #5f6368;
+    border-radius: 50%;
+    transition: background-color 0.2s ease;
+}
+.three-dots-btn:hover {
+    background-color: #eee;
+}
+.action-menu {
+    display: none;
+    position: absolute;
+    right: 0;
+    top: 100%;
+    background-color: white;
+    min-width: 120px;
+    box-shadow: 0px 8px 16px 0px rgba(0,0,0,0.2);
+    z-index: 10;
+    border-radius: 4px;
+    overflow: hidden;
+    padding: 5px 0;
+}
+.action-menu.show {
+    display: block;
+}
+.action-menu-item {
+    font-family: system-ui, -apple-system, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif;
+    font-size: 13px;
+    color: #333;
+    padding: 8px 16px;
+    text-decoration: none;
+    display: block;
+    cursor: pointer;
+    background: none;
+    border: none;
+    width: 100%;
+    text-align: left;
+    box-sizing: border-box;
+    white-space: nowrap;
+}
+.action-menu-item:hover {
+    background-color: #f1f1f1;
+}
+.action-menu-item.delete {
+    color: #d93025;
+    font-weight: 600;
+}
+.rename-form {
+    display: none;
+    padding: 10px 5px 5px 5px;
+    border-top: 1px solid #eee;
+    margin-top: 10px;
+}
+.rename-form input[type=text] {
+    width: calc(100% - 12px);
+    padding: 6px;
+    margin-bottom: 8px;
+    font-size: 12px;
+    border: 1px solid #ccc;
+    border-radius: 3px;
+    box-sizing: border-box;
+}
+.rename-form button {
+    font-size: 11px;
+    padding: 5px 10px;
+    border-radius: 15px;
+    cursor: pointer;
+    border: none;
+    margin-right: 5px;
+    font-weight: 600;
+    transition: background-color 0.2s ease, filter 0.2s ease;
+}
+.rename-form .save-btn {
+    background-color: #1a73e8;
+    color: white;
+}
+.rename-form .cancel-btn {
+    background-color: #eee;
+    color: #333;
+}
+.rename-form .save-btn:hover { filter: brightness(90%); }
+.rename-form .cancel-btn:hover { filter: brightness(95%); }
+"""
+
+LISTING_SCRIPT = r"""
+function toggleMenu(menuId) {
+    var targetMenu = document.getElementById(menuId);
+    if (!targetMenu) return;
+    var currentlyShown = targetMenu.classList.contains('show');
+    var menus = document.getElementsByClassName('action-menu');
+    for (var i = 0; i < menus.length; i++) {
+        menus[i].classList.remove('show');
+    }
+    if (!currentlyShown) {
+        targetMenu.classList.add('show');
+    }
+}
+window.onclick = function(event) {
+    if (!event.target.matches('.three-dots-btn')) {
+        var menus = document.getElementsByClassName("action-menu");
+        for (var i = 0; i < menus.length; i++) {
+            var openMenu = menus[i];
+            if (openMenu.classList.contains('show')) {
+                var parentItemActions = openMenu.closest('.item-actions');
+                if (!parentItemActions || !parentItemActions.contains(event.target)) {
+                     openMenu.classList.remove('show');
+                }
+            }
+        }
+    }
+}
+function showRenameForm(itemId, currentName) {
+    var displayDiv = document.getElementById('item-display-' + itemId);
+    var formDiv = document.getElementById('rename-form-' + itemId);
+    var input = document.getElementById('rename-input-' + itemId);
+    if (!displayDiv || !formDiv || !input) return;
+    var menu = document.getElementById('menu-' + itemId);
+    if(menu) menu.classList.remove('show');
+    displayDiv.style.display = 'none';
+    formDiv.style.display = 'block';
+    input.value = currentName;
+    setTimeout(function() { input.focus(); input.select(); }, 50);
+}
+function hideRenameForm(itemId) {
+    var displayDiv = document.getElementById('item-display-' + itemId);
+    var formDiv = document.getElementById('rename-form-' + itemId);
+    if (!displayDiv || !formDiv) return;
+    formDiv.style.display = 'none';
+    displayDiv.style.display = 'block';
+}
+function confirmAndDelete(formId, itemName) {
+     var formElement = document.getElementById(formId);
+     if (!formElement) return false;
+     var menu = formElement.closest('.item')?.querySelector('.action-menu');
+     if(menu) menu.classList.remove('show');
+     if (confirm(`Are you sure you want to delete '${itemName}'? This cannot be undone.`)) {
+         postAction(formElement, function(result) {
+             if (result.job) watchJob(result.job.id);
+             else patchListing(itemName, null);
+         });
+     }
+     return false;
+}
+// Rename and delete are sent with fetch() and answered with JSON, so the
+// grid is patched instead of the whole page being reloaded.
+function postAction(form, onSuccess) {
+    var status = document.getElementById('upload-status');
+    fetch(form.getAttribute('action'), {
+        method: 'POST', credentials: 'same-origin', headers: {'Accept': 'application/json'},
+        body: new URLSearchParams(new FormData(form))
+    }).then(function(response) {
+        return response.json().then(function(result) {
+            if (!response.ok) throw new Error(result.error || 'HTTP ' + response.status);
+            status.textContent = '';
+            onSuccess(result);
+        });
+    }).catch(function(error) { status.textContent = error.message; });
+}
+ function handleMenuAction(menuId, actionFn) {
+      actionFn();
+      var menu = document.getElementById(menuId);
+      if (menu) menu.classList.remove('show');
+ }
+
+// The grid is virtualized: only cards near the viewport exist in the DOM,
+// and pages of entries are fetched from /_api/list as they scroll into view.
+var CARD_WIDTH = 170, CARD_HEIGHT = 190, CARD_GAP = 20, PAGE_SIZE = 200, OVERSCAN_ROWS = 2;
+var listing = {
+    path: '', sort: 'name', order: 'asc', query: '', everywhere: false, total: 0, version: null,
+    entries: [], pages: {}, cards: {}, columns: 1, generation: 0, pendingRender: false, selected: {}, thumbnailTypes: [],
+    live: false, staleCards: false
+};
+
+function escapeHtml(text) {
+    return String(text).replace(/[&<>"']/g, function(c) {
+        return {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[c];
+    });
+}
+function quotePath(path) {
+    return path.split('/').map(encodeURIComponent).join('/');
+}
+function formatDate(epochSeconds) {
+    var d = new Date(epochSeconds * 1000);
+    function pad(n) { return (n < 10 ? '0' : '') + n; }
+    return pad(d.getDate()) + '-' + pad(d.getMonth() + 1) + '-' + d.getFullYear() + ' ' + pad(d.getHours()) + ':' + pad(d.getMinutes());
+}
+var ICON_SPRITE = '__ICON_SPRITE__';  // filled in with the hashed sprite URL when assets are built
+function fileIcon(name) {
+    var ext = (name.lastIndexOf('.') > 0 ? name.slice(name.lastIndexOf('.')) : '').toLowerCase();
+    var icon = 'document';
+    if (ext === '.pdf') icon = 'pdf';
+    else if (['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'].indexOf(ext) >= 0) icon = 'image';
+    else if (['.mp3', '.wav', '.ogg', '.m4a'].indexOf(ext) >= 0) icon = 'audio';
+    else if (['.mp4', '.mov', '.avi', '.mkv'].indexOf(ext) >= 0) icon = 'video';
+    else if (['.zip', '.rar', '.7z', '.tar', '.gz'].indexOf(ext) >= 0) icon = 'zip';
+    else if (['.txt', '.md', '.log'].indexOf(ext) >= 0) icon = 'txt';
+    return {id: icon, ext: ext};
+}
+function iconSvg(id, label) {
+    return '<svg class="icon" role="img" aria-label="' + label + '"><use href="' + ICON_SPRITE + '#' + id + '"></use></svg>';
+}
+
+function listUrl(offset) {
+    return '/_api/list?path=' + encodeURIComponent(listing.path) + '&sort=' + listing.sort + '&order=' + listing.order +
+        '&q=' + encodeURIComponent(listing.query) + '&offset=' + offset + '&limit=' + PAGE_SIZE;
+}
+function applyPage(data) {
+    if (listing.version && data.version !== listing.version) {
+        // The folder changed underneath us; start over so pages stay consistent.
+        resetListing();
+        return;
+    }
+    listing.version = data.version;
+    listing.total = data.total;
+    for (var i = 0; i < data.entries.length; i++) {
+        listing.entries[data.offset + i] = data.entries[i];
+    }
+    listing.pages[Math.floor(data.offset / PAGE_SIZE)] = 'loaded';
+    layoutGrid();
+    scheduleRender(listing.staleCards);
+    listing.staleCards = false;
+}
+function searchUrl() {
+    return '/_api/search?q=' + encodeURIComponent(listing.query) + '&limit=1000';
+}
+function loadPage(page) {
+    if (listing.pages[page]) return;
+    listing.pages[page] = 'loading';
+    var generation = listing.generation;
+    var everywhere = listing.everywhere && listing.query;
+    fetch(everywhere ? searchUrl() : listUrl(page * PAGE_SIZE), {credentials: 'same-origin'})
+        .then(function(response) { return response.json(); })
+        .then(function(data) {
+            if (everywhere) {
+                // Search results arrive as one page covering the whole tree.
+                data = {offset: 0, total: data.results.length, entries: data.results, version: 'search'};
+            }
+            if (generation === listing.generation) applyPage(data);
+        })
+        .catch(function() { if (generation === listing.generation) delete listing.pages[page]; });
+}
+function resetListing() {
+    listing.generation++;
+    listing.entries = [];
+    listing.pages = {};
+    listing.version = null;
+    clearCards();
+    loadPage(0);
+}
+function clearCards() {
+    for (var index in listing.cards) listing.cards[index].remove();
+    listing.cards = {};
+}
+function refreshListing() {
+    // Fetch the pages in view again, keeping the current cards on screen
+    // until the new entries arrive.
+    listing.generation++;
+    listing.entries = [];
+    listing.pages = {};
+    listing.version = null;
+    listing.staleCards = true;
+    var range = visibleRange();
+    for (var page = Math.floor(range[0] / PAGE_SIZE); page <= Math.floor(Math.max(range[0], range[1] - 1) / PAGE_SIZE); page++) loadPage(page);
+}
+
+// Same order as the server's LISTING_SORT_KEYS: folders first, then the
+// sort key, then the name.
+function sortKey(entry) {
+    var lower = entry.name.toLowerCase();
+    if (listing.sort === 'size') return [entry.size === null ? -1 : entry.size, lower, entry.name];
+    if (listing.sort === 'mtime') return [entry.mtime === null ? 0 : entry.mtime, lower, entry.name];
+    if (listing.sort === 'type') return [fileIcon(entry.name).ext, lower, entry.name];
+    return [lower, entry.name];
+}
+function compareEntries(a, b) {
+    if (a.type !== b.type) return a.type === 'folder' ? -1 : 1;
+    var ka = sortKey(a), kb = sortKey(b), sign = listing.order === 'desc' ? -1 : 1;
+    for (var i = 0; i < ka.length; i++) {
+        if (ka[i] < kb[i]) return -sign;
+        if (ka[i] > kb[i]) return sign;
+    }
+    return 0;
+}
+function patchListing(removeName, entry) {
+    // Drops removeName and puts entry (if any) in its sorted place, replacing
+    // an entry of the same name. Only a fully loaded folder can be patched
+    // exactly; a partly loaded one fetches the pages in view again.
+    if (listing.everywhere && listing.query) return;
+    var complete = listing.entries.length === listing.total;
+    for (var i = 0; complete && i < listing.entries.length; i++) complete = !!listing.entries[i];
+    if (!complete) {
+        refreshListing();
+        return;
+    }
+    var first = listing.total;
+    [removeName, entry && entry.name].forEach(function(name) {
+        if (name === null || name === undefined) return;
+        for (var i = 0; i < listing.entries.length; i++) {
+            if (listing.entries[i].name !== name) continue;
+            if (listing.selected[listing.entries[i].path] && (!entry || entry.path !== listing.entries[i].path)) toggleSelected(listing.entries[i].path, false);
+            listing.entries.splice(i, 1);
+            first = Math.min(first, i);
+            break;
+        }
+    });
+    if (entry && entry.name.toLowerCase().indexOf(listing.query.toLowerCase()) >= 0) {
+        var lo = 0, hi = listing.entries.length;
+        while (lo < hi) {
+            var mid = (lo + hi) >> 1;
+            if (compareEntries(listing.entries[mid], entry) < 0) lo = mid + 1;
+            else hi = mid;
+        }
+        listing.entries.splice(lo, 0, entry);
+        first = Math.min(first, lo);
+    }
+    listing.total = listing.entries.length;
+    listing.version = null;  // server pages may now be ahead of or behind this list
+    for (var index in listing.cards) {
+        if (Number(index) < first) continue;
+        listing.cards[index].remove();
+        delete listing.cards[index];
+    }
+    layoutGrid();
+    scheduleRender(false);
+}
+
+// Changes to this folder, from this tab or anywhere else, arrive as
+// Server-Sent Events. While the stream is up the grid is patched from them;
+// without it (old browser, server busy or in single-request mode) it is
+// reloaded after each of our own changes instead.
+function startLiveUpdates() {
+    if (!window.EventSource) return;
+    var feed = new EventSource('/_api/events?path=' + encodeURIComponent(listing.path));
+    feed.onopen = function() { listing.live = true; };
+    feed.onerror = function() { listing.live = false; };
+    function on(name, handler) {
+        feed.addEventListener(name, function(event) { handler(JSON.parse(event.data)); });
+    }
+    on('add', function(data) { patchListing(null, data.entry); });
+    on('modify', function(data) { patchListing(null, data.entry); });
+    on('remove', function(data) { patchListing(data.name, null); });
+    on('rename', function(data) { patchListing(data.old_name, data.entry); });
+    on('reload', function() { refreshListing(); });
+    on('gone', function(data) {
+        var parent = listing.path.lastIndexOf('/') > 0 ? listing.path.slice(0, listing.path.lastIndexOf('/')) : '';
+        location.href = '/' + quotePath(data.new_path !== null ? data.new_path : parent);
+    });
+}
+
+function buildCard(index, entry) {
+    var card = document.createElement('div');
+    if (!entry) {
+        card.className = 'item placeholder';
+        return card;
+    }
+    var id = 'i' + index;
+    var safeName = escapeHtml(entry.name);
+    var quoted = escapeHtml(quotePath(entry.path));
+    var isFile = entry.type === 'file';
+    var visual;
+    if (!isFile) {
+        visual = iconSvg('folder', 'Folder icon') +
+                 '<div class="item-name">' + safeName + '</div>' +
+                 (entry.size === null ? '' : '<div class="meta">' + (entry.size / (1024 * 1024)).toFixed(2) + ' MB | ' + entry.files + (entry.files === 1 ? ' file' : ' files') + '</div>');
+    } else {
+        var icon = fileIcon(entry.name);
+        var thumbnail = entry.size !== null && listing.thumbnailTypes.indexOf(icon.ext) >= 0;
+        visual = (thumbnail ?
+                     '<img class="thumb" src="/_api/thumb?path=' + encodeURIComponent(entry.path) + '&amp;v=' + entry.size + '-' + entry.mtime +
+                     '" data-icon="' + icon.id + '" alt="Preview of ' + safeName + '" loading="lazy"/>' :
+                     iconSvg(icon.id, 'File icon for ' + escapeHtml(icon.ext))) +
+                 '<div class="item-name">' + (entry.size === null ? safeName + ' ( inaccessible )' : safeName) + '</div>' +
+                 '<div class="meta">' + (entry.size === null ? '0.00 MB | N/A' : (entry.size / (1024 * 1024)).toFixed(2) + ' MB | ' + formatDate(entry.mtime)) + '</div>';
+    }
+    card.className = 'item ' + entry.type;
+    card.innerHTML =
+        '<input type="checkbox" class="select-box" aria-label="Select ' + safeName + '"' + (listing.selected[entry.path] ? ' checked' : '') + '>' +
+        '<div class="item-actions">' +
+            '<button class="three-dots-btn" aria-label="Actions for ' + safeName + '" title="Actions">⋮</button>' +
+            '<div id="menu-' + id + '" class="action-menu">' +
+                (isFile ? '' : '<a class="action-menu-item" href="/_api/zip?path=' + encodeURIComponent(entry.path) + '">Download ZIP</a>') +
+                '<button type="button" class="action-menu-item rename-action">Rename</button>' +
+                '<button type="button" class="action-menu-item delete delete-action">Delete</button>' +
+            '</div>' +
+        '</div>' +
+        '<div id="item-display-' + id + '">' +
+            '<a href="/' + quoted + '"' + (isFile ? ' target="_blank" rel="noopener noreferrer"' : '') + ' class="item-link" title="' + safeName + '">' + visual + '</a>' +
+        '</div>' +
+        '<div id="rename-form-' + id + '" class="rename-form">' +
+            '<form method="post" action="/rename" aria-labelledby="rename-heading-' + id + '">' +
+                '<input type="hidden" name="old_path" value="' + quoted + '">' +
+                '<label for="rename-input-' + id + '" style="display:none;" id="rename-heading-' + id + '">New name for ' + safeName + '</label>' +
+                '<input type="text" id="rename-input-' + id + '" name="new_name" required aria-required="true"><br>' +
+                '<button type="submit" class="save-btn">Save</button>' +
+                '<button type="button" class="cancel-btn">Cancel</button>' +
+            '</form>' +
+        '</div>' +
+        '<form id="delete-form-' + id + '" method="post" action="/delete" style="display: none;" aria-hidden="true">' +
+            '<input type="hidden" name="path" value="' + quoted + '">' +
+        '</form>';
+    card.querySelector('.three-dots-btn').onclick = function(event) { event.stopPropagation(); toggleMenu('menu-' + id); };
+    card.querySelector('.rename-action').onclick = function() { handleMenuAction('menu-' + id, function() { showRenameForm(id, entry.name); }); };
+    card.querySelector('.delete-action').onclick = function() { confirmAndDelete('delete-form-' + id, entry.name); };
+    var thumb = card.querySelector('img.thumb');
+    if (thumb) thumb.onerror = function() { thumb.outerHTML = iconSvg(thumb.getAttribute('data-icon'), thumb.alt); };
+    card.querySelector('.cancel-btn').onclick = function() { hideRenameForm(id); };
+    card.querySelector('.rename-form form').onsubmit = function(event) {
+        event.preventDefault();
+        postAction(this, function(result) { patchListing(entry.name, result.entry); });
+    };
+    card.querySelector('.select-box').onchange = function() { toggleSelected(entry.path, this.checked); };
+    return card;
+}
+
+function toggleSelected(path, checked) {
+    if (checked) listing.selected[path] = true;
+    else delete listing.selected[path];
+    var count = Object.keys(listing.selected).length;
+    var button = document.getElementById('zip-selected-btn');
+    button.style.display = count ? 'inline-block' : 'none';
+    button.innerText = '⬇ Download selected (' + count + ') as ZIP';
+}
+function downloadSelected() {
+    // A regular form post lets the browser stream the archive straight to disk.
+    var form = document.createElement('form');
+    form.method = 'post';
+    form.action = '/_api/zip';
+    Object.keys(listing.selected).forEach(function(path) {
+        var input = document.createElement('input');
+        input.type = 'hidden';
+        input.name = 'path';
+        input.value = path;
+        form.appendChild(input);
+    });
+    document.body.appendChild(form);
+    form.submit();
+    form.remove();
+}
+
+function layoutGrid() {
+    var grid = document.getElementById('item-grid');
+    listing.columns = Math.max(1, Math.floor((grid.clientWidth + CARD_GAP) / (CARD_WIDTH + CARD_GAP)));
+    var rows = Math.ceil(listing.total / listing.columns);
+    grid.style.height = Math.max(0, rows * (CARD_HEIGHT + CARD_GAP) - CARD_GAP) + 'px';
+    document.getElementById('empty-folder').style.display = listing.total ? 'none' : 'block';
+}
+function scheduleRender(rebuild) {
+    if (rebuild) clearCards();
+    if (listing.pendingRender) return;
+    listing.pendingRender = true;
+    window.requestAnimationFrame(function() { listing.pendingRender = false; renderVisible(); });
+}
+function visibleRange() {
+    var grid = document.getElementById('item-grid');
+    var rowHeight = CARD_HEIGHT + CARD_GAP;
+    var top = Math.max(0, -grid.getBoundingClientRect().top);
+    var firstRow = Math.max(0, Math.floor(top / rowHeight) - OVERSCAN_ROWS);
+    var lastRow = Math.floor((top + window.innerHeight) / rowHeight) + OVERSCAN_ROWS;
+    return [firstRow * listing.columns, Math.min(listing.total, (lastRow + 1) * listing.columns)];
+}
+function renderVisible() {
+    var grid = document.getElementById('item-grid');
+    var rowHeight = CARD_HEIGHT + CARD_GAP;
+    var range = visibleRange(), first = range[0], last = range[1];
+
+    for (var index in listing.cards) {
+        var card = listing.cards[index];
+        var keep = index >= first && index < last && card.classList.contains('placeholder') === !listing.entries[index];
+        if (!keep && !card.querySelector('.action-menu.show') && !card.contains(document.activeElement)) {
+            card.remove();
+            delete listing.cards[index];
+        }
+    }
+    for (var i = first; i < last; i++) {
+        if (listing.cards[i]) continue;
+        var entry = listing.entries[i];
+        if (!entry) loadPage(Math.floor(i / PAGE_SIZE));
+        var card = buildCard(i, entry);
+        card.style.left = (i % listing.columns) * (CARD_WIDTH + CARD_GAP) + 'px';
+        card.style.top = Math.floor(i / listing.columns) * rowHeight + 'px';
+        listing.cards[i] = card;
+        grid.appendChild(card);
+    }
+}
+
+var searchTimer = null;
+function filterItems() {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(function() {
+        listing.query = document.getElementById('search-input').value;
+        listing.everywhere = document.getElementById('search-everywhere').checked;
+        resetListing();
+    }, 200);
+}
+function changeSort() {
+    var parts = document.getElementById('sort-select').value.split(':');
+    listing.sort = parts[0];
+    listing.order = parts[1];
+    resetListing();
+}
+
+// Picked files are sent in batches (several small files per request, big
+// files alone) with a few requests in flight at once. Folder picks keep
+// their relative paths, which the server recreates under this folder.
+var UPLOAD_PARALLEL = 3, UPLOAD_BATCH_BYTES = 8 * 1024 * 1024, UPLOAD_BATCH_FILES = 50;
+function uploadFiles(input) {
+    var files = Array.prototype.slice.call(input.files);
+    input.value = '';
+    if (!files.length) return;
+    var batches = [], batch = null, totalBytes = 0;
+    files.forEach(function(file) {
+        if (!batch || batch.files.length >= UPLOAD_BATCH_FILES || batch.bytes + file.size > UPLOAD_BATCH_BYTES) {
+            batch = {files: [], bytes: 0, sent: 0};
+            batches.push(batch);
+        }
+        batch.files.push(file);
+        batch.bytes += file.size;
+        totalBytes += file.size;
+    });
+    var status = document.getElementById('upload-status');
+    var state = {next: 0, active: 0, finishedBytes: 0, saved: 0, failed: []};
+    function report() {
+        var sent = state.finishedBytes;
+        batches.forEach(function(b) { sent += b.sent; });
+        var percent = totalBytes ? Math.floor(sent * 100 / totalBytes) : 100;
+        status.textContent = 'Uploading ' + files.length + (files.length === 1 ? ' file: ' : ' files: ') + percent + '% (' +
+                             (sent / (1024 * 1024)).toFixed(1) + ' of ' + (totalBytes / (1024 * 1024)).toFixed(1) + ' MB)';
+    }
+    function finish() {
+        var text = 'Uploaded ' + state.saved + ' of ' + files.length + (files.length === 1 ? ' file' : ' files');
+        if (state.failed.length) text += '. Failed: ' + state.failed.slice(0, 5).join('; ') + (state.failed.length > 5 ? '; …' : '');
+        status.textContent = text;
+        if (!listing.live) resetListing();
+    }
+    function startNext() {
+        if (state.next >= batches.length) {
+            if (!state.active) finish();
+            return;
+        }
+        var current = batches[state.next++];
+        state.active++;
+        var form = new FormData();
+        current.files.forEach(function(file) { form.append('file', file, file.webkitRelativePath || file.name); });
+        var xhr = new XMLHttpRequest();
+        xhr.open('POST', '/upload?path=' + encodeURIComponent(listing.path));
+        xhr.setRequestHeader('Accept', 'application/json');
+        xhr.upload.onprogress = function(e) {
+            current.sent = Math.min(current.bytes, e.loaded);
+            report();
+        };
+        function done(result, failure) {
+            if (result && result.files) {
+                result.files.forEach(function(f) {
+                    if (f.error) state.failed.push(f.name + ' (' + f.error + ')');
+                    else state.saved++;
+                });
+            } else {
+                current.files.forEach(function(file) { state.failed.push(file.name + ' (' + failure + ')'); });
+            }
+            state.active--;
+            state.finishedBytes += current.bytes;
+            current.sent = 0;
+            report();
+            startNext();
+        }
+        xhr.onload = function() {
+            var result = null;
+            try { result = JSON.parse(xhr.responseText); } catch (e) {}
+            done(result, 'HTTP ' + xhr.status);
+        };
+        xhr.onerror = function() { done(null, 'connection lost'); };
+        xhr.send(form);
+    }
+    report();
+    for (var i = 0; i < UPLOAD_PARALLEL; i++) startNext();
+}
+
+// Recursive deletes run as background jobs; the redirect after one carries
+// ?job=<id> and the page shows its progress until it finishes.
+var JOB_LABELS = {'delete': 'Deleting'};
+function watchJob(jobId) {
+    var status = document.getElementById('upload-status');
+    history.replaceState(null, '', location.pathname);
+    function poll() {
+        fetch('/_api/jobs/' + encodeURIComponent(jobId)).then(function(response) {
+            return response.ok ? response.json() : null;
+        }).then(function(job) {
+            if (!job) return;
+            var label = (JOB_LABELS[job.kind] || job.kind) + ' ' + escapeHtml(job.path) + ': ';
+            var progress = job.items + (job.total_items !== null ? ' of ' + job.total_items : '') + ' items, ' +
+                           (job.bytes / (1024 * 1024)).toFixed(2) + ' MB';
+            if (job.state === 'queued' || job.state === 'running') {
+                status.innerHTML = label + (job.state === 'queued' ? 'waiting' : progress) +
+                                   ' <button type="button" class="job-cancel">Cancel</button>';
+                status.querySelector('.job-cancel').onclick = function() {
+                    fetch('/_api/jobs/' + encodeURIComponent(jobId), {method: 'DELETE'});
+                };
+                setTimeout(poll, 1000);
+                return;
+            }
+            status.innerHTML = label + (job.state === 'done' ? 'done' : job.state + (job.error ? ' (' + escapeHtml(job.error) + ')' : '')) +
+                               ', ' + progress;
+            if (!listing.live) resetListing();
+        }).catch(function() { setTimeout(poll, 5000); });
+    }
+    poll();
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+    var initial = JSON.parse(document.getElementById('listing-data').textContent);
+    listing.path = initial.path;
+    listing.thumbnailTypes = initial.thumbnail_types || [];
+    applyPage(initial);
+    var jobId = new URLSearchParams(location.search).get('job');
+    if (jobId) watchJob(jobId);
+    startLiveUpdates();
+    window.addEventListener('scroll', function() { scheduleRender(false); }, {passive: true});
+    window.addEventListener('resize', function() { layoutGrid(); scheduleRender(true); });
+});
+"""
+
+# File-type icons for the cards, referenced as <use href="sprite#id">.
+ICON_SPRITE = """<svg xmlns="http://www.w3.org/2000/svg">
+<symbol id="folder" viewBox="0 0 48 48">
+  <path d="M4 11a3 3 0 0 1 3-3h12l4 4h18a3 3 0 0 1 3 3v4H4z" fill="#e8a600"/>
+  <path d="M4 17h40v20a3 3 0 0 1-3 3H7a3 3 0 0 1-3-3z" fill="#fbbc04"/>
+</symbol>
+<symbol id="page" viewBox="0 0 48 48">
+  <path d="M10 4h20l10 10v28a2 2 0 0 1-2 2H10a2 2 0 0 1-2-2V6a2 2 0 0 1 2-2z"/>
+  <path d="M30 4v8a2 2 0 0 0 2 2h8z" fill="#fff" fill-opacity=".45"/>
+</symbol>
+<symbol id="document" viewBox="0 0 48 48">
+  <use href="#page" fill="#5f6368"/>
+  <path d="M15 22h18M15 28h18M15 34h12" stroke="#fff" stroke-width="2.5" stroke-linecap="round"/>
+</symbol>
+<symbol id="txt" viewBox="0 0 48 48">
+  <use href="#page" fill="#4285f4"/>
+  <path d="M15 22h18M15 28h18M15 34h12" stroke="#fff" stroke-width="2.5" stroke-linecap="round"/>
+</symbol>
+<symbol id="pdf" viewBox="0 0 48 48">
+  <use href="#page" fill="#ea4335"/>
+  <text x="24" y="35" fill="#fff" font-family="Arial, sans-serif" font-size="11" font-weight="bold" text-anchor="middle">PDF</text>
+</symbol>
+<symbol id="zip" viewBox="0 0 48 48">
+  <use href="#page" fill="#795548"/>
+  <path d="M22 8h4v3h-4zM22 14h4v3h-4zM22 20h4v3h-4z" fill="#fff"/>
+  <rect x="20" y="26" width="8" height="9" rx="1.5" fill="#fff"/>
+</symbol>
+<symbol id="image" viewBox="0 0 48 48">
+  <use href="#page" fill="#34a853"/>
+  <circle cx="18" cy="23" r="3.5" fill="#fff"/>
+  <path d="M13 37l7-8 4 4 5-7 7 11z" fill="#fff"/>
+</symbol>
+<symbol id="audio" viewBox="0 0 48 48">
+  <use href="#page" fill="#9c27b0"/>
+  <path d="M21 20v11.2a4 4 0 1 0 2.5 3.8V24l8-2v7.2a4 4 0 1 0 2.5 3.8V17z" fill="#fff"/>
+</symbol>
+<symbol id="video" viewBox="0 0 48 48">
+  <use href="#page" fill="#e91e63"/>
+  <path d="M19 21v14l12-7z" fill="#fff"/>
+</symbol>
+</svg>
+"""
+
+# Built-in static files, served from content-hashed URLs such as
+# /_static/drive.3f9c0a1b2c4d.css: a new version gets a new URL, so browsers
+# may cache each one for good. The icon sprite is hashed first since the
+# script embeds its URL.
+STATIC_ASSETS = {}
+_static_urls = {}
+
+def _register_static(name, content_type, text):
+    body = text.encode('utf-8')
+    digest = hashlib.sha256(body).hexdigest()[:12]
+    stem, ext = os.path.splitext(name)
+    url = f"{STATIC_PREFIX}{stem}.{digest}{ext}"
+    # content type, body, ETag, compressed variants by encoding
+    STATIC_ASSETS[url] = (content_type, body, f'"{digest}"', {})
+    _static_urls[name] = url
+
+def static_url(name):
+    return _static_urls[name]
+
+_register_static('icons.svg', 'image/svg+xml', ICON_SPRITE)
+_register_static('drive.css', 'text/css; charset=utf-8', LISTING_STYLE)
+_register_static('drive.js', 'application/javascript; charset=utf-8',
+                 LISTING_SCRIPT.replace('__ICON_SPRITE__', static_url('icons.svg')))
+
 class GDriveHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # headers and body are separate writes on a kept-alive connection
+
+    def setup(self):
+        super().setup()
+        self.connection.settimeout(REQUEST_TIMEOUT)
+        self.requests_on_connection = 0
+        self.wfile = self._connection_wfile = CountingWriter(self.wfile)
+        metrics.connection_opened()
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            metrics.connection_closed()
+
+    def handle_one_request(self):
+        if self.requests_on_connection and not self._wait_for_next_request():
+            self.close_connection = True
+            return
+        self.body = None
+        self.client_id = self.client_address[0]
+        self.bulk_transfer = False
+        self.route = 'other'
+        self._request_started = None
+        self._response_code = None
+        self._connection_header_sent = False
+        sent_before = self._connection_wfile.bytes_written
+        try:
+            super().handle_one_request()
+            if self.body is not None and self.body.remaining and not self.close_connection:
+                if not self.body.discard(MAX_UNREAD_BODY_DISCARD):
+                    self.close_connection = True
+        except OSError:
+            self.close_connection = True
+        finally:
+            self.wfile = self._connection_wfile
+            if self._request_started is not None:
+                self._record_request(self._connection_wfile.bytes_written - sent_before)
+
+    def _record_request(self, bytes_out):
+        seconds = time.perf_counter() - self._request_started
+        bytes_in = self.body.length - self.body.remaining if self.body is not None else 0
+        status = self._response_code or 0
+        if METRICS_ENABLED:
+            metrics.request_finished(self.route, self.command, status, seconds, bytes_in, bytes_out)
+        if LOG_ACCESS:
+            log_event('request', client=self.client_id, method=self.command, path=self.path,
+                      status=status, route=self.route, bytes_in=bytes_in, bytes_out=bytes_out,
+                      duration_ms=round(seconds * 1000, 1))
+
+    def log_request(self, code='-', size='-'):
+        pass  # logged once the response is complete, see _record_request
+
+    def log_message(self, format, *args):
+        log_event('http', format % args, level='warning', client=self.client_address[0])
+
+    def _wait_for_next_request(self):
+        # Idle between requests. Give the worker up early when the server is
+        # stopping or other clients are queued for one.
+        self.connection.settimeout(0)
+        try:
+            if self.rfile.peek(1):  # pipelined request already buffered
+                return True
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(REQUEST_TIMEOUT)
+        deadline = time.monotonic() + KEEPALIVE_TIMEOUT
+        while time.monotonic() < deadline:
+            if not self._may_keep_alive():
+                return False
+            try:
+                readable, _, _ = select.select([self.connection], [], [], min(0.5, max(0, deadline - time.monotonic())))
+                if readable:
+                    return bool(self.rfile.peek(1))
+            except (OSError, ValueError):
+                return False
+        return False
+
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        self.requests_on_connection += 1
+        self._request_started = time.perf_counter()
+        if METRICS_ENABLED:
+            metrics.request_started()
+        if self.headers.get('Transfer-Encoding'):
+            self.send_error(411, "Chunked request bodies are not supported, send a Content-Length")
+            return False
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            if length < 0: raise ValueError(length)
+        except ValueError:
+            self.send_error(400, "Invalid Content-Length header")
+            return False
+        self.client_id = self._client_id()
+        throttle = None
+        if length > BULK_TRANSFER_SIZE and bandwidth.enabled:
+            self.bulk_transfer = True
+            throttle = self._throttle
+        self.body = RequestBody(self.rfile, length, throttle)
+        return True
+
+    def _may_keep_alive(self):
+        if self.requests_on_connection >= MAX_KEEPALIVE_REQUESTS:
+            return False
+        stopping = getattr(self.server, 'stopping', None)
+        if stopping is not None and stopping.is_set():
+            return False
+        waiting = getattr(self.server, 'clients_waiting', None)
+        return not (waiting and waiting())
+
+    def send_response_only(self, code, message=None):
+        super().send_response_only(code, message)
+        self._response_code = code
+        self._connection_header_sent = False
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'connection':
+            self._connection_header_sent = True
+        super().send_header(keyword, value)
+
+    def end_headers(self):
+        if self._response_code is None or self._response_code < 200:
+            super().end_headers()
+            return
+        if not self._connection_header_sent:
+            unread = self.body.remaining if self.body is not None else 0
+            if self.close_connection or unread > MAX_UNREAD_BODY_DISCARD or not self._may_keep_alive():
+                self.send_header('Connection', 'close')
+            else:
+                if self.request_version == 'HTTP/1.0':
+                    self.send_header('Connection', 'keep-alive')
+                self.send_header('Keep-Alive', f'timeout={KEEPALIVE_TIMEOUT}, max={MAX_KEEPALIVE_REQUESTS - self.requests_on_connection}')
+        super().end_headers()
+        if self.command == 'HEAD':
+            self.wfile.flush()
+            self.wfile = _DiscardWriter()
+
+    def _start_stream(self):
+        # For bodies of unknown length; call before end_headers().
+        chunked = self.request_version != 'HTTP/1.0'
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+        return StreamWriter(self.wfile, chunked, throttle=self._throttle if bandwidth.enabled else None)
+
+    def _client_id(self):
+        # ngrok and other local proxies connect from loopback and append the
+        # address they saw to X-Forwarded-For. Only that last entry comes from
+        # the proxy; anything before it was sent by the client and could be
+        # changed on every request to dodge the per-client bandwidth limit.
+        address = self.client_address[0]
+        if address in ('127.0.0.1', '::1'):
+            forwarded = self.headers.get('X-Forwarded-For')
+            if forwarded and forwarded.rsplit(',', 1)[-1].strip():
+                return forwarded.rsplit(',', 1)[-1].strip()
+        return address
+
+    def _throttle(self, nbytes):
+        bandwidth.consume(self.client_id, nbytes, self.bulk_transfer)
 
     def _get_validated_path(self, path_param):
         if path_param is None:
@@ -27,21 +4573,64 @@ class GDriveHandler(SimpleHTTPRequestHandler):
         abs_path = os.path.normpath(os.path.join(UPLOAD_DIR, rel_path))
 
         if os.path.commonpath([UPLOAD_DIR, abs_path]) != UPLOAD_DIR:
-            print(f"Security Alert: Path traversal attempt denied for '{rel_path}'")
+            log_event('security', f"Path traversal attempt denied for '{rel_path}'", level='warning',
+                      client=self.client_address[0], path=rel_path)
+            return None
+        if os.path.relpath(abs_path, UPLOAD_DIR).split(os.sep)[0] == STATE_DIR_NAME:
             return None
         return abs_path, rel_path
 
-    def _send_json_response(self, status_code, data):
+    def _negotiate_encoding(self, content_type, path=None):
+        if not COMPRESSION_ENABLED or not is_compressible(content_type, path):
+            return None
+        return choose_encoding(self.headers.get('Accept-Encoding', ''))
+
+    def _send_body(self, status_code, content_type, body, extra_headers=None, variants=None):
+        # variants, if given, is a dict that keeps compressed copies of a body
+        # that never changes, keyed by encoding.
+        encoding = self._negotiate_encoding(content_type) if len(body) >= COMPRESSION_MIN_SIZE else None
+        if encoding and variants is not None:
+            if encoding not in variants:
+                variants[encoding] = compress_bytes(body, encoding)
+            body = variants[encoding]
+        elif encoding:
+            body = compress_bytes(body, encoding)
         self.send_response(status_code)
-        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if COMPRESSION_ENABLED and is_compressible(content_type):
+            self.send_header('Vary', 'Accept-Encoding')
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode('utf-8'))
+        if bandwidth.enabled:
+            self._throttle(len(body))
+        self.wfile.write(body)
+
+    def _send_json_response(self, status_code, data, extra_headers=None):
+        self._send_body(status_code, 'application/json', json.dumps(data).encode('utf-8'), extra_headers)
+
+    def _wants_json(self):
+        # Scripts and the page's own fetch() calls ask for a JSON result
+        # instead of the redirect a plain form post gets.
+        return 'application/json' in self.headers.get('Accept', '')
+
+    def send_error(self, code, message=None, explain=None):
+        # Page scripts and API clients that asked for JSON get the error as
+        # JSON too, instead of an HTML page.
+        if code >= 400 and getattr(self, 'headers', None) is not None and self._wants_json():
+            self._send_json_response(code, {'error': message or self.responses.get(code, ('Error',))[0]})
+            return
+        super().send_error(code, message, explain)
 
     def _redirect(self, path):
         if not path.startswith('/'):
             path = '/' + path
         self.send_response(303)
         self.send_header('Location', path)
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
     def _is_authenticated(self):
@@ -59,21 +4648,23 @@ class GDriveHandler(SimpleHTTPRequestHandler):
             username, password = decoded_credentials_str.split(':', 1)
             return username == USERNAME and password == PASSWORD
         except Exception as e:
-            print(f"Authentication parsing error: {e}")
+            log_event('auth', f"Authentication parsing error: {e}", level='warning', client=self.client_address[0])
             return False
 
     def _require_auth(self):
-        self.send_response(401)
-        self.send_header('WWW-Authenticate', f'Basic realm="{REALM}"')
-        self.send_header('Content-type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(f"""
+        body = f"""
         <!DOCTYPE html>
         <html>
         <head><title>401 Unauthorized</title></head>
         <body><h1>401 Unauthorized</h1><p>You need to provide credentials to access this resource.</p></body>
         </html>
-        """.encode('utf-8'))
+        """.encode('utf-8')
+        self.send_response(401)
+        self.send_header('WWW-Authenticate', f'Basic realm="{REALM}"')
+        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
     def _generate_breadcrumbs(self, current_rel_path):
         breadcrumb_html = '<nav class="breadcrumbs"><a href="/">Root</a>'
@@ -92,26 +4683,13 @@ class GDriveHandler(SimpleHTTPRequestHandler):
         breadcrumb_html += '</nav>'
         return breadcrumb_html
 
-    def list_directory_html(self, current_abs_path):
-        files = []
-        dirs = []
+    def _read_directory(self, current_abs_path):
         current_rel_path = os.path.relpath(current_abs_path, UPLOAD_DIR)
         if current_rel_path == '.':
             current_rel_path = ""
 
         try:
-            for item in os.listdir(current_abs_path):
-                item_abs_path = os.path.join(current_abs_path, item)
-                item_rel_path = os.path.join(current_rel_path, item) if current_rel_path else item
-                if os.path.isdir(item_abs_path):
-                    dirs.append({'name': item, 'rel_path': item_rel_path})
-                elif os.path.isfile(item_abs_path):
-                    try:
-                        size = os.path.getsize(item_abs_path) / (1024 * 1024)
-                        mtime = datetime.fromtimestamp(os.path.getmtime(item_abs_path)).strftime('%d-%m-%Y %H:%M')
-                        files.append({'name': item, 'size': size, 'mtime': mtime, 'rel_path': item_rel_path})
-                    except OSError:
-                         files.append({'name': f"{item} ( inaccessible )", 'size': 0, 'mtime': 'N/A', 'rel_path': item_rel_path})
+            snapshot = listing_cache.get(current_abs_path)
         except PermissionError:
             self.send_error(403, "Permission Denied to list directory")
             return None
@@ -121,11 +4699,14 @@ class GDriveHandler(SimpleHTTPRequestHandler):
         except Exception as e:
             self.send_error(500, f"Error listing directory: {e}")
             return None
+        return current_rel_path, snapshot
 
-        files.sort(key=lambda x: x['name'].lower())
-        dirs.sort(key=lambda x: x['name'].lower())
-
+    def list_directory_html(self, current_rel_path, snapshot):
         breadcrumb_nav_html = self._generate_breadcrumbs(current_rel_path)
+        # Only the first page is embedded; the grid fetches the rest on demand.
+        initial_page = listing_page(snapshot, current_rel_path.replace(os.sep, '/'))
+        initial_page['thumbnail_types'] = thumbnails.extensions()
+        initial_page_json = json.dumps(initial_page).replace('</', '<\\/')
 
         html_content = f"""
         <!DOCTYPE html>
@@ -134,330 +4715,8 @@ class GDriveHandler(SimpleHTTPRequestHandler):
             <meta charset="UTF-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
             <title>My Drive - {'/' + html.escape(current_rel_path) if current_rel_path else 'Root'}</title>
-            <link href="https://fonts.googleapis.com/css2?family=Poppins:wght@400;600&display=swap" rel="stylesheet">
-            <style>
-                body {{
-                    font-family: 'Poppins', sans-serif;
-                    background-color: #f1f3f4;
-                    margin: 0;
-                    padding: 20px;
-                    color: #333;
-                }}
-                h1 {{
-                    color: #202124;
-                    border-bottom: 1px solid #ddd;
-                    padding-bottom: 10px;
-                    margin-top: 0;
-                    margin-bottom: 15px;
-                    font-weight: 600;
-                }}
-                .container {{
-                    background-color: white;
-                    padding: 20px 30px;
-                    border-radius: 10px;
-                    box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-                    max-width: 1200px;
-                    margin: auto;
-                }}
-                a {{
-                    color: #1a73e8;
-                    text-decoration: none;
-                }}
-                a:hover {{
-                    text-decoration: underline;
-                }}
-                .breadcrumbs {{
-                    margin-bottom: 20px;
-                    font-size: 14px;
-                    color: #5f6368;
-                    word-wrap: break-word;
-                }}
-                .breadcrumbs a {{
-                    color: #1a73e8;
-                }}
-                .breadcrumbs .current-crumb {{
-                    font-weight: 600;
-                    color: #202124;
-                }}
-                .upload-section, .search-section {{
-                    margin-bottom: 25px;
-                    padding: 15px;
-                    background-color: #e8f0fe;
-                    border-radius: 8px;
-                }}
-                .search-section {{
-                     background-color: #f8f9fa;
-                }}
-                 .upload-btn {{
-                    background: #1a73e8;
-                    color: white;
-                    border: none;
-                    padding: 10px 20px;
-                    border-radius: 20px;
-                    cursor: pointer;
-                    font-size: 14px;
-                    font-weight: 600;
-                    transition: background-color 0.2s ease;
-                 }}
-                 .upload-btn:hover {{
-                    background: #1558b0;
-                 }}
-                 #upload-status {{
-                     margin-left: 10px;
-                     font-style: italic;
-                     color: #1a73e8;
-                     font-size: 13px;
-                 }}
-                #search-input {{
-                    padding: 10px 15px;
-                    font-size: 14px;
-                    border-radius: 20px;
-                    border: 1px solid #ccc;
-                    width: 300px;
-                    max-width: 90%;
-                    box-sizing: border-box;
-                }}
-                #search-input:focus {{
-                     outline: none;
-                     border-color: #1a73e8;
-                     box-shadow: 0 0 0 2px rgba(26, 115, 232, 0.2);
-                }}
-                .item-grid {{
-                    display: flex;
-                    flex-wrap: wrap;
-                    gap: 20px;
-                    margin-top: 20px;
-                    padding-top: 10px;
-                }}
-                .item {{
-                    width: 170px;
-                    padding: 10px 15px 15px 15px;
-                    border-radius: 8px;
-                    background: #fff;
-                    border: 1px solid #dadce0;
-                    text-align: center;
-                    font-size: 13px;
-                    overflow: visible;
-                    position: relative;
-                    transition: box-shadow 0.2s ease-in-out, opacity 0.3s ease, transform 0.3s ease;
-                    word-wrap: break-word;
-                    display: flex;
-                    flex-direction: column;
-                    box-sizing: border-box;
-                }}
-                 .item:hover {{
-                    box-shadow: 0 4px 8px rgba(0,0,0,0.15);
-                    transform: translateY(-2px);
-                 }}
-                 .item.hidden {{
-                    opacity: 0;
-                    pointer-events: none;
-                    transform: scale(0.8);
-                    height: 0;
-                    padding: 0;
-                    margin: 0;
-                    border: none;
-                    width: 0;
-                    gap: 0;
-                 }}
-                 .item-link {{
-                    text-decoration: none;
-                    color: #1a0dab;
-                    font-weight: 600;
-                    display: block;
-                    flex-grow: 1;
-                    margin-bottom: 5px;
-                 }}
-                 .item img {{
-                    width: 60px;
-                    height: 60px;
-                    object-fit: contain;
-                    margin-bottom: 10px;
-                    margin-top: 5px;
-                 }}
-                 .item-name {{
-                    height: 40px;
-                    overflow: hidden;
-                    line-height: 1.4;
-                    word-break: break-all;
-                 }}
-                 .meta {{
-                    font-size: 11px;
-                    color: #5f6368;
-                    margin-top: auto;
-                    padding-top: 5px;
-                 }}
-                .item-actions {{
-                    position: absolute;
-                    top: 5px;
-                    right: 5px;
-                    z-index: 11;
-                }}
-                .three-dots-btn {{
-                    background: none;
-                    border: none;
-                    font-size: 20px;
-                    line-height: 1;
-                    font-weight: bold;
-                    padding: 5px;
-                    cursor: pointer;
-                    color: #5f6368;
-                    border-radius: 50%;
-                    transition: background-color 0.2s ease;
-                }}
-                .three-dots-btn:hover {{
-                    background-color: #eee;
-                }}
-                .action-menu {{
-                    display: none;
-                    position: absolute;
-                    right: 0;
-                    top: 100%;
-                    background-color: white;
-                    min-width: 120px;
-                    box-shadow: 0px 8px 16px 0px rgba(0,0,0,0.2);
-                    z-index: 10;
-                    border-radius: 4px;
-                    overflow: hidden;
-                    padding: 5px 0;
-                }}
-                .action-menu.show {{
-                    display: block;
-                }}
-                .action-menu-item {{
-                    font-family: 'Poppins', sans-serif;
-                    font-size: 13px;
-                    color: #333;
-                    padding: 8px 16px;
-                    text-decoration: none;
-                    display: block;
-                    cursor: pointer;
-                    background: none;
-                    border: none;
-                    width: 100%;
-                    text-align: left;
-                    box-sizing: border-box;
-                    white-space: nowrap;
-                }}
-                .action-menu-item:hover {{
-                    background-color: #f1f1f1;
-                }}
-                .action-menu-item.delete {{
-                    color: #d93025;
-                    font-weight: 600;
-                }}
-                .rename-form {{
-                    display: none;
-                    padding: 10px 5px 5px 5px;
-                    border-top: 1px solid #eee;
-                    margin-top: 10px;
-                }}
-                .rename-form input[type=text] {{
-                    width: calc(100% - 12px);
-                    padding: 6px;
-                    margin-bottom: 8px;
-                    font-size: 12px;
-                    border: 1px solid #ccc;
-                    border-radius: 3px;
-                    box-sizing: border-box;
-                }}
-                .rename-form button {{
-                   font-size: 11px;
-                   padding: 5px 10px;
-                   border-radius: 15px;
-                   cursor: pointer;
-                   border: none;
-                   margin-right: 5px;
-                   font-weight: 600;
-                   transition: background-color 0.2s ease, filter 0.2s ease;
-                }}
-                .rename-form .save-btn {{
-                    background-color: #1a73e8;
-                    color: white;
-                }}
-                .rename-form .cancel-btn {{
-                    background-color: #eee;
-                    color: #333;
-                }}
-                .rename-form .save-btn:hover {{ filter: brightness(90%); }}
-                .rename-form .cancel-btn:hover {{ filter: brightness(95%); }}
-            </style>
-             <script>
-                function toggleMenu(menuId) {{
-                    var targetMenu = document.getElementById(menuId);
-                    if (!targetMenu) return;
-                    var currentlyShown = targetMenu.classList.contains('show');
-                    var menus = document.getElementsByClassName('action-menu');
-                    for (var i = 0; i < menus.length; i++) {{
-                        menus[i].classList.remove('show');
-                    }}
-                    if (!currentlyShown) {{
-                        targetMenu.classList.add('show');
-                    }}
-                }}
-                window.onclick = function(event) {{
-                    if (!event.target.matches('.three-dots-btn')) {{
-                        var menus = document.getElementsByClassName("action-menu");
-                        for (var i = 0; i < menus.length; i++) {{
-                            var openMenu = menus[i];
-                            if (openMenu.classList.contains('show')) {{
-                                var parentItemActions = openMenu.closest('.item-actions');
-                                if (!parentItemActions || !parentItemActions.contains(event.target)) {{
-                                     openMenu.classList.remove('show');
-                                }}
-                            }}
-                        }}
-                    }}
-                }}
-                function showRenameForm(itemId, currentName) {{
-                    var displayDiv = document.getElementById('item-display-' + itemId);
-                    var formDiv = document.getElementById('rename-form-' + itemId);
-                    var input = document.getElementById('rename-input-' + itemId);
-                    if (!displayDiv || !formDiv || !input) return;
-                    var menu = document.getElementById('menu-' + itemId);
-                    if(menu) menu.classList.remove('show');
-                    displayDiv.style.display = 'none';
-                    formDiv.style.display = 'block';
-                    input.value = currentName;
-                    setTimeout(function() {{ input.focus(); input.select(); }}, 50);
-                }}
-                function hideRenameForm(itemId) {{
-                    var displayDiv = document.getElementById('item-display-' + itemId);
-                    var formDiv = document.getElementById('rename-form-' + itemId);
-                    if (!displayDiv || !formDiv) return;
-                    formDiv.style.display = 'none';
-                    displayDiv.style.display = 'block';
-                }}
-                function confirmAndDelete(formId, itemName) {{
-                     var formElement = document.getElementById(formId);
-                     if (!formElement) return false;
-                     var menu = formElement.closest('.item')?.querySelector('.action-menu');
-                     if(menu) menu.classList.remove('show');
-                     if (confirm(Are you sure you want to delete '${{itemName}}'? This cannot be undone.)) {{
-                         formElement.submit();
-                     }}
-                     return false;
-                }}
-                 function handleMenuAction(menuId, actionFn) {{
-                      actionFn();
-                      var menu = document.getElementById(menuId);
-                      if (menu) menu.classList.remove('show');
-                 }}
-                 function filterItems() {{
-                    var searchTerm = document.getElementById('search-input').value.toLowerCase();
-                    var items = document.getElementsByClassName('searchable-item');
-                    var matchFound = false;
-                    for (var i = 0; i < items.length; i++) {{
-                        var itemName = items[i].getAttribute('data-name')?.toLowerCase() || '';
-                        if (itemName.includes(searchTerm)) {{
-                            items[i].classList.remove('hidden');
-                            matchFound = true;
-                        }} else {{
-                            items[i].classList.add('hidden');
-                        }}
-                    }}
-                 }}
-            </script>
+            <link rel="stylesheet" href="{static_url('drive.css')}">
+            <script src="{static_url('drive.js')}" defer></script>
         </head>
         <body>
             <div class="container">
@@ -465,95 +4724,310 @@ class GDriveHandler(SimpleHTTPRequestHandler):
                 {breadcrumb_nav_html}
                 <div class="upload-section">
                     <form enctype="multipart/form-data" method="post" action="/upload?path={urllib.parse.quote(current_rel_path)}">
-                        <input type="file" name="file" id="file" style="display:none" onchange="document.getElementById('upload-status').innerText = 'Uploading ' + this.files[0].name + '...'; this.form.submit();">
-                        <button type="button" class="upload-btn" onclick="document.getElementById('file').click()">⬆ Upload File Here</button>
+                        <input type="file" name="file" id="file" multiple style="display:none" onchange="uploadFiles(this)">
+                        <input type="file" name="file" id="folder-picker" webkitdirectory multiple style="display:none" onchange="uploadFiles(this)">
+                        <button type="button" class="upload-btn" onclick="document.getElementById('file').click()">⬆ Upload Files Here</button>
+                        <button type="button" class="upload-btn" onclick="document.getElementById('folder-picker').click()">📂 Upload Folder</button>
                         <span id="upload-status"></span>
                     </form>
+                    <div class="zip-actions">
+                        <a class="zip-link" href="/_api/zip?path={urllib.parse.quote(current_rel_path.replace(os.sep, '/'), safe='')}">⬇ Download this folder as ZIP</a>
+                        <button type="button" id="zip-selected-btn" class="upload-btn" style="display:none" onclick="downloadSelected()"></button>
+                    </div>
                 </div>
                 <div class="search-section">
                     <input type="search" id="search-input" placeholder="🔍 Search this folder..." oninput="filterItems()" aria-label="Search items in current folder">
+                    <label class="search-scope"><input type="checkbox" id="search-everywhere" onchange="filterItems()"> All folders</label>
+                    <select id="sort-select" onchange="changeSort()" aria-label="Sort items">
+                        <option value="name:asc">Name (A–Z)</option>
+                        <option value="name:desc">Name (Z–A)</option>
+                        <option value="mtime:desc">Newest first</option>
+                        <option value="mtime:asc">Oldest first</option>
+                        <option value="size:desc">Largest first</option>
+                        <option value="size:asc">Smallest first</option>
+                        <option value="type:asc">Type</option>
+                    </select>
                 </div>
-                <div class="item-grid">
-        """
-        item_counter = 0
-        for item_list, item_type in [(dirs, 'folder'), (files, 'file')]:
-            for item_info in item_list:
-                name = item_info['name']
-                html_safe_name = html.escape(name, quote=True)
-                js_safe_name = name.replace("'", "\\'")
-                rel_path = item_info['rel_path']
-                link = '/' + urllib.parse.quote(rel_path)
-                item_id = f"{item_type}-{item_counter}"
-                menu_id = f"menu-{item_id}"
-                delete_form_id = f"delete-form-{item_id}"
-                rename_form_id = f"rename-form-{item_id}"
-                item_counter += 1
-
-                html_content += f"""
-                    <div class="item {item_type} searchable-item" data-name="{html_safe_name}">
-                        <div class="item-actions">
-                            <button class="three-dots-btn" onclick="event.stopPropagation(); toggleMenu('{menu_id}');" aria-label="Actions for {html_safe_name}" title="Actions">⋮</button>
-                            <div id="{menu_id}" class="action-menu">
-                                <button type="button" class="action-menu-item" onclick="handleMenuAction('{menu_id}', function() {{ showRenameForm('{item_id}', '{js_safe_name}') }})">Rename</button>
-                                <button type="button" class="action-menu-item delete" onclick="confirmAndDelete('{delete_form_id}', '{js_safe_name}')">Delete</button>
-                            </div>
-                        </div>
-                        <div id="item-display-{item_id}">
-                            <a href="{link}" {'target="_blank" rel="noopener noreferrer"' if item_type == 'file' else ''} class="item-link" title="{html_safe_name}">
-                """
-                if item_type == 'folder':
-                     icon = "https://img.icons8.com/color/96/000000/folder-invoices.png"
-                     html_content += f'<img src="{icon}" alt="Folder icon" loading="lazy"/>'
-                     html_content += f'<div class="item-name">{html_safe_name}</div>'
-                else:
-                     size = item_info['size']
-                     mtime = item_info['mtime']
-                     ext = os.path.splitext(name)[1].lower()
-                     file_icon = 'https://img.icons8.com/fluency/96/000000/document.png'
-                     if ext == '.pdf': file_icon = 'https://img.icons8.com/fluency/96/000000/pdf.png'
-                     elif ext in ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'): file_icon = 'https://img.icons8.com/fluency/96/000000/image.png'
-                     elif ext in ('.mp3', '.wav', '.ogg', '.m4a'): file_icon = 'https://img.icons8.com/fluency/96/000000/audio-file.png'
-                     elif ext in ('.mp4', '.mov', '.avi', '.mkv'): file_icon = 'https://img.icons8.com/fluency/96/000000/video-file.png'
-                     elif ext in ('.zip', '.rar', '.7z', '.tar', '.gz'): file_icon = 'https://img.icons8.com/fluency/96/000000/zip.png'
-                     elif ext in ('.txt', '.md', '.log'): file_icon = 'https://img.icons8.com/fluency/96/000000/txt.png'
-                     html_content += f'<img src="{file_icon}" alt="File icon for {ext}" loading="lazy"/>'
-                     html_content += f'<div class="item-name">{html_safe_name}</div>'
-                     html_content += f'<div class="meta">{size:.2f} MB | {mtime}</div>'
-                html_content += """
-                            </a>
-                        </div>
-                        """
-                html_content += f"""
-                        <div id="{rename_form_id}" class="rename-form">
-                             <form method="post" action="/rename" aria-labelledby="rename-heading-{item_id}">
-                                 <input type="hidden" name="old_path" value="{urllib.parse.quote(rel_path)}">
-                                 <label for="rename-input-{item_id}" style="display:none;" id="rename-heading-{item_id}">New name for {html_safe_name}</label>
-                                 <input type="text" id="rename-input-{item_id}" name="new_name" required aria-required="true"><br>
-                                 <button type="submit" class="save-btn">Save</button>
-                                 <button type="button" class="cancel-btn" onclick="hideRenameForm('{item_id}')">Cancel</button>
-                             </form>
-                         </div>
-                        """
-                html_content += f"""
-                         <form id="{delete_form_id}" method="post" action="/delete" style="display: none;" aria-hidden="true">
-                             <input type="hidden" name="path" value="{urllib.parse.quote(rel_path)}">
-                         </form>
-                    </div>
-                """
-        html_content += """
-                </div>
+                <div id="empty-folder">This folder is empty.</div>
+                <div id="item-grid" class="item-grid"></div>
             </div>
+            <script id="listing-data" type="application/json">{initial_page_json}</script>
         </body>
         </html>
         """
         return html_content.encode('utf-8')
 
+    def handle_static(self, path):
+        asset = STATIC_ASSETS.get(path)
+        if asset is None: self.send_error(404, "Unknown static file"); return
+        content_type, body, etag, variants = asset
+        cache_control = cache_policy_for('static')
+        if etag_matches(self.headers.get('If-None-Match', ''), etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', cache_control)
+            self.end_headers()
+            return
+        self._send_body(200, content_type, body, {'ETag': etag, 'Cache-Control': cache_control}, variants)
+
+    def _content_disposition(self, abs_path, content_type):
+        disposition = 'inline' if content_type.startswith(('image/', 'text/', 'application/pdf')) else 'attachment'
+        safe_filename = os.path.basename(abs_path)
+        try:
+             safe_filename.encode('latin-1')
+             filename_header = f'filename="{safe_filename}"'
+        except UnicodeEncodeError:
+             encoded_filename = urllib.parse.quote(safe_filename)
+             filename_header = f"filename*=UTF-8''{encoded_filename}"
+        return f'{disposition}; {filename_header}'
+
+    def _is_not_modified(self, etag, mtime):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return etag_matches(if_none_match, etag)
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is None:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return since is not None and int(mtime) <= since.timestamp()
+
+    def _send_not_modified(self, etag, mtime, cache_control):
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(mtime))
+        self.send_header('Cache-Control', cache_control)
+        self.end_headers()
+
+    def _if_range_allows_partial(self, etag, mtime):
+        if_range = self.headers.get('If-Range')
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith(('"', 'W/')):
+            # Weak validators never match for If-Range.
+            return if_range == etag
+        try:
+            since = email.utils.parsedate_to_datetime(if_range)
+        except (TypeError, ValueError):
+            return False
+        return since is not None and int(since.timestamp()) == int(mtime)
+
+    def _can_sendfile(self):
+        # SSL-wrapped sockets are socket.socket subclasses and need userspace copies.
+        return USE_SENDFILE and hasattr(os, 'sendfile') and type(self.connection) is socket.socket
+
+    def _send_file_range(self, f, start, length):
+        if length <= 0 or self.command == 'HEAD':
+            return 0
+        throttled = bandwidth.enabled
+        if throttled and not self.bulk_transfer:
+            self._throttle(length)  # interactive: charged up front, never waits
+            throttled = False
+        if self._can_sendfile():
+            self.wfile.flush()
+            step = THROTTLE_CHUNK_SIZE if throttled else SENDFILE_CHUNK_SIZE
+            sent_total = 0
+            try:
+                while sent_total < length:
+                    n = min(step, length - sent_total)
+                    if throttled:
+                        self._throttle(n)
+                    sent = self.connection.sendfile(f, start + sent_total, n)
+                    if not sent:
+                        break
+                    sent_total += sent
+            finally:
+                self._connection_wfile.bytes_written += sent_total
+            return sent_total
+
+        view = _transfer_buffer()
+        if throttled:
+            view = view[:THROTTLE_CHUNK_SIZE]
+        f.seek(start)
+        sent_total = 0
+        while sent_total < length:
+            n = f.readinto(view[:min(len(view), length - sent_total)])
+            if not n:
+                break
+            if throttled:
+                self._throttle(n)
+            self.wfile.write(view[:n])
+            sent_total += n
+        return sent_total
+
+    def _serve_file(self, abs_path):
+        try:
+            f = open(abs_path, 'rb', buffering=0)
+        except FileNotFoundError: self.send_error(404, "File Not Found"); return
+        except PermissionError: self.send_error(403, "Permission Denied"); return
+        except OSError as e:
+            log_event('download', f"Error opening file {abs_path}: {e}", level='error', path=abs_to_rel(abs_path))
+            self.send_error(500, "Server error serving file")
+            return
+
+        with f:
+            st = os.fstat(f.fileno())
+            file_size = st.st_size
+            content_type = self.guess_type(abs_path)
+            etag = file_etag(st)
+            cache_control = cache_policy_for(content_type)
+
+            # Ranges always address the identity encoding.
+            encoding = None
+            if file_size >= COMPRESSION_MIN_SIZE and not self.headers.get('Range'):
+                encoding = self._negotiate_encoding(content_type, abs_path)
+                if encoding:
+                    etag = f'{etag[:-1]}-{encoding}"'
+
+            if self._is_not_modified(etag, st.st_mtime):
+                self._send_not_modified(etag, st.st_mtime, cache_control)
+                return
+
+            if encoding:
+                self._send_compressed_file(f, st, abs_path, content_type, etag, cache_control, encoding)
+                return
+
+            ranges = None
+            range_header = self.headers.get('Range')
+            if range_header and self._if_range_allows_partial(etag, st.st_mtime):
+                ranges = parse_byte_ranges(range_header, file_size)
+                if ranges == []:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{file_size}')
+                    self.send_header('Accept-Ranges', 'bytes')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+            requested = sum(end - start + 1 for start, end in ranges) if ranges else file_size
+            self.bulk_transfer = requested > BULK_TRANSFER_SIZE
+            if ranges:
+                self.send_response(206)
+            else:
+                self.send_response(200)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.date_time_string(st.st_mtime))
+            self.send_header('Cache-Control', cache_control)
+            self.send_header('Content-Disposition', self._content_disposition(abs_path, content_type))
+            if COMPRESSION_ENABLED and is_compressible(content_type, abs_path):
+                self.send_header('Vary', 'Accept-Encoding')
+
+            try:
+                if not ranges:
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(file_size))
+                    self.end_headers()
+                    self._send_file_range(f, 0, file_size)
+                elif len(ranges) == 1:
+                    start, end = ranges[0]
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{file_size}')
+                    self.send_header('Content-Length', str(end - start + 1))
+                    self.end_headers()
+                    self._send_file_range(f, start, end - start + 1)
+                else:
+                    boundary = base64.b16encode(os.urandom(12)).decode('ascii')
+                    part_headers = [
+                        (f'--{boundary}\r\nContent-Type: {content_type}\r\n'
+                         f'Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n').encode('latin-1')
+                        for start, end in ranges
+                    ]
+                    closing = f'--{boundary}--\r\n'.encode('latin-1')
+                    total = len(closing) + sum(len(h) + (end - start + 1) + 2 for h, (start, end) in zip(part_headers, ranges))
+                    self.send_header('Content-Type', f'multipart/byteranges; boundary={boundary}')
+                    self.send_header('Content-Length', str(total))
+                    self.end_headers()
+                    for header_bytes, (start, end) in zip(part_headers, ranges):
+                        self.wfile.write(header_bytes)
+                        self._send_file_range(f, start, end - start + 1)
+                        self.wfile.write(b'\r\n')
+                    self.wfile.write(closing)
+            except (BrokenPipeError, ConnectionResetError):
+                log_event('disconnect', f"Client disconnected while downloading {abs_path}", path=abs_to_rel(abs_path))
+
+    def _send_compressed_file(self, f, st, abs_path, content_type, etag, cache_control, encoding):
+        self.bulk_transfer = st.st_size > BULK_TRANSFER_SIZE
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Encoding', encoding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(st.st_mtime))
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('Content-Disposition', self._content_disposition(abs_path, content_type))
+
+        cached_path = compressed_cache.lookup(etag)
+        if cached_path is not None:
+            try:
+                cached = open(cached_path, 'rb', buffering=0)
+            except OSError:
+                cached = None
+            if cached is not None:
+                with cached:
+                    size = os.fstat(cached.fileno()).st_size
+                    self.send_header('Content-Length', str(size))
+                    self.end_headers()
+                    try:
+                        self._send_file_range(cached, 0, size)
+                    except (BrokenPipeError, ConnectionResetError):
+                        log_event('disconnect', f"Client disconnected while downloading {abs_path}", path=abs_to_rel(abs_path))
+                return
+
+        # Not cached yet: compress while sending. The length is unknown up
+        # front, so the body goes out chunked. Popular files are written to
+        # the cache at the same time.
+        stream = self._start_stream()
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        writer = None
+        if compressed_cache.should_store(etag, st.st_size):
+            try:
+                cache_path, writer = compressed_cache.open_writer(etag)
+            except OSError:
+                writer = None
+        compressor = compressor_for(encoding)
+        view = _transfer_buffer()
+        try:
+            while True:
+                n = f.readinto(view)
+                if not n:
+                    break
+                out = compressor.compress(view[:n])
+                if out:
+                    stream.write(out)
+                    if writer: writer.write(out)
+            out = compressor.flush()
+            stream.write(out)
+            stream.close()
+            if writer:
+                writer.write(out)
+                compressed_cache.commit(cache_path, writer)
+                writer = None
+        except (BrokenPipeError, ConnectionResetError):
+            log_event('disconnect', f"Client disconnected while downloading {abs_path}", path=abs_to_rel(abs_path))
+            self.close_connection = True
+        finally:
+            if writer:
+                compressed_cache.discard(writer)
+
     def do_GET(self):
         if not self._is_authenticated():
             self._require_auth()
             return
 
         parsed_path = urllib.parse.urlparse(self.path)
+        if parsed_path.path.startswith(API_PREFIX):
+            self._dispatch_api('GET', parsed_path)
+            return
+        if parsed_path.path.startswith(STATIC_PREFIX):
+            self.route = 'static'
+            self.handle_static(parsed_path.path)
+            return
         lookup_rel_path = parsed_path.path
         validation_result = self._get_validated_path(lookup_rel_path)
 
@@ -564,41 +5038,33 @@ class GDriveHandler(SimpleHTTPRequestHandler):
              abs_path, rel_path = validation_result
 
         if os.path.isdir(abs_path):
-            content = self.list_directory_html(abs_path)
-            if content:
-                 self.send_response(200)
-                 self.send_header('Content-type', 'text/html; charset=utf-8')
-                 self.send_header('Content-Length', str(len(content)))
-                 self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-                 self.send_header('Pragma', 'no-cache')
-                 self.send_header('Expires', '0')
-                 self.end_headers()
-                 self.wfile.write(content)
+            self.route = 'listing'
+            started = time.perf_counter()
+            listing = self._read_directory(abs_path)
+            if listing is None:
+                return
+            current_rel_path, snapshot = listing
+            etag, last_modified = listing_validators(current_rel_path, snapshot)
+            cache_control = cache_policy_for('listing')
+            stat_done = time.perf_counter()
+            metrics.listing_phase('stat', stat_done - started)
+            if self._is_not_modified(etag, last_modified):
+                self._send_not_modified(etag, last_modified, cache_control)
+                return
+            content = self.list_directory_html(current_rel_path, snapshot)
+            rendered = time.perf_counter()
+            metrics.listing_phase('render', rendered - stat_done)
+            self._send_body(200, 'text/html; charset=utf-8', content, {
+                'ETag': etag,
+                'Last-Modified': self.date_time_string(last_modified),
+                'Cache-Control': cache_control,
+            })
+            metrics.listing_phase('write', time.perf_counter() - rendered)
 
         elif os.path.isfile(abs_path):
-            try:
-                file_size = os.path.getsize(abs_path)
-                self.send_response(200)
-                content_type = self.guess_type(abs_path)
-                self.send_header('Content-Type', content_type)
-                self.send_header('Content-Length', str(file_size))
-                disposition = 'inline' if content_type.startswith(('image/', 'text/', 'application/pdf')) else 'attachment'
-                safe_filename = os.path.basename(abs_path)
-                try:
-                     safe_filename.encode('latin-1')
-                     filename_header = f'filename="{safe_filename}"'
-                except UnicodeEncodeError:
-                     encoded_filename = urllib.parse.quote(safe_filename)
-                     filename_header = f"filename*=UTF-8''{encoded_filename}"
-                self.send_header('Content-Disposition', f'{disposition}; {filename_header}')
-                self.end_headers()
-                with open(abs_path, 'rb') as f:
-                    shutil.copyfileobj(f, self.wfile)
-            except FileNotFoundError: self.send_error(404, "File Not Found")
-            except PermissionError: self.send_error(403, "Permission Denied")
-            except Exception as e:
-                 print(f"Error serving file {abs_path}: {e}")
-                 self.send_error(500, "Server error serving file")
+            self.route = 'download'
+            with metrics.transfer('download'):
+                self._serve_file(abs_path)
         else:
             self.send_error(404, "Not Found")
 
@@ -611,6 +5077,10 @@ class GDriveHandler(SimpleHTTPRequestHandler):
         action_path = parsed_path.path
         content_type_header = self.headers.get('Content-Type', '')
 
+        if action_path.startswith(API_PREFIX):
+            self._dispatch_api('POST', parsed_path)
+            return
+
         if not content_type_header.startswith(('multipart/form-data', 'application/x-www-form-urlencoded')):
              self.send_error(415, "Unsupported Media Type")
              return
@@ -624,25 +5094,535 @@ class GDriveHandler(SimpleHTTPRequestHandler):
                      if action_path == '/upload': self.send_error(400, "Invalid Content-Length header"); return
             if action_path == '/upload' and content_length <= 0 : self.send_error(411, "Length Required for Upload"); return
 
-            form = cgi.FieldStorage(
-                fp=self.rfile,
-                headers=self.headers,
-                environ={'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': content_type_header},
-                keep_blank_values=True
-            )
+            if content_type_header.startswith('multipart/form-data'):
+                boundary = multipart_boundary(content_type_header)
+                if boundary is None: self.send_error(400, "Missing multipart boundary"); return
+                parts = MultipartReader(self.body, boundary, max(content_length, 0))
+            else:
+                if action_path == '/upload': self.send_error(400, "Uploads must be sent as multipart/form-data."); return
+                if content_length > MAX_FORM_FIELD_SIZE: self.send_error(413, "Form data too large"); return
+                parts = None
+                form = FormData.from_urlencoded(self.body.read())
+
+            if action_path == '/upload':
+                self.route = 'upload'
+                with metrics.transfer('upload'):
+                    self.handle_upload(parts, content_length, parsed_path.query)
+                return
+            if parts is not None:
+                form = parts.collect_fields()
 
-            if action_path == '/upload': self.handle_upload(form, content_length, parsed_path.query)
-            elif action_path == '/delete': self.handle_delete(form)
-            elif action_path == '/rename': self.handle_rename(form)
+            if action_path == '/delete': self.route = 'delete'; self.handle_delete(form)
+            elif action_path == '/rename': self.route = 'rename'; self.handle_rename(form)
             else: self.send_error(404, "Invalid POST endpoint.")
+        except MultipartError as e:
+            log_event('bad_request', f"Malformed form data in POST to {action_path}: {e}", level='warning', path=action_path)
+            self.send_error(400, f"Malformed form data: {e}")
         except Exception as e:
-            print(f"Critical Error processing POST to {action_path}: {e}")
             import traceback
-            traceback.print_exc()
+            log_event('error', f"Critical Error processing POST to {action_path}: {e}", level='error',
+                      path=action_path, traceback=traceback.format_exc())
             self.send_error(500, "Internal Server Error processing request.")
 
-    def handle_upload(self, form, content_length, query_string):
-        if content_length > MAX_UPLOAD_SIZE: self.send_error(413, f"File Too Large (Limit: {MAX_UPLOAD_SIZE // (1024*1024)} MB)"); return
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_PUT(self):
+        self._handle_api_only('PUT')
+
+    def do_PATCH(self):
+        self._handle_api_only('PATCH')
+
+    def do_DELETE(self):
+        self._handle_api_only('DELETE')
+
+    def _handle_api_only(self, method):
+        if not self._is_authenticated():
+            self._require_auth()
+            return
+        parsed_path = urllib.parse.urlparse(self.path)
+        if not parsed_path.path.startswith(API_PREFIX):
+            self.send_error(405, f"{method} is only supported on {API_PREFIX} endpoints.")
+            return
+        self._dispatch_api(method, parsed_path)
+
+    def _request_length(self):
+        try:
+            return int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            return None
+
+    def _read_api_params(self, parsed_path, multi=False):
+        # Small parameter sets for API calls: query string plus an optional
+        # urlencoded or JSON body. With multi=True every form value is a list.
+        pick = (lambda v: v) if multi else (lambda v: v[0])
+        params = {k: pick(v) for k, v in urllib.parse.parse_qs(parsed_path.query, keep_blank_values=True).items()}
+        length = self._request_length() or 0
+        if length > MAX_FORM_FIELD_SIZE:
+            raise ValueError("Request body too large")
+        if length > 0:
+            body = self.body.read(length)
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                data = json.loads(body.decode('utf-8'))
+                if not isinstance(data, dict):
+                    raise ValueError("Expected a JSON object")
+                params.update({k: v for k, v in data.items() if v is not None})
+            else:
+                for k, v in urllib.parse.parse_qs(body.decode('utf-8', 'replace'), keep_blank_values=True).items():
+                    params[k] = params.get(k, []) + v if multi else v[0]
+        return params
+
+    def _dispatch_api(self, method, parsed_path):
+        route = parsed_path.path[len(API_PREFIX):].strip('/').split('/')
+        if route[0] in ('uploads', 'jobs', 'sync', 'events', 'list', 'search', 'usage', 'duplicates', 'thumb', 'zip', 'metrics'):
+            self.route = 'api_' + route[0]
+        try:
+            if route[0] == 'uploads':
+                self.handle_upload_session(method, route[1:], parsed_path)
+            elif route[0] == 'jobs':
+                self.handle_jobs_api(method, route[1:], parsed_path)
+            elif route[0] == 'sync':
+                self.handle_sync_api(method, route[1:], parsed_path)
+            elif route == ['events'] and method == 'GET':
+                self.handle_events_api(parsed_path)
+            elif route == ['list'] and method == 'GET':
+                self.handle_list_api(parsed_path)
+            elif route == ['search'] and method == 'GET':
+                self.handle_search_api(parsed_path)
+            elif route == ['usage'] and method == 'GET':
+                self.handle_usage_api(parsed_path)
+            elif route == ['duplicates'] and method == 'GET':
+                self.handle_duplicates_api(parsed_path)
+            elif route == ['thumb'] and method == 'GET':
+                self.handle_thumbnail_api(parsed_path)
+            elif route == ['zip'] and method in ('GET', 'POST'):
+                self.handle_zip_api(parsed_path)
+            elif route == ['metrics'] and method == 'GET':
+                self.handle_metrics_api()
+            else:
+                self._send_json_response(404, {'error': 'Unknown API endpoint'})
+        except (ValueError, TypeError, UnicodeDecodeError) as e:
+            self._send_json_response(400, {'error': str(e)})
+        except Exception as e:
+            import traceback
+            log_event('error', f"Critical Error processing {method} {parsed_path.path}: {e}", level='error',
+                      path=parsed_path.path, traceback=traceback.format_exc())
+            self._send_json_response(500, {'error': 'Internal Server Error processing request.'})
+
+    def handle_list_api(self, parsed_path):
+        params = {k: v[0] for k, v in urllib.parse.parse_qs(parsed_path.query).items()}
+        validation_result = self._get_validated_path(params.get('path', ''))
+        if validation_result is None: self._send_json_response(403, {'error': 'Invalid path'}); return
+        abs_path, _ = validation_result
+        if not os.path.isdir(abs_path): self._send_json_response(404, {'error': 'Directory Not Found'}); return
+
+        sort = params.get('sort', 'name')
+        if sort not in LISTING_SORT_KEYS: raise ValueError(f"sort must be one of: {', '.join(LISTING_SORT_KEYS)}")
+        order = params.get('order', 'asc')
+        if order not in ('asc', 'desc'): raise ValueError("order must be 'asc' or 'desc'")
+        limit = min(max(int(params.get('limit', LISTING_PAGE_SIZE)), 1), MAX_LISTING_PAGE_SIZE)
+
+        try:
+            snapshot = listing_cache.get(abs_path)
+        except PermissionError: self._send_json_response(403, {'error': 'Permission Denied to list directory'}); return
+        except FileNotFoundError: self._send_json_response(404, {'error': 'Directory Not Found'}); return
+
+        current_rel_path = os.path.relpath(abs_path, UPLOAD_DIR)
+        current_rel_path = '' if current_rel_path == '.' else current_rel_path.replace(os.sep, '/')
+        listing_etag, last_modified = listing_validators(current_rel_path, snapshot)
+        etag = f'{listing_etag[:-1]}-{hashlib.sha1(parsed_path.query.encode("utf-8")).hexdigest()[:8]}"'
+        cache_control = cache_policy_for('listing')
+        if self._is_not_modified(etag, last_modified):
+            self._send_not_modified(etag, last_modified, cache_control)
+            return
+        page = listing_page(snapshot, current_rel_path, sort, order == 'desc', params.get('q', ''),
+                            params.get('cursor'), int(params.get('offset', 0)), limit)
+        self._send_json_response(200, page, {'ETag': etag, 'Cache-Control': cache_control})
+
+    def handle_events_api(self, parsed_path):
+        # Server-Sent Events for one folder; see folder_events for the
+        # messages. Each carries an id, which the browser sends back as
+        # Last-Event-ID when it reconnects.
+        if not EVENTS_ENABLED: self._send_json_response(404, {'error': 'Live updates are disabled'}); return
+        params = {k: v[0] for k, v in urllib.parse.parse_qs(parsed_path.query).items()}
+        validation_result = self._get_validated_path(params.get('path', ''))
+        if validation_result is None: self._send_json_response(403, {'error': 'Invalid path'}); return
+        abs_path, _ = validation_result
+        if not os.path.isdir(abs_path): self._send_json_response(404, {'error': 'Directory Not Found'}); return
+        if not isinstance(self.server, (PooledHTTPServer, ThreadingHTTPServer)):
+            # One request at a time: a stream would block everyone else. 204
+            # tells the browser not to reconnect.
+            self._send_body(204, 'text/event-stream', b'', {'Cache-Control': 'no-store'})
+            return
+        rel_dir = abs_to_rel(abs_path)
+        last_id = self.headers.get('Last-Event-ID', params.get('last_event_id'))
+        after = change_feed.parse_id(last_id) if last_id else change_feed.last_id
+        opened = change_feed.open_stream()
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        if not opened:
+            # Too many open streams; the browser tries again later.
+            self.wfile.write(b'retry: 15000\n\n')
+            return
+        try:
+            self.wfile.write(b'retry: 3000\n\n')
+            if after is None:
+                after = change_feed.last_id
+                self.wfile.write(f"id: {change_feed.epoch}-{after}\nevent: reload\ndata: {{}}\n\n".encode('utf-8'))
+            deadline = time.monotonic() + EVENT_STREAM_TIMEOUT
+            quiet_since = time.monotonic()
+            while time.monotonic() < deadline and self._may_keep_alive():
+                batch = change_feed.wait(after, 1)
+                if batch is None:
+                    after = change_feed.last_id
+                    messages = [('reload', {})]
+                else:
+                    if batch:
+                        after = batch[-1][0]
+                    messages = folder_events(rel_dir, [event for _, event in batch])
+                if messages:
+                    self.wfile.write(''.join(f"id: {change_feed.epoch}-{after}\nevent: {name}\ndata: {json.dumps(data)}\n\n"
+                                             for name, data in messages).encode('utf-8'))
+                    quiet_since = time.monotonic()
+                elif time.monotonic() - quiet_since >= EVENT_HEARTBEAT_INTERVAL:
+                    self.wfile.write(b': ping\n\n')  # also finds out when the browser has gone
+                    quiet_since = time.monotonic()
+                readable, _, _ = select.select([self.connection], [], [], 0)
+                if readable and not self.rfile.peek(1):
+                    break  # the browser closed the connection
+        except OSError:
+            pass
+        finally:
+            change_feed.close_stream()
+
+    def handle_usage_api(self, parsed_path):
+        if not DISK_USAGE_ENABLED: self._send_json_response(404, {'error': 'Folder sizes are disabled'}); return
+        params = {k: v[0] for k, v in urllib.parse.parse_qs(parsed_path.query).items()}
+        validation_result = self._get_validated_path(params.get('path', ''))
+        if validation_result is None: self._send_json_response(403, {'error': 'Invalid path'}); return
+        abs_path, _ = validation_result
+        if not os.path.isdir(abs_path): self._send_json_response(404, {'error': 'Directory Not Found'}); return
+        if not disk_usage.ready: self._send_json_response(503, {'error': 'Folder sizes are still being computed'}, {'Retry-After': '5'}); return
+
+        sort = params.get('sort', 'size')
+        if sort not in ('size', 'files', 'name'): raise ValueError("sort must be 'size', 'files' or 'name'")
+        order = params.get('order', 'asc' if sort == 'name' else 'desc')
+        if order not in ('asc', 'desc'): raise ValueError("order must be 'asc' or 'desc'")
+        limit = min(max(int(params.get('limit', USAGE_RESULT_LIMIT)), 1), MAX_USAGE_RESULT_LIMIT)
+        depth = int(params['depth']) if params.get('depth') else None
+        if depth is not None and depth < 1: raise ValueError("depth must be at least 1")
+
+        current_rel_path = os.path.relpath(abs_path, UPLOAD_DIR)
+        current_rel_path = '' if current_rel_path == '.' else current_rel_path.replace(os.sep, '/')
+        result = disk_usage.largest(current_rel_path, 'bytes' if sort == 'size' else sort, order == 'desc', depth, limit)
+        if result is None: self._send_json_response(404, {'error': 'Directory Not Found'}); return
+        self._send_json_response(200, result)
+
+    def handle_duplicates_api(self, parsed_path):
+        if not DEDUP_ENABLED: self._send_json_response(404, {'error': 'Duplicate detection is disabled'}); return
+        params = {k: v[0] for k, v in urllib.parse.parse_qs(parsed_path.query).items()}
+        validation_result = self._get_validated_path(params.get('path', ''))
+        if validation_result is None: self._send_json_response(403, {'error': 'Invalid path'}); return
+        abs_path, _ = validation_result
+        if not os.path.isdir(abs_path): self._send_json_response(404, {'error': 'Directory Not Found'}); return
+        limit = min(max(int(params.get('limit', DUPLICATES_RESULT_LIMIT)), 1), MAX_USAGE_RESULT_LIMIT)
+        self._send_json_response(200, dedup.duplicates(abs_to_rel(abs_path), limit))
+
+    def handle_thumbnail_api(self, parsed_path):
+        if not THUMBNAILS_ENABLED: self._send_json_response(404, {'error': 'Thumbnails are disabled'}); return
+        params = {k: v[0] for k, v in urllib.parse.parse_qs(parsed_path.query).items()}
+        validation_result = self._get_validated_path(params.get('path'))
+        if validation_result is None: self._send_json_response(403, {'error': 'Invalid path'}); return
+        abs_path, _ = validation_result
+        try:
+            st = os.stat(abs_path)
+        except OSError: self._send_json_response(404, {'error': 'File Not Found'}); return
+        if not os.path.isfile(abs_path): self._send_json_response(404, {'error': 'File Not Found'}); return
+        kind = thumbnails.kind(abs_path)
+        if kind is None: self._send_json_response(415, {'error': 'No thumbnails for this file type'}); return
+        if kind == 'image' and st.st_size > THUMBNAIL_MAX_SOURCE_SIZE: self._send_json_response(413, {'error': 'Image too large for a thumbnail'}); return
+
+        # Pages ask for /_api/thumb?path=…&v=<size>-<mtime>, so the URL changes
+        # with the file and can be cached for good.
+        etag = f'"{thumbnails.key(st)}"'
+        cache_control = cache_policy_for('thumbnail' if params.get('v') else 'image/')
+        if self._is_not_modified(etag, st.st_mtime):
+            self._send_not_modified(etag, st.st_mtime, cache_control)
+            return
+        data = thumbnails.get(abs_path, st, kind)
+        if data is None: self._send_json_response(404, {'error': 'Thumbnail could not be generated'}); return
+        self._send_body(200, 'image/jpeg', data, {
+            'ETag': etag,
+            'Last-Modified': self.date_time_string(st.st_mtime),
+            'Cache-Control': cache_control,
+        })
+
+    def handle_zip_api(self, parsed_path):
+        params = self._read_api_params(parsed_path, multi=True)
+        selected = params.get('path') or ['']
+        if isinstance(selected, str):
+            selected = [selected]
+        if len(selected) > ZIP_MAX_SELECTION: self._send_json_response(400, {'error': f'At most {ZIP_MAX_SELECTION} items per archive'}); return
+        abs_paths = []
+        for path_param in selected:
+            validation_result = self._get_validated_path(path_param)
+            if validation_result is None: self._send_json_response(403, {'error': 'Invalid path'}); return
+            if not os.path.exists(validation_result[0]): self._send_json_response(404, {'error': f"'{path_param}' not found"}); return
+            abs_paths.append(validation_result[0])
+
+        if len(abs_paths) == 1:
+            archive_name = (os.path.basename(abs_paths[0]) if abs_paths[0] != UPLOAD_DIR else 'Drive') + '.zip'
+        else:
+            archive_name = 'download.zip'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Disposition', self._content_disposition(archive_name, 'application/zip'))
+        self.send_header('Cache-Control', 'no-store')
+        # The archive is produced on the fly, so its length is unknown.
+        self.bulk_transfer = True
+        stream = self._start_stream()
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        started = time.monotonic()
+        try:
+            with metrics.transfer('zip'):
+                count = write_zip_stream(stream, abs_paths)
+                stream.close()
+            log_event('zip', f"Streamed {archive_name} ({count} files) in {time.monotonic() - started:.1f}s",
+                      name=archive_name, files=count)
+        except (BrokenPipeError, ConnectionResetError):
+            log_event('disconnect', f"Client disconnected while downloading {archive_name}", name=archive_name)
+            self.close_connection = True
+        except Exception as e:
+            # Headers are out; all that's left is to cut the transfer short.
+            log_event('zip', f"Error while streaming {archive_name}: {e}", level='error', name=archive_name)
+            self.close_connection = True
+
+    def handle_metrics_api(self):
+        if not METRICS_ENABLED: self._send_json_response(404, {'error': 'Metrics are disabled'}); return
+        entries, cache_bytes, hits, misses = listing_cache.stats()
+        samples = [
+            ('drive_listing_cache_entries', 'gauge', 'Folders held in the listing cache.', entries),
+            ('drive_listing_cache_bytes', 'gauge', 'Estimated memory used by the listing cache.', cache_bytes),
+            ('drive_listing_cache_hits_total', 'counter', 'Folder reads answered from the listing cache.', hits),
+            ('drive_listing_cache_misses_total', 'counter', 'Folder reads that had to scan the folder.', misses),
+            ('drive_throttle_wait_seconds_total', 'counter', 'Time bulk transfers spent waiting for bandwidth.', round(bandwidth.waited, 3)),
+        ]
+        samples += [
+            ('drive_thumbnails_generated_total', 'counter', 'Thumbnails rendered.', thumbnails.generated),
+            ('drive_thumbnail_cache_hits_total', 'counter', 'Thumbnails served from the disk cache.', thumbnails.hits),
+            ('drive_thumbnail_failures_total', 'counter', 'Files that could not be thumbnailed.', thumbnails.failures),
+        ]
+        samples += [
+            ('drive_dedup_linked_files_total', 'counter', 'Uploads stored as a link to identical content.', dedup.linked_files),
+            ('drive_dedup_linked_bytes_total', 'counter', 'Bytes not written thanks to those links.', dedup.linked_bytes),
+        ]
+        job_counts = jobs.counts()
+        samples += [
+            ('drive_event_streams', 'gauge', 'Open live-update streams.', change_feed.streams),
+            ('drive_changes_merged_total', 'counter', 'Repeat reports of a queued change that were dropped.', change_bus.merged),
+            ('drive_jobs_queued', 'gauge', 'Background jobs waiting for a worker.', job_counts.get('queued', 0)),
+            ('drive_jobs_running', 'gauge', 'Background jobs in progress.', job_counts.get('running', 0)),
+        ]
+        if isinstance(self.server, PooledHTTPServer):
+            samples += [
+                ('drive_workers', 'gauge', 'Worker threads in the pool.', self.server.max_workers),
+                ('drive_busy_workers', 'gauge', 'Workers serving a connection.', self.server.active_connections),
+                ('drive_queued_connections', 'gauge', 'Connections waiting for a free worker.', self.server.waiting_connections()),
+            ]
+        body = metrics.render(samples).encode('utf-8')
+        self._send_body(200, 'text/plain; version=0.0.4; charset=utf-8', body, {'Cache-Control': 'no-store'})
+
+    def handle_search_api(self, parsed_path):
+        if not SEARCH_INDEX_ENABLED: self._send_json_response(404, {'error': 'Search index is disabled'}); return
+        params = {k: v[0] for k, v in urllib.parse.parse_qs(parsed_path.query).items()}
+
+        def number(name):
+            return float(params[name]) if params.get(name) else None
+
+        def date(name):
+            value = params.get(name)
+            if not value:
+                return None
+            try:
+                return float(value)
+            except ValueError:
+                return time.mktime(time.strptime(value, '%Y-%m-%d'))
+
+        extensions = None
+        if params.get('ext'):
+            extensions = {('.' + e.strip().lstrip('.')).lower() for e in params['ext'].split(',') if e.strip()}
+        kind = params.get('type')
+        if kind not in (None, 'file', 'folder'): raise ValueError("type must be 'file' or 'folder'")
+        limit = min(max(int(params.get('limit', SEARCH_RESULT_LIMIT)), 1), MAX_SEARCH_RESULT_LIMIT)
+        under = params.get('path')
+        if under and self._get_validated_path(under) is None: self._send_json_response(403, {'error': 'Invalid path'}); return
+
+        started = time.perf_counter()
+        result = search_index.search(params.get('q', ''), extensions, kind, number('min_size'), number('max_size'),
+                                     date('after'), date('before'), under, limit)
+        result['query'] = params.get('q', '')
+        result['took_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        self._send_json_response(200, result)
+
+    def handle_upload_session(self, method, route, parsed_path):
+        try:
+            if not route and method == 'POST':
+                params = self._read_api_params(parsed_path)
+                target_validation = self._get_validated_path(params.get('path', ''))
+                if target_validation is None: self._send_json_response(400, {'error': 'Invalid upload target directory.'}); return
+                target_abs_path, target_rel_path = target_validation
+                if not os.path.isdir(target_abs_path): self._send_json_response(404, {'error': 'Upload target directory does not exist.'}); return
+                filename = os.path.basename(str(params.get('filename', '')))
+                if not filename or filename in ('.', '..'): self._send_json_response(400, {'error': 'Missing or invalid filename.'}); return
+                size = params.get('size')
+                size = int(size) if size not in (None, '') else None
+                if size is not None and not 0 <= size <= MAX_RESUMABLE_UPLOAD_SIZE:
+                    self._send_json_response(413, {'error': f'Upload size must be at most {MAX_RESUMABLE_UPLOAD_SIZE} bytes.'})
+                    return
+                mtime = params.get('mtime')
+                session = upload_sessions.create(target_rel_path, filename, size, float(mtime) if mtime not in (None, '') else None)
+                log_event('upload', f"Started resumable upload {session['id']} for {filename} in /{target_rel_path}",
+                          session=session['id'], path=target_rel_path, filename=filename)
+                self._send_json_response(201, session)
+            elif len(route) == 1 and method == 'GET':
+                self._send_json_response(200, upload_sessions.status(route[0]))
+            elif len(route) == 1 and method in ('PATCH', 'PUT'):
+                length = self._request_length()
+                if length is None: self._send_json_response(411, {'error': 'Length Required for upload chunk'}); return
+                params = {k: v[0] for k, v in urllib.parse.parse_qs(parsed_path.query).items()}
+                offset = self.headers.get('Upload-Offset', params.get('offset'))
+                if offset is None: self._send_json_response(400, {'error': 'Missing Upload-Offset header or offset parameter'}); return
+                with metrics.transfer('upload'):
+                    session = upload_sessions.append(route[0], int(offset), self.body, length)
+                self._send_json_response(200, session)
+            elif len(route) == 2 and route[1] == 'finish' and method == 'POST':
+                session = upload_sessions.status(route[0])
+                target_validation = self._get_validated_path(session['path'])
+                if target_validation is None: self._send_json_response(400, {'error': 'Invalid upload target directory.'}); return
+                session = upload_sessions.finish(route[0], target_validation[0])
+                record_change('added', session['saved_as'])
+                log_event('upload', f"Saved {session['filename']} to /{session['path']} (resumable upload {session['id']})",
+                          session=session['id'], path=abs_to_rel(session['saved_as']), size=session.get('size'))
+                del session['saved_as']
+                self._send_json_response(200, session)
+            elif len(route) == 1 and method == 'DELETE':
+                upload_sessions.abort(route[0])
+                self._send_json_response(200, {'id': route[0], 'aborted': True})
+            else:
+                self._send_json_response(405, {'error': f'{method} not supported here'})
+        except UploadSessionError as e:
+            data = {'error': str(e)}
+            if e.offset is not None:
+                data['offset'] = e.offset
+            self._send_json_response(e.status, data)
+
+    def handle_jobs_api(self, method, route, parsed_path):
+        try:
+            if not route and method == 'GET':
+                self._send_json_response(200, {'jobs': jobs.list()})
+            elif not route and method == 'POST':
+                params = self._read_api_params(parsed_path)
+                validation_result = self._get_validated_path(params.get('path'))
+                if validation_result is None: self._send_json_response(403, {'error': 'Invalid path'}); return
+                abs_path, _ = validation_result
+                if abs_path == UPLOAD_DIR and params.get('kind') == 'delete': self._send_json_response(400, {'error': 'Cannot delete the root directory.'}); return
+                if not os.path.lexists(abs_path): self._send_json_response(404, {'error': 'Item not found'}); return
+                job = jobs.submit(str(params.get('kind', '')), abs_to_rel(abs_path))
+                self._send_json_response(202, job, {'Location': f"{API_PREFIX}jobs/{job['id']}"})
+            elif len(route) == 1 and method == 'GET':
+                self._send_json_response(200, jobs.status(route[0]))
+            elif len(route) == 1 and method == 'DELETE':
+                self._send_json_response(200, jobs.cancel(route[0]))
+            else:
+                self._send_json_response(405, {'error': f'{method} not supported here'})
+        except JobError as e:
+            self._send_json_response(e.status, {'error': str(e)})
+
+    def handle_sync_api(self, method, route, parsed_path):
+        params = {k: v[0] for k, v in urllib.parse.parse_qs(parsed_path.query).items()}
+        if not route and method == 'POST':
+            # The manifest can list tens of thousands of files, so it is read
+            # here rather than by _read_api_params, and may be gzipped.
+            length = self._request_length()
+            if length is None: self._send_json_response(411, {'error': 'Length Required for the manifest'}); return
+            if length > MAX_SYNC_MANIFEST_SIZE: self._send_json_response(413, {'error': f'Manifest larger than {MAX_SYNC_MANIFEST_SIZE} bytes'}); return
+            body = self.body.read(length)
+            if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+                decompressor = zlib.decompressobj(wbits=31)
+                body = decompressor.decompress(body, MAX_SYNC_MANIFEST_SIZE)
+                if decompressor.unconsumed_tail: self._send_json_response(413, {'error': f'Manifest larger than {MAX_SYNC_MANIFEST_SIZE} bytes'}); return
+            data = json.loads(body.decode('utf-8')) if body else {}
+            if not isinstance(data, dict) or not isinstance(data.get('files', []), list):
+                raise ValueError("Expected a JSON object with a 'files' list")
+            validation_result = self._get_validated_path(data.get('path', params.get('path', '')))
+            if validation_result is None: self._send_json_response(403, {'error': 'Invalid path'}); return
+            abs_path, _ = validation_result
+            if not os.path.isdir(abs_path): self._send_json_response(404, {'error': 'Directory Not Found'}); return
+            started = time.monotonic()
+            plan = plan_sync(abs_to_rel(abs_path), data.get('files', []), str(data.get('mode', 'push')),
+                             bool(data.get('delete')), bool(data.get('fresh')))
+            log_event('sync', f"Sync plan for /{plan['path']}: {len(data.get('files', []))} client files, "
+                      f"{len(plan['upload'])} to upload, {len(plan['download'])} to download ({time.monotonic() - started:.2f}s)",
+                      path=plan['path'], upload=len(plan['upload']), download=len(plan['download']))
+            self._send_json_response(200, plan)
+            return
+
+        validation_result = self._get_validated_path(params.get('path'))
+        if validation_result is None: self._send_json_response(403, {'error': 'Invalid path'}); return
+        abs_path, rel_path = validation_result
+        if route == ['signature'] and method == 'GET':
+            try:
+                st = os.stat(abs_path)
+            except OSError: self._send_json_response(404, {'error': 'File Not Found'}); return
+            if not os.path.isfile(abs_path): self._send_json_response(404, {'error': 'File Not Found'}); return
+            block_size = int(params['block_size']) if params.get('block_size') else None
+            if block_size is not None and not 1024 <= block_size <= 64 * 1024 * 1024:
+                raise ValueError("block_size must be between 1024 and 67108864")
+            signature = file_signature(abs_path, block_size)
+            etag = file_etag(st)
+            self._send_json_response(200, dict(signature, path=rel_path, mtime=st.st_mtime, etag=etag), {'ETag': etag})
+        elif route == ['patch'] and method == 'POST':
+            # A delta against the file's current content (see file_signature),
+            # which must still be the version the signature was taken from.
+            if self._request_length() is None: self._send_json_response(411, {'error': 'Length Required for the delta'}); return
+            try:
+                st = os.stat(abs_path)
+            except OSError: self._send_json_response(404, {'error': 'File Not Found'}); return
+            if not os.path.isfile(abs_path): self._send_json_response(404, {'error': 'File Not Found'}); return
+            if_match = self.headers.get('If-Match')
+            if if_match is None: self._send_json_response(428, {'error': 'If-Match with the signature ETag is required'}); return
+            if not etag_matches(if_match, file_etag(st)): self._send_json_response(412, {'error': 'File changed since its signature was taken'}); return
+            temp_save_path = abs_path + ".uploading"
+            try:
+                with metrics.transfer('upload'):
+                    size, digest, copied, sent = apply_delta(self.body, abs_path, temp_save_path, MAX_RESUMABLE_UPLOAD_SIZE)
+                if params.get('sha256') and params['sha256'].lower() != digest:
+                    self._send_json_response(422, {'error': 'SHA-256 of the result does not match', 'sha256': digest}); return
+                mtime = float(params['mtime']) if params.get('mtime') else None
+                duplicate_of = dedup.place(temp_save_path, abs_path, size, digest, mtime=mtime)
+            finally:
+                if os.path.exists(temp_save_path): os.remove(temp_save_path)
+            record_change('added', abs_path)
+            log_event('upload', f"Patched {rel_path} ({size} bytes, {sent} sent)", path=rel_path, size=size, sent=sent)
+            result = {'path': rel_path, 'size': size, 'sha256': digest, 'copied_bytes': copied, 'sent_bytes': sent}
+            if duplicate_of is not None:
+                result['duplicate_of'] = duplicate_of
+            self._send_json_response(200, result)
+        else:
+            self._send_json_response(404, {'error': 'Unknown API endpoint'})
+
+    def handle_upload(self, parts, content_length, query_string):
+        # Any number of 'file' parts, each streamed to disk as it arrives.
+        # Filenames may carry a relative path (folder uploads); missing
+        # folders are created. One bad file does not fail the others.
+        if content_length > MAX_UPLOAD_REQUEST_SIZE: self.send_error(413, f"Upload Too Large (Limit: {MAX_UPLOAD_REQUEST_SIZE // (1024*1024)} MB per request)"); return
 
         query_params = urllib.parse.parse_qs(query_string)
         target_rel_path = query_params.get('path', [''])[0]
@@ -651,42 +5631,90 @@ class GDriveHandler(SimpleHTTPRequestHandler):
         target_abs_path, _ = target_validation
 
         if not os.path.isdir(target_abs_path): self.send_error(404, "Upload target directory does not exist."); return
-        if 'file' not in form: self.send_error(400, "Missing 'file' field in form data."); return
 
-        file_item = form['file']
-        if not hasattr(file_item, 'file') or not hasattr(file_item, 'filename') or not file_item.filename:
-            self.send_error(400, "'file' field did not contain a valid file upload.")
+        results = []
+        try:
+            for part in parts:
+                if part.name != 'file' or not part.filename:
+                    continue
+                results.append(self._save_uploaded_file(part, target_abs_path))
+        except MultipartError as e:
+            log_event('upload', f"Upload error (malformed body) in /{target_rel_path}: {e}", level='warning',
+                      path=target_rel_path, saved=len(results))
+            self.send_error(400, f"Upload failed: {e}")
             return
+        if not results: self.send_error(400, "Missing 'file' field in form data."); return
+
+        saved = [result for result in results if 'error' not in result]
+        if len(results) > 1:
+            log_event('upload', f"Saved {len(saved)} of {len(results)} files to /{target_rel_path} ({sum(r['size'] for r in saved)} bytes)",
+                      path=target_rel_path, saved=len(saved), failed=len(results) - len(saved))
+        if self._wants_json():
+            self._send_json_response(200 if saved else results[0]['status'], {
+                'path': target_rel_path, 'saved': len(saved), 'failed': len(results) - len(saved),
+                'files': [{k: v for k, v in result.items() if k != 'status'} for result in results],
+            })
+        elif saved:
+            self._redirect('/' + urllib.parse.quote(target_rel_path if target_rel_path else ''))
+        else:
+            self.send_error(results[0]['status'], f"Upload failed: {results[0]['error']}")
 
-        filename = os.path.basename(file_item.filename)
-        if not filename: filename = "uploaded_file"
-        save_path = os.path.join(target_abs_path, filename)
-        temp_save_path = save_path + ".uploading"
+    def _upload_destination(self, target_abs_path, filename):
+        # Returns the save path, creating its folders. The name comes from the
+        # multipart headers, not the URL, so it is checked as is: unquoting it
+        # would turn a harmless '%2e%2e' into '..'.
+        components = upload_components(filename)
+        save_path = os.path.normpath(os.path.join(target_abs_path, *components))
+        if (os.path.commonpath([UPLOAD_DIR, save_path]) != UPLOAD_DIR
+                or os.path.relpath(save_path, UPLOAD_DIR).split(os.sep)[0] == STATE_DIR_NAME):
+            raise PermissionError("Invalid file name")
+        current = target_abs_path
+        for component in components[:-1]:
+            current = os.path.join(current, component)
+            if not os.path.isdir(current):
+                os.mkdir(current)
+                record_change('added', current, is_dir=True)
+        return save_path
 
+    def _save_uploaded_file(self, part, target_abs_path):
+        result = {'name': part.filename}
+        temp_save_path = None
         try:
-            print(f"Attempting upload to: {save_path} (via {temp_save_path})")
+            save_path = self._upload_destination(target_abs_path, part.filename)
+            result['path'] = abs_to_rel(save_path)
+            temp_save_path = save_path + ".uploading"
             bytes_written = 0
+            digest = hashlib.sha256() if DEDUP_ENABLED else None
             with open(temp_save_path, 'wb') as f:
-                chunk_size = 65536
                 while True:
-                    chunk = file_item.file.read(chunk_size)
+                    chunk = part.read(UPLOAD_CHUNK_SIZE)
                     if not chunk: break
                     bytes_written += len(chunk)
                     if bytes_written > MAX_UPLOAD_SIZE:
                         raise ValueError(f"File size exceeds limit ({MAX_UPLOAD_SIZE // (1024*1024)} MB) during transfer.")
                     f.write(chunk)
-            os.rename(temp_save_path, save_path)
-            print(f"Successfully saved {filename} to {target_abs_path}")
-            redirect_path = '/' + urllib.parse.quote(target_rel_path if target_rel_path else '')
-            self._redirect(redirect_path)
-        except ValueError as e:
-             print(f"Upload error (size limit) {save_path}: {e}")
-             if os.path.exists(temp_save_path): os.remove(temp_save_path)
-             self.send_error(413, f"Upload failed: {e}")
+                    if digest is not None: digest.update(chunk)
+            duplicate_of = dedup.place(temp_save_path, save_path, bytes_written, digest and digest.hexdigest(), mtime=part.mtime)
+            record_change('added', save_path)
+            log_event('upload', f"Saved {result['path']} ({bytes_written} bytes)", path=result['path'], size=bytes_written)
+            result['size'] = bytes_written
+            if duplicate_of is not None:
+                result['duplicate_of'] = duplicate_of
+            return result
+        except MultipartError:
+            if temp_save_path and os.path.exists(temp_save_path): os.remove(temp_save_path)
+            raise
         except Exception as e:
-            print(f"Upload error {save_path}: {e}")
-            if os.path.exists(temp_save_path): os.remove(temp_save_path)
-            self.send_error(500, f"Upload failed: {e}")
+            if isinstance(e, ValueError):
+                status, level = 413, 'warning'
+            elif isinstance(e, PermissionError):
+                status, level = 403, 'warning'
+            else:
+                status, level = 500, 'error'
+            log_event('upload', f"Upload error {result.get('path', part.filename)}: {e}", level=level, path=result.get('path'))
+            if temp_save_path and os.path.exists(temp_save_path): os.remove(temp_save_path)
+            result.update(error=str(e), status=status)
+            return result
 
     def handle_delete(self, form):
         if 'path' not in form: self.send_error(400, "Missing 'path' parameter for delete operation."); return
@@ -705,41 +5733,49 @@ class GDriveHandler(SimpleHTTPRequestHandler):
         parent_rel_path = os.path.dirname(rel_path) if rel_path else ""
         redirect_path = '/' + urllib.parse.quote(parent_rel_path if parent_rel_path else '')
         item_name_for_msg = html.escape(os.path.basename(abs_path_to_delete))
+        deleting_dir = os.path.isdir(abs_path_to_delete)
 
         try:
             if os.path.isfile(abs_path_to_delete):
-                print(f"Attempting to delete file: {abs_path_to_delete}")
                 os.remove(abs_path_to_delete)
-                print(f"Deleted file: {item_name_for_msg}")
+                log_event('delete', f"Deleted file: {rel_path}", path=rel_path)
             elif os.path.isdir(abs_path_to_delete):
-                print(f"Attempting to delete directory: {abs_path_to_delete}")
                 try:
                     dir_contents = os.listdir(abs_path_to_delete)
                 except PermissionError:
-                     print(f"Permission error reading contents of directory {abs_path_to_delete}")
+                     log_event('delete', f"Permission error reading contents of directory {abs_path_to_delete}", level='warning', path=rel_path)
                      self.send_error(403, f"Permission denied reading contents of '{item_name_for_msg}' for deletion check.")
                      return
 
                 if not dir_contents:
                     os.rmdir(abs_path_to_delete)
-                    print(f"Deleted empty directory: {item_name_for_msg}")
+                    log_event('delete', f"Deleted empty directory: {rel_path}", path=rel_path)
                 elif ALLOW_DELETE_NON_EMPTY_DIRS:
-                     print(f"WARNING: Recursively deleting non-empty directory: {abs_path_to_delete}")
-                     shutil.rmtree(abs_path_to_delete)
-                     print(f"Deleted non-empty directory: {item_name_for_msg}")
+                     job = jobs.submit('delete', abs_to_rel(abs_path_to_delete))
+                     log_event('delete', f"Recursive delete of {rel_path} queued as job {job['id']}", level='warning',
+                               path=rel_path, job=job['id'])
+                     if self._wants_json():
+                         self._send_json_response(202, {'path': rel_path, 'job': job}, {'Location': f"{API_PREFIX}jobs/{job['id']}"})
+                     else:
+                         self._redirect(redirect_path + '?job=' + job['id'])
+                     return
                 else:
-                     print(f"Delete failed: Directory '{item_name_for_msg}' is not empty.")
+                     log_event('delete', f"Delete failed: Directory '{rel_path}' is not empty.", path=rel_path)
                      self.send_error(400, f"Cannot delete non-empty directory '{item_name_for_msg}'.")
                      return
-            self._redirect(redirect_path)
+            record_change('deleted', abs_path_to_delete, is_dir=deleting_dir)
+            if self._wants_json():
+                self._send_json_response(200, {'path': rel_path, 'deleted': True})
+            else:
+                self._redirect(redirect_path)
         except PermissionError:
-            print(f"Permission denied trying to delete: {abs_path_to_delete}")
+            log_event('delete', f"Permission denied trying to delete: {abs_path_to_delete}", level='warning', path=rel_path)
             self.send_error(403, f"Permission denied to delete '{item_name_for_msg}'.")
         except OSError as e:
-            print(f"OS error deleting {abs_path_to_delete}: {e}")
+            log_event('delete', f"OS error deleting {abs_path_to_delete}: {e}", level='error', path=rel_path)
             self.send_error(500, f"Error deleting '{item_name_for_msg}': {e}")
         except Exception as e:
-            print(f"Unexpected error deleting {abs_path_to_delete}: {e}")
+            log_event('delete', f"Unexpected error deleting {abs_path_to_delete}: {e}", level='error', path=rel_path)
             self.send_error(500, f"Unexpected error deleting '{item_name_for_msg}'.")
 
     def handle_rename(self, form):
@@ -778,21 +5814,36 @@ class GDriveHandler(SimpleHTTPRequestHandler):
         redirect_path = '/' + urllib.parse.quote(parent_rel_path if parent_rel_path else '')
 
         try:
-            print(f"Attempting to rename '{old_abs_path}' to '{new_abs_path}'")
             os.rename(old_abs_path, new_abs_path)
-            print(f"Successfully renamed '{old_item_name_for_msg}' to '{new_name}'")
-            self._redirect(redirect_path)
+            record_change('renamed', new_abs_path, old_abs_path)
+            log_event('rename', f"Renamed '{old_rel}' to '{new_name}'", path=old_rel, new_path=abs_to_rel(new_abs_path))
+            if self._wants_json():
+                self._send_json_response(200, {'old_path': old_rel, 'path': abs_to_rel(new_abs_path),
+                                               'entry': listing_entry(abs_to_rel(new_abs_path))})
+            else:
+                self._redirect(redirect_path)
         except PermissionError:
-            print(f"Permission denied trying to rename: {old_abs_path}")
+            log_event('rename', f"Permission denied trying to rename: {old_abs_path}", level='warning', path=old_rel)
             self.send_error(403, f"Permission denied to rename '{old_item_name_for_msg}'.")
         except OSError as e:
-            print(f"OS error renaming {old_abs_path} to {new_abs_path}: {e}")
+            log_event('rename', f"OS error renaming {old_abs_path} to {new_abs_path}: {e}", level='error', path=old_rel)
             self.send_error(500, f"Error renaming '{old_item_name_for_msg}': {e}")
         except Exception as e:
-            print(f"Unexpected error renaming {old_abs_path}: {e}")
+            log_event('rename', f"Unexpected error renaming {old_abs_path}: {e}", level='error', path=old_rel)
             self.send_error(500, f"Unexpected error renaming '{old_item_name_for_msg}'.")
 
-def run(server_class=HTTPServer, handler_class=GDriveHandler, port=PORT):
+SERVER_CLASSES = {
+    'pool': PooledHTTPServer,
+    'threaded': DrainingThreadingHTTPServer,
+    'single': HTTPServer,
+}
+
+def run(server_class=None, handler_class=GDriveHandler, port=PORT):
+    if server_class is None:
+        server_class = SERVER_CLASSES.get(SERVER_MODE)
+        if server_class is None:
+            print(f"ERROR: Unknown SERVER_MODE '{SERVER_MODE}'. Use one of: {', '.join(SERVER_CLASSES)}")
+            return
     try:
         if not os.path.exists(UPLOAD_DIR):
              print(f"Creating upload directory: {UPLOAD_DIR}")
@@ -805,6 +5856,17 @@ def run(server_class=HTTPServer, handler_class=GDriveHandler, port=PORT):
         print("Please ensure the base path exists and Termux has storage permissions ('termux-setup-storage').")
         return
 
+    threading.Thread(target=_upload_session_gc_loop, name="upload-gc", daemon=True).start()
+    if DEDUP_ENABLED:
+        dedup.load()
+    jobs.start()
+    if SEARCH_INDEX_ENABLED:
+        threading.Thread(target=_search_index_loop, name="search-index", daemon=True).start()
+    if DISK_USAGE_ENABLED:
+        threading.Thread(target=_disk_usage_loop, name="disk-usage", daemon=True).start()
+    threading.Thread(target=_save_state_loop, name="state-save", daemon=True).start()
+    start_change_tracking()
+
     server_address = ('', port)
     try:
         httpd = server_class(server_address, handler_class)
@@ -816,21 +5878,36 @@ def run(server_class=HTTPServer, handler_class=GDriveHandler, port=PORT):
     print(f"   Username: {USERNAME}")
     print(f"   Directory: {UPLOAD_DIR}")
     print(f"   Mode: {'Allow delete non-empty dirs' if ALLOW_DELETE_NON_EMPTY_DIRS else 'Delete only files/empty dirs'}")
+    if isinstance(httpd, PooledHTTPServer):
+        print(f"   Workers: {httpd.max_workers} (queue limit {REQUEST_QUEUE_SIZE})")
+    else:
+        print(f"   Serving: {'one request at a time' if server_class is HTTPServer else 'one thread per connection'}")
     print(f"   Access locally at: http://localhost:{port} or http://<your-device-ip>:{port}")
     print(f"   If using ngrok (for external access), run: ngrok http {port}")
+    print(f"   Log: {event_log.path()}")
+    if THUMBNAILS_ENABLED:
+        kinds = [name for name, available in (('photos', Image is not None), ('videos', thumbnails.kind('video.mp4'))) if available]
+        print(f"   Thumbnails: {' and '.join(kinds) if kinds else 'off'}"
+              + ('' if Image is not None else " (install Pillow for photo thumbnails: pip install pillow)"))
     print("   WARNING: Basic Authentication over HTTP is not secure for internet exposure.")
     print("Press Ctrl+C to stop the server.")
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
-        print("\n🛑 Server stopping...")
-        httpd.server_close()
-        print("Server stopped.")
+        print("\n🛑 Server stopping... (waiting for active transfers to finish)")
     except Exception as e:
          print(f"\n🚨 Server encountered an unexpected error: {e}")
-         httpd.server_close()
+    finally:
+        # Whatever ended the server, keep the indexes and reap the thumbnail
+        # workers.
+        httpd.server_close()
+        change_bus.drain(timeout=5)
+        save_state()
+        thumbnails.shutdown()
+        event_log.close()
+        print("Server stopped.")
 
-if _name_ == "_main_":
+if __name__ == "__main__":
     print("--- Starting Personal Cloud Server ---")
     print("Reminder: Ensure Termux has storage access ('termux-setup-storage' command) and")
     print(f"          that the directory '{UPLOAD_DIR}' exists and is accessible.")
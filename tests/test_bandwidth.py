@@ -0,0 +1,101 @@
+import email.message
+
+import pytest
+
+import server
+
+
+class FakeTime:
+    # Stands in for the time module inside server: the clock only moves when
+    # told to, and sleeps are recorded instead of taken.
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept = seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(server, 'time', fake)
+    return fake
+
+
+def test_bulk_streams_share_the_rate_evenly(clock):
+    rate, chunk = 100_000, 1000
+    scheduler = server.BandwidthScheduler(global_rate=rate, client_rate=0, burst_seconds=0.25)
+    ready = {'a': clock.now, 'b': clock.now}
+    sent = {'a': 0, 'b': 0}
+    start, end = clock.now, clock.now + 10
+    while True:
+        stream = min(ready, key=ready.get)
+        if ready[stream] >= end:
+            break
+        clock.now, clock.slept = ready[stream], 0.0
+        scheduler.consume(stream, chunk)
+        sent[stream] += chunk
+        ready[stream] = clock.now + clock.slept
+    # The initial burst goes to whoever asks first; after that they alternate.
+    assert abs(sent['a'] - sent['b']) <= rate * 0.25 + chunk
+    # The burst allowance is the only thing sent beyond the rate.
+    assert sent['a'] + sent['b'] <= rate * (end - start + 0.25) + 2 * chunk
+    assert sent['a'] + sent['b'] >= rate * (end - start) - 2 * chunk
+
+
+def test_interactive_debt_is_capped(clock):
+    rate = 1000
+    scheduler = server.BandwidthScheduler(global_rate=rate, client_rate=0, burst_seconds=0)
+    scheduler.consume('page', 50 * rate, bulk=False)
+    assert clock.slept == 0
+    assert scheduler._global.tat == clock.now + server.BandwidthScheduler.MAX_INTERACTIVE_DEBT
+    scheduler.consume('download', rate)
+    assert clock.slept == pytest.approx(server.BandwidthScheduler.MAX_INTERACTIVE_DEBT + 1.0)
+
+
+def test_idle_clients_are_swept(clock):
+    scheduler = server.BandwidthScheduler(global_rate=0, client_rate=1000, burst_seconds=0)
+    scheduler.consume('10.0.0.1', 1000)
+    scheduler.consume('10.0.0.2', 1000)
+    clock.now += 30
+    scheduler.consume('10.0.0.2', 1000)
+    clock.now += server.BandwidthScheduler.CLIENT_IDLE_TIMEOUT - 20
+    scheduler.consume('10.0.0.2', 1000)
+    assert set(scheduler._clients) == {'10.0.0.2'}
+    clock.now += server.BandwidthScheduler.CLIENT_IDLE_TIMEOUT + 5
+    scheduler.consume('10.0.0.3', 1000)
+    assert set(scheduler._clients) == {'10.0.0.3'}
+
+
+def test_sweep_keeps_the_bucket_being_charged(clock):
+    scheduler = server.BandwidthScheduler(global_rate=0, client_rate=1000, burst_seconds=0)
+    scheduler.consume('10.0.0.1', 1000)
+    clock.now += server.BandwidthScheduler.CLIENT_IDLE_TIMEOUT * 3
+    scheduler.consume('10.0.0.1', 5000)
+    assert scheduler._clients['10.0.0.1'].tat == clock.now + 5
+
+
+class FakeRequest:
+
+    def __init__(self, peer, forwarded=None):
+        self.client_address = (peer, 50000)
+        self.headers = email.message.Message()
+        if forwarded is not None:
+            self.headers['X-Forwarded-For'] = forwarded
+
+
+@pytest.mark.parametrize('forged', ['', '1.2.3.4, ', '6.6.6.6, 7.7.7.7, '])
+def test_forged_forwarded_prefix_does_not_change_client(forged):
+    request = FakeRequest('127.0.0.1', forged + '203.0.113.9')
+    assert server.GDriveHandler._client_id(request) == '203.0.113.9'
+
+
+def test_forwarded_header_only_trusted_from_loopback():
+    assert server.GDriveHandler._client_id(FakeRequest('198.51.100.7', '203.0.113.9')) == '198.51.100.7'
+    assert server.GDriveHandler._client_id(FakeRequest('127.0.0.1')) == '127.0.0.1'
+    assert server.GDriveHandler._client_id(FakeRequest('127.0.0.1', '203.0.113.9,')) == '127.0.0.1'
@@ -0,0 +1,50 @@
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', [(0, 99)]),
+    ('bytes=900-', [(900, 999)]),
+    ('bytes=500-5000', [(500, 999)]),
+    ('bytes=-100', [(900, 999)]),
+    ('bytes=-5000', [(0, 999)]),
+    ('BYTES = 0-0', [(0, 0)]),
+])
+def test_single_ranges(header, expected):
+    assert server.parse_byte_ranges(header, 1000) == expected
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99,50-149', [(0, 149)]),
+    ('bytes=0-99,100-199', [(0, 199)]),
+    ('bytes=200-299,0-99', [(0, 99), (200, 299)]),
+    ('bytes=0-499,-600', [(0, 999)]),
+    ('bytes=10-20,0-999,30-40', [(0, 999)]),
+])
+def test_overlapping_ranges_are_merged_and_sorted(header, expected):
+    assert server.parse_byte_ranges(header, 1000) == expected
+
+
+@pytest.mark.parametrize('header', ['bytes=1000-', 'bytes=5000-6000', 'bytes=-0', 'bytes=1000-1000,2000-'])
+def test_unsatisfiable(header):
+    assert server.parse_byte_ranges(header, 1000) == []
+
+
+def test_unsatisfiable_parts_are_dropped():
+    assert server.parse_byte_ranges('bytes=2000-3000,0-9', 1000) == [(0, 9)]
+
+
+def test_empty_file():
+    assert server.parse_byte_ranges('bytes=0-', 0) == []
+    assert server.parse_byte_ranges('bytes=-10', 0) == []
+
+
+@pytest.mark.parametrize('header', ['items=0-9', 'bytes=', 'bytes=abc', 'bytes=5', 'bytes=9-1', 'bytes=-', 'bytes=x-9'])
+def test_malformed_headers_are_ignored(header):
+    assert server.parse_byte_ranges(header, 1000) is None
+
+
+def test_too_many_ranges_are_ignored():
+    parts = ','.join(f'{i * 10}-{i * 10 + 1}' for i in range(server.MAX_RANGES_PER_REQUEST + 1))
+    assert server.parse_byte_ranges('bytes=' + parts, 10000) is None
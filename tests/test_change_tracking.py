@@ -0,0 +1,142 @@
+import os
+import time
+
+import pytest
+
+import server
+from server import ChangeEvent
+
+
+def event(action, path, is_dir=False, old_path=None, source='server'):
+    return ChangeEvent(action, path, is_dir, old_path, source)
+
+
+@pytest.fixture
+def bus():
+    bus = server.ChangeBus(delay=0.2)
+    seen = []
+    bus.subscribe(seen.append)
+    return bus, seen
+
+
+def test_repeat_reports_within_the_delay_are_merged(bus):
+    bus, seen = bus
+    bus.publish(event('added', 'a/up.jpg'))
+    bus.publish(event('added', 'a/up.jpg', source='watcher'))
+    bus.publish(event('modified', 'a/up.jpg', source='watcher'))
+    assert bus.drain(timeout=5)
+    assert [(e.action, e.path, e.source) for e in seen] == [('added', 'a/up.jpg', 'server')]
+    assert bus.merged == 2
+
+
+def test_other_actions_on_the_same_path_are_kept(bus):
+    bus, seen = bus
+    bus.publish(event('added', 'a/f.txt'))
+    bus.publish(event('deleted', 'a/f.txt'))
+    bus.publish(event('added', 'a/f.txt'))
+    bus.publish(event('added', 'a/g.txt'))
+    bus.publish(event('renamed', 'a/h.txt', old_path='a/g.txt'))
+    bus.publish(event('modified', 'a', True))
+    assert bus.drain(timeout=5)
+    assert [(e.action, e.path) for e in seen] == [('added', 'a/f.txt'), ('deleted', 'a/f.txt'), ('added', 'a/f.txt'),
+                                                  ('added', 'a/g.txt'), ('renamed', 'a/h.txt'), ('modified', 'a')]
+    assert bus.merged == 0
+
+
+def test_delivered_change_is_not_merged_with_a_later_one(bus):
+    bus, seen = bus
+    bus.publish(event('modified', 'a/f.txt'))
+    assert bus.drain(timeout=5)
+    bus.publish(event('modified', 'a/f.txt'))
+    assert bus.drain(timeout=5)
+    assert len(seen) == 2
+
+
+def test_publish_does_not_wait_for_consumers():
+    bus = server.ChangeBus(delay=0)
+    bus.subscribe(lambda e: time.sleep(0.3))
+    started = time.monotonic()
+    bus.publish(event('added', 'x'))
+    assert time.monotonic() - started < 0.1
+    assert not bus.drain(timeout=0.05)
+    assert bus.drain(timeout=5)
+
+
+def test_failing_consumer_does_not_stop_the_others():
+    bus = server.ChangeBus(delay=0)
+    seen = []
+
+    def broken(e):
+        raise RuntimeError('boom')
+
+    bus.subscribe(broken)
+    bus.subscribe(seen.append)
+    bus.publish(event('added', 'x'))
+    assert bus.drain(timeout=5)
+    assert len(seen) == 1
+
+
+@pytest.fixture
+def drive(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'UPLOAD_DIR', str(tmp_path))
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'a' / 'old.txt').write_bytes(b'x')
+    return tmp_path
+
+
+def settle(*paths):
+    # Give every changed folder a fresh, distinct mtime and every new file an
+    # old one, so the watcher's checks don't depend on the filesystem
+    # clock's granularity.
+    settle.tick += 1
+    for path in paths:
+        if path.is_dir():
+            os.utime(path, ns=(0, time.time_ns() + settle.tick * 10**6))
+        else:
+            os.utime(path, (settle.tick, settle.tick))
+settle.tick = 1000
+
+
+def test_polling_watcher_diffs_folders(drive):
+    events = []
+    watcher = server.PollingWatcher(lambda action, path, is_dir: events.append((action, server.abs_to_rel(path), is_dir)))
+    watcher.start()
+    watcher.poll()
+    assert events == []
+
+    (drive / 'a' / 'new.txt').write_bytes(b'y')
+    (drive / 'a' / 'sub').mkdir()
+    settle(drive / 'a' / 'new.txt', drive / 'a')
+    watcher.poll()
+    assert sorted(events) == [('added', 'a/new.txt', False), ('added', 'a/sub', True)]
+
+    events.clear()
+    os.rename(drive / 'a' / 'new.txt', drive / 'a' / 'renamed.txt')
+    settle(drive / 'a')
+    watcher.poll()
+    assert sorted(events) == [('added', 'a/renamed.txt', False), ('deleted', 'a/new.txt', False)]
+
+    events.clear()
+    os.remove(drive / 'a' / 'old.txt')
+    (drive / 'a' / 'sub' / 'deep.txt').write_bytes(b'z')
+    settle(drive / 'a' / 'sub' / 'deep.txt', drive / 'a', drive / 'a' / 'sub')
+    watcher.poll()
+    assert sorted(events) == [('added', 'a/sub/deep.txt', False), ('deleted', 'a/old.txt', False)]
+
+    events.clear()
+    os.remove(drive / 'a' / 'sub' / 'deep.txt')
+    os.rmdir(drive / 'a' / 'sub')
+    settle(drive / 'a')
+    watcher.poll()
+    assert events == [('deleted', 'a/sub', True)]
+    assert str(drive / 'a' / 'sub') not in watcher._dirs
+
+
+def test_polling_watcher_ignores_state_dir(drive):
+    events = []
+    watcher = server.PollingWatcher(lambda *args: events.append(args))
+    watcher.start()
+    server.state_dir('search')
+    settle(drive)
+    watcher.poll()
+    assert events == []
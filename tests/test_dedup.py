@@ -0,0 +1,122 @@
+import errno
+import hashlib
+import os
+
+import pytest
+
+import server
+
+CONTENT = b'holiday photo ' * 100
+
+
+@pytest.fixture
+def catalog(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'UPLOAD_DIR', str(tmp_path))
+    monkeypatch.setattr(server, 'DEDUP_ENABLED', True)
+    monkeypatch.setattr(server, 'DEDUP_MIN_SIZE', 1)
+    monkeypatch.setattr(server, 'SEARCH_INDEX_ENABLED', False)
+    catalog = server.DedupCatalog()
+    catalog.reflinks = False  # tmpfs and ext4 can't clone; test the hardlink path everywhere
+    catalog.hardlinks = True
+    return catalog
+
+
+def existing(tmp_path, catalog, name='a.jpg', data=CONTENT):
+    path = tmp_path / name
+    path.write_bytes(data)
+    catalog.remember(str(path), hashlib.sha256(data).hexdigest())
+    return path
+
+
+def upload(tmp_path, catalog, name='b.jpg', data=CONTENT, mtime=None):
+    temp = tmp_path / (name + '.uploading')
+    temp.write_bytes(data)
+    save = tmp_path / name
+    linked = catalog.place(str(temp), str(save), len(data), hashlib.sha256(data).hexdigest(), mtime=mtime)
+    assert not temp.exists()
+    assert save.read_bytes() == data
+    return linked, save
+
+
+def test_duplicate_upload_becomes_a_link(tmp_path, catalog):
+    original = existing(tmp_path, catalog)
+    linked, save = upload(tmp_path, catalog)
+    assert linked == 'a.jpg'
+    assert os.stat(save).st_ino == os.stat(original).st_ino
+    assert (catalog.linked_files, catalog.linked_bytes) == (1, len(CONTENT))
+    assert catalog.duplicates()['groups'][0]['paths'] == ['a.jpg', 'b.jpg']
+
+
+def test_different_content_is_stored_as_is(tmp_path, catalog):
+    original = existing(tmp_path, catalog)
+    linked, save = upload(tmp_path, catalog, data=CONTENT[::-1])
+    assert linked is None
+    assert os.stat(save).st_ino != os.stat(original).st_ino
+
+
+def touch_later(path):
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 5 * 10**9))
+
+
+def rewrite(path):
+    path.unlink()
+    path.write_bytes(CONTENT)
+
+
+def grow(path):
+    with open(path, 'ab') as f:
+        f.write(b'!')
+
+
+@pytest.mark.parametrize('change', [touch_later, rewrite, grow])
+def test_stale_entry_is_ignored(tmp_path, catalog, change):
+    original = existing(tmp_path, catalog)
+    change(original)
+    linked, save = upload(tmp_path, catalog)
+    assert linked is None
+    assert os.stat(save).st_ino != os.stat(original).st_ino
+    assert 'a.jpg' not in catalog._entries
+
+
+@pytest.mark.parametrize('code', [errno.EPERM, errno.EXDEV])
+def test_hardlinks_disabled_when_unsupported(tmp_path, catalog, monkeypatch, code):
+    calls = []
+
+    def refuse(source, dest):
+        calls.append(dest)
+        raise OSError(code, os.strerror(code))
+
+    monkeypatch.setattr(server.os, 'link', refuse)
+    original = existing(tmp_path, catalog)
+    linked, save = upload(tmp_path, catalog)
+    assert linked is None
+    assert catalog.hardlinks is False
+    assert os.stat(save).st_ino != os.stat(original).st_ino
+    assert not [p for p in os.listdir(tmp_path) if p.endswith('.link')]
+
+    linked, _ = upload(tmp_path, catalog, name='c.jpg')
+    assert linked is None
+    assert len(calls) == 1
+
+
+def test_hardlink_skipped_when_mtimes_differ(tmp_path, catalog, monkeypatch):
+    calls = []
+    real_link = os.link
+    monkeypatch.setattr(server.os, 'link', lambda *args: (calls.append(args), real_link(*args)))
+    original = existing(tmp_path, catalog)
+    original_mtime = os.stat(original).st_mtime_ns
+    client_mtime = int(os.stat(original).st_mtime) - 3600
+    linked, save = upload(tmp_path, catalog, mtime=client_mtime)
+    assert linked is None
+    assert calls == []
+    assert int(os.stat(save).st_mtime) == client_mtime
+    assert os.stat(original).st_mtime_ns == original_mtime
+    assert catalog.hardlinks is True
+
+
+def test_hardlink_used_when_mtimes_match(tmp_path, catalog):
+    original = existing(tmp_path, catalog)
+    linked, save = upload(tmp_path, catalog, mtime=int(os.stat(original).st_mtime))
+    assert linked == 'a.jpg'
+    assert os.stat(save).st_ino == os.stat(original).st_ino
@@ -0,0 +1,92 @@
+import hashlib
+import io
+import random
+import struct
+import zlib
+
+import pytest
+
+import server
+
+
+def make_delta(signature, new):
+    # A minimal client: find blocks the server already has at any offset in
+    # the new data and send everything else as literal data.
+    block_size = signature['block_size']
+    known = {}
+    for index, (weak, strong) in enumerate(signature['blocks']):
+        known.setdefault((weak, strong), index)
+    out = io.BytesIO()
+    literal = bytearray()
+
+    def flush():
+        if literal:
+            out.write(b'D' + struct.pack('>Q', len(literal)) + literal)
+            literal.clear()
+
+    pos = 0
+    while pos < len(new):
+        block = new[pos:pos + block_size]
+        index = None
+        if len(block) == block_size:
+            index = known.get((zlib.adler32(block), hashlib.sha256(block).hexdigest()[:16]))
+        if index is None:
+            literal.append(new[pos])
+            pos += 1
+            continue
+        flush()
+        out.write(b'C' + struct.pack('>QQ', index * block_size, block_size))
+        pos += block_size
+    flush()
+    return out.getvalue()
+
+
+@pytest.fixture
+def base(tmp_path):
+    data = random.Random(0).randbytes(64 * 1024 + 123)
+    path = tmp_path / 'base.bin'
+    path.write_bytes(data)
+    return path, data
+
+
+def test_round_trip(base, tmp_path):
+    path, data = base
+    new = data[:5000] + b'inserted bytes' + data[5000:40000] + data[50000:] + b'appended'
+    signature = server.file_signature(str(path), block_size=1024)
+    delta = make_delta(signature, new)
+    out = tmp_path / 'out.bin'
+    size, digest, copied, sent = server.apply_delta(io.BytesIO(delta), str(path), str(out), len(new))
+    assert out.read_bytes() == new
+    assert (size, digest) == (len(new), hashlib.sha256(new).hexdigest())
+    assert copied + sent == size
+    assert sent < 3 * 1024 + 30
+
+
+def test_empty_delta_gives_empty_file(base, tmp_path):
+    path, _ = base
+    out = tmp_path / 'out.bin'
+    assert server.apply_delta(io.BytesIO(b''), str(path), str(out), 100) == (0, hashlib.sha256(b'').hexdigest(), 0, 0)
+    assert out.read_bytes() == b''
+
+
+@pytest.mark.parametrize('delta, message', [
+    (b'X', 'Unknown delta record'),
+    (b'C' + struct.pack('>Q', 0), 'ended in the middle'),
+    (b'D' + struct.pack('>Q', 10) + b'short', 'ended in the middle'),
+    (b'C' + struct.pack('>QQ', 64 * 1024, 1024), 'past the end'),
+    (b'C' + struct.pack('>QQ', 2 ** 64 - 1, 1), 'past the end'),
+    (b'D' + struct.pack('>Q', 2 ** 40), 'larger than'),
+])
+def test_corrupt_patch(base, tmp_path, delta, message):
+    path, _ = base
+    with pytest.raises(ValueError, match=message):
+        server.apply_delta(io.BytesIO(delta), str(path), str(tmp_path / 'out.bin'), 10 ** 6)
+
+
+def test_signature_grows_block_size_for_large_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'SYNC_BLOCK_SIZE', 16)
+    path = tmp_path / 'f.bin'
+    path.write_bytes(b'x' * (16 * 65536 * 2 + 1))
+    signature = server.file_signature(str(path))
+    assert signature['block_size'] == 32
+    assert len(signature['blocks']) == -(-path.stat().st_size // 32)
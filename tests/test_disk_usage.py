@@ -0,0 +1,147 @@
+import os
+import shutil
+
+import pytest
+
+import server
+from server import ChangeEvent
+
+
+@pytest.fixture
+def drive(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'UPLOAD_DIR', str(tmp_path))
+    for rel, size in (('a/x.bin', 1000), ('a/b/y.bin', 2000), ('a/b/c/z.bin', 3000), ('top.bin', 7)):
+        write(tmp_path, rel, size)
+    return tmp_path
+
+
+@pytest.fixture
+def index(drive):
+    index = server.DiskUsageIndex()
+    index.rebuild()
+    return index
+
+
+def write(root, rel, size):
+    path = root / rel
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'x' * size)
+
+
+def event(action, path, is_dir=False, old_path=None, source='server'):
+    return ChangeEvent(action, path, is_dir, old_path, source)
+
+
+def assert_matches_disk(index, root):
+    def state(nodes):
+        return {rel: (n.bytes, n.files, n.dirs, n.own_bytes, n.own_files, n.children, n.sizes) for rel, n in nodes.items()}
+    assert state(index._dirs) == state(index._walk(str(root), ''))
+
+
+def test_rebuild_totals(index):
+    assert index.totals('') == (6007, 4, 3)
+    assert index.totals('a/b') == (5000, 2, 1)
+
+
+def test_add_file(index, drive):
+    write(drive, 'a/b/new.bin', 500)
+    index.apply(event('added', 'a/b/new.bin'))
+    assert index.totals('') == (6507, 5, 3)
+    assert index.totals('a/b/c') == (3000, 1, 0)
+    assert_matches_disk(index, drive)
+
+
+def test_modify_file(index, drive):
+    write(drive, 'a/b/c/z.bin', 10)
+    index.apply(event('modified', 'a/b/c/z.bin'))
+    assert index.totals('a') == (3010, 3, 2)
+    assert_matches_disk(index, drive)
+
+
+def test_delete_file(index, drive):
+    os.remove(drive / 'a' / 'x.bin')
+    index.apply(event('deleted', 'a/x.bin'))
+    assert index.totals('a') == (5000, 2, 2)
+    assert_matches_disk(index, drive)
+
+
+def test_rename_file_across_folders(index, drive):
+    os.rename(drive / 'a' / 'b' / 'y.bin', drive / 'moved.bin')
+    index.apply(event('renamed', 'moved.bin', old_path='a/b/y.bin'))
+    assert index.totals('a') == (4000, 2, 2)
+    assert index.totals('') == (6007, 4, 3)
+    assert_matches_disk(index, drive)
+
+
+def test_rename_and_delete_folder(index, drive):
+    os.rename(drive / 'a' / 'b', drive / 'b2')
+    index.apply(event('renamed', 'b2', True, old_path='a/b'))
+    assert index.totals('a') == (1000, 1, 0)
+    assert index.totals('b2/c') == (3000, 1, 0)
+    assert index.totals('a/b') is None
+    assert_matches_disk(index, drive)
+    shutil.rmtree(drive / 'b2')
+    index.apply(event('deleted', 'b2', True))
+    assert index.totals('') == (1007, 2, 1)
+    assert_matches_disk(index, drive)
+
+
+def test_new_folder_with_files(index, drive):
+    write(drive, 'n/m/f.bin', 40)
+    write(drive, 'n/g.bin', 2)
+    index.apply(event('added', 'n', True))
+    assert index.totals('n') == (42, 2, 1)
+    assert_matches_disk(index, drive)
+
+
+def test_repeated_events_count_once(index, drive):
+    # The server and the watcher both report an upload, and inotify adds a
+    # write after the create.
+    write(drive, 'a/up.bin', 300)
+    for e in (event('added', 'a/up.bin'), event('added', 'a/up.bin', source='watcher'),
+              event('modified', 'a/up.bin', source='watcher')):
+        index.apply(e)
+    assert index.totals('a') == (6300, 4, 2)
+    os.remove(drive / 'a' / 'up.bin')
+    index.apply(event('deleted', 'a/up.bin'))
+    index.apply(event('deleted', 'a/up.bin', source='watcher'))
+    assert index.totals('a') == (6000, 3, 2)
+    assert_matches_disk(index, drive)
+
+
+def test_event_for_vanished_file(index, drive):
+    index.apply(event('added', 'a/ghost.bin'))
+    assert index.totals('a') == (6000, 3, 2)
+    assert_matches_disk(index, drive)
+
+
+def test_file_in_unknown_folder(index, drive):
+    write(drive, 'p/q/f.bin', 9)
+    index.apply(event('added', 'p/q/f.bin'))
+    assert index.totals('p') == (9, 1, 1)
+    assert_matches_disk(index, drive)
+
+
+def test_folder_replaced_by_file(index, drive):
+    shutil.rmtree(drive / 'a' / 'b')
+    write(drive, 'a/b', 5)
+    index.apply(event('added', 'a/b'))
+    assert index.totals('a') == (1005, 2, 0)
+    assert_matches_disk(index, drive)
+
+
+def test_modified_folder_is_rescanned(index, drive):
+    write(drive, 'a/b/outside.bin', 70)  # written by something that sent no event of its own
+    index.apply(event('modified', 'a/b', True, source='watcher'))
+    assert index.totals('a/b') == (5070, 3, 1)
+    assert_matches_disk(index, drive)
+
+
+def test_save_and_load(index, drive):
+    write(drive, 'a/extra.bin', 11)
+    index.apply(event('added', 'a/extra.bin'))
+    index.save()
+    loaded = server.DiskUsageIndex()
+    assert loaded.load()
+    assert loaded.totals('') == index.totals('')
+    assert_matches_disk(loaded, drive)
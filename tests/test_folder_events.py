@@ -0,0 +1,102 @@
+import pytest
+
+import server
+from server import ChangeEvent
+
+
+@pytest.fixture(autouse=True)
+def drive(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'UPLOAD_DIR', str(tmp_path))
+    monkeypatch.setattr(server, 'DISK_USAGE_ENABLED', False)
+    for rel in ('photos/a.jpg', 'photos/trip/b.jpg', 'photos2/c.jpg', 'top.txt'):
+        path = tmp_path / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'x' * 10)
+    return tmp_path
+
+
+def event(action, path, is_dir=False, old_path=None):
+    return ChangeEvent(action, path, is_dir, old_path, 'server')
+
+
+def names(messages):
+    return [(name, data.get('name') or data.get('entry', {}).get('name')) for name, data in messages]
+
+
+def test_only_direct_entries_of_the_folder():
+    messages = server.folder_events('photos', [
+        event('added', 'photos/a.jpg'),
+        event('added', 'photos2/c.jpg'),
+        event('added', 'top.txt'),
+    ])
+    assert names(messages) == [('add', 'a.jpg')]
+    assert messages[0][1]['entry']['path'] == 'photos/a.jpg'
+
+
+def test_change_below_a_subfolder_modifies_it():
+    messages = server.folder_events('photos', [event('added', 'photos/trip/b.jpg')])
+    assert names(messages) == [('modify', 'trip')]
+    assert messages[0][1]['entry']['type'] == 'folder'
+
+
+def test_root_folder_sees_top_level_entries_only():
+    messages = server.folder_events('', [
+        event('added', 'top.txt'),
+        event('added', 'photos2/c.jpg'),
+        event('added', server.STATE_DIR_NAME + '/search/index.pickle'),
+    ])
+    assert names(messages) == [('add', 'top.txt'), ('modify', 'photos2')]
+
+
+def test_rename_inside_and_across_folders(drive):
+    (drive / 'photos' / 'a.jpg').rename(drive / 'photos' / 'renamed.jpg')
+    (drive / 'photos2' / 'c.jpg').rename(drive / 'photos' / 'c.jpg')
+    messages = server.folder_events('photos', [
+        event('renamed', 'photos/renamed.jpg', old_path='photos/a.jpg'),
+        event('renamed', 'photos/c.jpg', old_path='photos2/c.jpg'),
+    ])
+    assert names(messages) == [('rename', 'renamed.jpg'), ('add', 'c.jpg')]
+    assert messages[0][1]['old_name'] == 'a.jpg'
+    assert names(server.folder_events('photos2', [event('renamed', 'photos/c.jpg', old_path='photos2/c.jpg')])) == [('remove', 'c.jpg')]
+
+
+def test_burst_on_one_file_is_one_message(drive):
+    (drive / 'photos' / 'new.jpg').write_bytes(b'y')
+    messages = server.folder_events('photos', [
+        event('added', 'photos/new.jpg'),
+        event('modified', 'photos/new.jpg'),
+        event('modified', 'photos/new.jpg'),
+    ])
+    # The page upserts on 'modify' as well, so only the count matters.
+    assert len(messages) == 1
+    assert messages[0][1]['entry']['size'] == 1
+
+
+def test_added_then_deleted_is_a_remove(drive):
+    messages = server.folder_events('photos', [
+        event('added', 'photos/gone.jpg'),
+        event('deleted', 'photos/gone.jpg'),
+    ])
+    assert messages == [('remove', {'name': 'gone.jpg'})]
+
+
+def test_entry_that_vanished_before_it_was_read_is_removed():
+    assert server.folder_events('photos', [event('added', 'photos/missing.jpg')]) == [('remove', {'name': 'missing.jpg'})]
+
+
+@pytest.mark.parametrize('gone', ['photos/trip', 'photos'])
+def test_deleted_folder_or_ancestor(gone):
+    assert server.folder_events('photos/trip', [event('deleted', gone, True)]) == [('gone', {'path': 'photos/trip', 'new_path': None})]
+
+
+def test_moved_ancestor_reports_new_path():
+    messages = server.folder_events('photos/trip', [event('renamed', 'albums', True, old_path='photos')])
+    assert messages == [('gone', {'path': 'photos/trip', 'new_path': 'albums/trip'})]
+
+
+def test_similar_prefix_is_not_an_ancestor():
+    assert server.folder_events('photos2', [event('deleted', 'photos', True)]) == []
+
+
+def test_rescan_reloads():
+    assert server.folder_events('photos', [event('added', 'photos/a.jpg'), ChangeEvent('rescan', '', True, None, 'watcher')]) == [('reload', {})]
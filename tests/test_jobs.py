@@ -0,0 +1,105 @@
+import json
+import os
+import time
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def drive(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'UPLOAD_DIR', str(tmp_path))
+    monkeypatch.setattr(server, 'DISK_USAGE_ENABLED', False)
+    monkeypatch.setattr(server, 'change_bus', server.ChangeBus())
+    return tmp_path
+
+
+def saved_job(drive, job_id, state, created, **fields):
+    job = {'id': job_id, 'kind': 'delete', 'path': 'old', 'state': state, 'created': created,
+           'started': created if state == 'running' else None, 'finished': time.time() if state == 'done' else None,
+           'items': 5, 'bytes': 500, 'total_items': None, 'total_bytes': None, 'error': None, **fields}
+    with open(os.path.join(server.state_dir('jobs'), job_id + '.json'), 'w', encoding='utf-8') as f:
+        json.dump(job, f)
+    return job
+
+
+def wait_until_finished(jobs, job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = jobs.status(job_id)
+        if job['state'] not in server.JobManager.UNFINISHED:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} still {job['state']}")
+
+
+def test_unfinished_jobs_are_requeued_on_start(drive):
+    running = saved_job(drive, 'a' * 32, 'running', 200.0)
+    queued = saved_job(drive, 'b' * 32, 'queued', 100.0)
+    done = saved_job(drive, 'c' * 32, 'done', 50.0)
+    jobs = server.JobManager()
+    jobs.start(workers=0)
+    assert [jobs._queue.get_nowait() for _ in range(jobs._queue.qsize())] == [queued['id'], running['id']]
+    for job_id in (running['id'], queued['id']):
+        job = jobs.status(job_id)
+        assert (job['state'], job['started'], job['items'], job['bytes']) == ('queued', None, 0, 0)
+        with open(jobs._path(job_id), encoding='utf-8') as f:
+            assert json.load(f)['state'] == 'queued'
+    assert jobs.status(done['id'])['state'] == 'done'
+
+
+def test_requeued_delete_runs_to_completion(drive):
+    (drive / 'old' / 'sub').mkdir(parents=True)
+    (drive / 'old' / 'sub' / 'f.txt').write_bytes(b'x' * 10)
+    job = saved_job(drive, 'd' * 32, 'running', 100.0)
+    jobs = server.JobManager()
+    jobs.start(workers=1)
+    finished = wait_until_finished(jobs, job['id'])
+    assert finished['state'] == 'done'
+    assert not (drive / 'old').exists()
+
+
+def test_same_delete_twice_returns_the_existing_job(drive):
+    jobs = server.JobManager()
+    first = jobs.submit('delete', 'photos')
+    assert jobs.submit('delete', 'photos')['id'] == first['id']
+    assert jobs.submit('delete', 'videos')['id'] != first['id']
+    jobs.cancel(first['id'])
+    assert jobs.submit('delete', 'photos')['id'] != first['id']
+
+
+def test_unknown_kind_is_rejected(drive):
+    with pytest.raises(server.JobError) as error:
+        server.JobManager().submit('format', '')
+    assert error.value.status == 400
+
+
+class CancelAfterThree(server.JobManager):
+
+    def progress(self, job, items=0, nbytes=0):
+        if job['items'] + items >= 3:
+            self.cancel(job['id'])
+        super().progress(job, items, nbytes)
+
+
+def test_cancel_stops_at_the_next_item(drive):
+    folder = drive / 'big'
+    folder.mkdir()
+    for n in range(10):
+        (folder / f'{n}.bin').write_bytes(b'x' * 100)
+    jobs = CancelAfterThree()
+    jobs.start(workers=1)
+    job = wait_until_finished(jobs, jobs.submit('delete', 'big')['id'])
+    assert job['state'] == 'cancelled'
+    assert job['items'] == 3
+    assert len(os.listdir(folder)) == 7
+    assert not jobs._cancelled
+
+
+def test_cancelling_a_queued_job(drive):
+    jobs = server.JobManager()
+    job = jobs.submit('delete', 'photos')
+    assert jobs.cancel(job['id'])['state'] == 'cancelled'
+    with pytest.raises(server.JobError):
+        jobs.cancel('0' * 32)
@@ -0,0 +1,38 @@
+import os
+import time
+
+import server
+
+
+def test_record_change_drops_listing_after_in_place_edit(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'UPLOAD_DIR', str(tmp_path))
+    monkeypatch.setattr(server, 'CHANGE_TRACKING', 'off')
+    cache = server.DirectoryListingCache()
+    monkeypatch.setattr(server, 'listing_cache', cache)
+    # A bus of our own: the real one would hand the event to the indexes
+    # after this test has put UPLOAD_DIR back.
+    bus = server.ChangeBus(delay=60)
+    monkeypatch.setattr(server, 'change_bus', bus)
+    path = tmp_path / 'a.txt'
+    path.write_bytes(b'x')
+    old = time.time() - 10
+    os.utime(tmp_path, (old, old))
+    first = cache.get(str(tmp_path))
+    assert cache.get(str(tmp_path)) is first
+
+    path.write_bytes(b'12345')  # rewritten in place: the folder's mtime stays put
+    assert cache.get(str(tmp_path)) is first
+    server.record_change('modified', str(path))
+    assert cache.get(str(tmp_path)).files[0][1] == 5
+    assert [e.action for _, e in bus._pending] == ['modified']
+
+
+def test_sorted_views_are_kept_on_the_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'UPLOAD_DIR', str(tmp_path))
+    monkeypatch.setattr(server, 'DISK_USAGE_ENABLED', False)
+    for name in ('b.txt', 'a.txt'):
+        (tmp_path / name).write_bytes(b'x')
+    snapshot = server.DirectorySnapshot(str(tmp_path))
+    view = server.sorted_listing(snapshot, '', 'name', False)
+    assert [entry[1] for entry in view] == ['a.txt', 'b.txt']
+    assert server.sorted_listing(snapshot, '', 'name', False) is view
@@ -0,0 +1,83 @@
+import base64
+import json
+
+import pytest
+
+import server
+
+# ('folder' | 'file', name, size, mtime, file_count), as sorted_listing builds them.
+ENTRIES = [
+    ('folder', 'Photos', 5000, None, 3),
+    ('folder', 'docs', 10, None, 1),
+    ('file', 'a.txt', 300, 1700000002.5, None),
+    ('file', 'B.txt', 100, 1700000001.0, None),
+    ('file', 'c.bin', 200, 1700000003.0, None),
+]
+
+
+def view_for(sort, descending):
+    key = server.LISTING_SORT_KEYS[sort]
+    dirs = [e for e in ENTRIES if e[0] == 'folder']
+    files = [e for e in ENTRIES if e[0] == 'file']
+    return sorted(dirs, key=key, reverse=descending) + sorted(files, key=key, reverse=descending)
+
+
+def encode(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+@pytest.mark.parametrize('sort', sorted(server.LISTING_SORT_KEYS))
+@pytest.mark.parametrize('descending', [False, True])
+def test_cursor_resumes_after_its_entry(sort, descending):
+    view = view_for(sort, descending)
+    for i, entry in enumerate(view):
+        cursor = server.listing_cursor(entry, sort)
+        assert server.listing_position_after(view, cursor, sort, descending) == i + 1
+
+
+def test_cursor_survives_removal_of_its_entry():
+    view = view_for('name', False)
+    cursor = server.listing_cursor(view[2], 'name')
+    del view[2]
+    assert server.listing_position_after(view, cursor, 'name', False) == 2
+
+
+@pytest.mark.parametrize('cursor', [
+    '!!!not base64',
+    base64.urlsafe_b64encode(b'\xff\xfe').decode(),
+    encode(5),
+    encode('abc'),
+    encode({'kind': 1}),
+    encode([]),
+    encode([7, 'a.txt']),
+    encode([None]),
+])
+def test_malformed_cursors(cursor):
+    with pytest.raises(ValueError):
+        server.listing_position_after(view_for('name', False), cursor, 'name', False)
+
+
+@pytest.mark.parametrize('cursor, sort', [
+    (encode([1, 'b', 'b']), 'size'),
+    (encode([1, None, 'b', 'b']), 'mtime'),
+    (encode([0, {'a': 1}]), 'name'),
+    (encode([1, ['x'], 'a.txt', 'a.txt']), 'size'),
+])
+def test_cursor_with_wrong_key_types(cursor, sort):
+    with pytest.raises(ValueError):
+        server.listing_position_after(view_for(sort, False), cursor, sort, False)
+
+
+def test_cursor_from_another_sort_order():
+    view = view_for('size', False)
+    cursor = server.listing_cursor(view[3], 'name')
+    with pytest.raises(ValueError):
+        server.listing_position_after(view, cursor, 'size', False)
+
+
+def test_listing_page_rejects_bad_cursor(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'UPLOAD_DIR', str(tmp_path))
+    (tmp_path / 'f.txt').write_bytes(b'x')
+    snapshot = server.DirectorySnapshot(str(tmp_path))
+    with pytest.raises(ValueError):
+        server.listing_page(snapshot, '', cursor=encode([]))
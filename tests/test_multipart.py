@@ -0,0 +1,86 @@
+import io
+
+import pytest
+
+import server
+
+BOUNDARY = b'----formboundary42'
+
+
+class ChunkedBody:
+    # Hands the body out `size` bytes at a time, the way a slow socket would.
+
+    def __init__(self, data, size):
+        self._data = io.BytesIO(data)
+        self._size = size
+
+    def read1(self, n):
+        return self._data.read(min(n, self._size))
+
+
+def part(name, value, filename=None):
+    disposition = f'form-data; name="{name}"'
+    if filename is not None:
+        disposition += f'; filename="{filename}"'
+    return b'--' + BOUNDARY + f'\r\nContent-Disposition: {disposition}\r\n\r\n'.encode() + value + b'\r\n'
+
+
+def read_parts(body, chunk_size, content_length=None):
+    reader = server.MultipartReader(ChunkedBody(body, chunk_size), BOUNDARY,
+                                    len(body) if content_length is None else content_length)
+    parts = []
+    for p in reader:
+        data = bytearray()
+        while True:
+            chunk = p.read(5)
+            if not chunk:
+                break
+            data += chunk
+        parts.append((p.name, p.filename, bytes(data)))
+    return parts
+
+
+def test_parts_are_read_in_order():
+    body = part('path', b'photos') + part('file', b'hello world', 'a.txt') + b'--' + BOUNDARY + b'--\r\n'
+    assert read_parts(body, 4096) == [('path', None, b'photos'), ('file', 'a.txt', b'hello world')]
+
+
+@pytest.mark.parametrize('chunk_size', range(1, len(BOUNDARY) + 8))
+def test_boundary_split_across_reads(chunk_size):
+    # Data that looks like the start of a delimiter must come through intact
+    # however the reads happen to cut it.
+    payload = b'x\r\n--' + BOUNDARY[:-1] + b'y\r\n-' * 3 + b'end'
+    body = part('file', payload, 'f.bin') + part('note', b'ok') + b'--' + BOUNDARY + b'--\r\n'
+    assert read_parts(body, chunk_size) == [('file', 'f.bin', payload), ('note', None, b'ok')]
+
+
+def test_missing_closing_boundary():
+    body = part('file', b'truncated upload', 'f.bin')
+    with pytest.raises(server.MultipartError):
+        read_parts(body, 7)
+
+
+def test_body_shorter_than_content_length():
+    body = part('file', b'cut off', 'f.bin')
+    with pytest.raises(server.MultipartError):
+        read_parts(body, 7, content_length=len(body) + 100)
+
+
+def test_no_boundary_at_all():
+    with pytest.raises(server.MultipartError):
+        read_parts(b'just some bytes, no multipart here', 8)
+
+
+def test_oversized_part_headers():
+    # The limit bounds what is buffered while waiting for the headers to end.
+    body = b'--' + BOUNDARY + b'\r\nX-Padding: ' + b'a' * (2 * server.MAX_PART_HEADER_SIZE) + b'\r\n\r\nv\r\n--' + BOUNDARY + b'--'
+    with pytest.raises(server.MultipartError):
+        read_parts(body, 1024)
+
+
+def test_collect_fields_skips_files():
+    body = part('path', b'docs') + part('file', b'data', 'd.txt') + part('mode', b'x') + b'--' + BOUNDARY + b'--'
+    form = server.MultipartReader(ChunkedBody(body, 3), BOUNDARY, len(body)).collect_fields()
+    assert form.getvalue('path') == 'docs'
+    assert form.getvalue('mode') == 'x'
+    assert 'file' not in form
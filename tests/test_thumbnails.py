@@ -0,0 +1,69 @@
+import concurrent.futures
+import os
+import threading
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'UPLOAD_DIR', str(tmp_path))
+    monkeypatch.setattr(server, 'THUMBNAIL_TIMEOUT', 0.05)
+    gate = threading.Event()
+
+    def render(kind, abs_path, out_path, size, quality, ffmpeg):
+        gate.wait(5)
+        with open(out_path, 'wb') as f:
+            f.write(b'j' * 100)
+        return 100
+
+    monkeypatch.setattr(server, '_render_thumbnail', render)
+    svc = server.ThumbnailService()
+    svc._pool = concurrent.futures.ThreadPoolExecutor(1)
+    yield svc, gate
+    gate.set()
+    svc.shutdown()
+
+
+def photo(tmp_path, name):
+    path = tmp_path / name
+    path.write_bytes(name.encode())
+    return str(path), os.stat(path)
+
+
+def test_timeout_is_not_a_failure_and_late_render_is_accounted(service, tmp_path):
+    svc, gate = service
+    first, second = photo(tmp_path, 'a.jpg'), photo(tmp_path, 'b.jpg')
+    # One worker: the second render only waits in the queue.
+    assert svc.get(*first, 'image') is None
+    assert svc.get(*second, 'image') is None
+    assert svc.failures == 0 and not svc._failed
+    futures = [future for future, _ in svc._pending.values()]
+    assert len(futures) == 2
+
+    gate.set()
+    concurrent.futures.wait(futures)
+    svc._pool.shutdown(wait=True)  # done callbacks have run
+    assert svc.generated == 2
+    assert not svc._pending
+    assert svc._total_bytes == 200
+
+    assert svc.get(*first, 'image') == b'j' * 100
+    assert svc.hits == 1
+
+
+def test_render_error_is_remembered(service, tmp_path, monkeypatch):
+    svc, gate = service
+
+    def broken(*args):
+        raise OSError('cannot identify image file')
+
+    monkeypatch.setattr(server, '_render_thumbnail', broken)
+    source = photo(tmp_path, 'bad.jpg')
+    assert svc.get(*source, 'image') is None
+    assert svc.failures == 1
+    assert svc.key(source[1]) in svc._failed
+    assert svc.get(*source, 'image') is None
+    assert svc.failures == 1
@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize('filename, expected', [
+    ('photo.jpg', ['photo.jpg']),
+    ('album/2024/photo.jpg', ['album', '2024', 'photo.jpg']),
+    ('../../etc/passwd', ['etc', 'passwd']),
+    ('..', ['uploaded_file']),
+    ('a/./b/../c', ['a', 'b', 'c']),
+    ('C:\\Users\\me\\..\\x.txt', ['C:', 'Users', 'me', 'x.txt']),
+    ('\\\\server\\share\\f', ['server', 'share', 'f']),
+    ('', ['uploaded_file']),
+    ('///', ['uploaded_file']),
+    ('%2e%2e', ['%2e%2e']),
+])
+def test_upload_components(filename, expected):
+    assert server.upload_components(filename) == expected
+
+
+@pytest.fixture
+def drive(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'UPLOAD_DIR', str(tmp_path))
+    monkeypatch.setattr(server, 'change_bus', server.ChangeBus())
+    return tmp_path
+
+
+def destination(target, filename):
+    return server.GDriveHandler._upload_destination(None, str(target), filename)
+
+
+@pytest.mark.parametrize('filename', ['%2e%2e', 'a%2F..%2F..%2Fb', '%2Edrive'])
+def test_percent_escapes_are_plain_names(drive, filename):
+    assert destination(drive, filename) == os.path.join(str(drive), filename)
+
+
+def test_folder_upload_creates_folders(drive):
+    assert destination(drive, 'trip/day1/a.jpg') == os.path.join(str(drive), 'trip', 'day1', 'a.jpg')
+    assert (drive / 'trip' / 'day1').is_dir()
+
+
+def test_climbing_names_stay_in_target(drive):
+    (drive / 'photos').mkdir()
+    assert destination(drive / 'photos', '../../../x.jpg') == os.path.join(str(drive), 'photos', 'x.jpg')
+    assert destination(drive / 'photos', '..\\..\\y.jpg') == os.path.join(str(drive), 'photos', 'y.jpg')
+
+
+@pytest.mark.parametrize('filename', [server.STATE_DIR_NAME + '/search/index.pickle', server.STATE_DIR_NAME,
+                                      '..\\' + server.STATE_DIR_NAME + '\\x'])
+def test_state_dir_is_off_limits_at_the_root(drive, filename):
+    with pytest.raises(PermissionError):
+        destination(drive, filename)
+    assert not (drive / server.STATE_DIR_NAME / 'search').exists()
+
+
+def test_state_dir_name_is_fine_below_the_root(drive):
+    (drive / 'docs').mkdir()
+    assert destination(drive / 'docs', server.STATE_DIR_NAME) == os.path.join(str(drive), 'docs', server.STATE_DIR_NAME)
+
+
+def test_empty_name_falls_back(drive):
+    assert destination(drive, '') == os.path.join(str(drive), 'uploaded_file')